@@ -0,0 +1,116 @@
+#!/usr/bin/python
+"""Compares the Flask Database service, run by gunicorn with its gunicorn.conf.py, with its ASGI variant run by
+uvicorn, by the p50 and p99 latency and the throughput of /api/get and /api/put requests at growing numbers of
+concurrent callers. Each server runs on a copy of ../Database in a temporary directory, with --goods generated goods,
+and one request in --write-every is a write. Needs the packages of requirements.txt installed.
+
+    python bench_asgi.py --concurrency 1 10 100 1000 --requests 5000 --workers 2
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import aiohttp
+from measure import percentile
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database")
+COMMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common")
+
+def start(command, port, options):
+    """Starts a server on a fresh copy of the service and its generated database, and waits until it answers
+    """
+    directory = tempfile.mkdtemp()
+    for name in ("database.py", "database_asgi.py", "gunicorn.conf.py"):
+        shutil.copy(os.path.join(DATABASE, name), directory)
+    #The shared modules go next to the service, like in its image
+    for name in ("serving.py", "database_client.py"):
+        shutil.copy(os.path.join(COMMON, name), directory)
+    subprocess.run([sys.executable, "-c", "import database"], cwd=directory, check=True, stdout=subprocess.DEVNULL)
+    conn = sqlite3.connect(os.path.join(directory, "database.db"))
+    conn.executemany("INSERT INTO goods (name, category, price, description, count) VALUES (?, 'food', ?, ?, 1000000)",
+                     (("good{}".format(i), i % 100, "Good number {}".format(i)) for i in range(options.goods)))
+    conn.commit()
+    conn.close()
+    env = dict(os.environ, PORT=str(port), WORKERS=str(options.workers), QUEUE_REPORT_INTERVAL="0")
+    server = subprocess.Popen(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        #A get without a body is refused, any http answer means the server is up
+        try:
+            urllib.request.urlopen("http://127.0.0.1:{}/api/get".format(port), timeout=1)
+            return server
+        except urllib.error.HTTPError:
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("{} did not start".format(" ".join(command)))
+
+async def call(session, url, options, latencies, errors):
+    name = "good{}".format(random.randrange(options.goods))
+    begin = time.perf_counter()
+    if options.write_every and random.randrange(options.write_every) == 0:
+        response = await session.put(url + "/api/put", json={"op": "goods.deduct", "args": [0, name, 0, 0]})
+    else:
+        response = await session.get(url + "/api/get", json={"op": "goods.by_name", "args": [name]})
+    async with response:
+        await response.read()
+        if response.status != 200:
+            errors.append(response.status)
+    latencies.append((time.perf_counter() - begin) * 1000)
+
+async def load(url, concurrency, options):
+    """Sends --requests requests from concurrency callers and returns their latencies, the errors and the duration
+    """
+    latencies, errors = [], []
+    remaining = [options.requests]
+
+    async def caller(session):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            try:
+                await call(session, url, options, latencies, errors)
+            except aiohttp.ClientError as e:
+                errors.append(type(e).__name__)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        begin = time.perf_counter()
+        await asyncio.gather(*(caller(session) for _ in range(concurrency)))
+        return latencies, errors, time.perf_counter() - begin
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--goods", type=int, default=10000)
+    parser.add_argument("--write-every", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=2)
+    options = parser.parse_args()
+
+    servers = {"flask": ["gunicorn", "database:app"],
+               "asgi": ["uvicorn", "database_asgi:app", "--host", "127.0.0.1", "--port", "5202",
+                        "--workers", str(options.workers), "--log-level", "warning", "--backlog", "2048"]}
+    ports = {"flask": 5201, "asgi": 5202}
+    for name, command in servers.items():
+        server = start(command, ports[name], options)
+        try:
+            for concurrency in options.concurrency:
+                latencies, errors, elapsed = asyncio.run(load("http://127.0.0.1:{}".format(ports[name]), concurrency,
+                                                              options))
+                print("{:<6} {:>5} callers  {:>7.0f} req/s  p50 {:8.2f}ms  p99 {:8.2f}ms  {} errors".format(
+                    name, concurrency, len(latencies) / elapsed, percentile(latencies, 50),
+                    percentile(latencies, 99), len(errors)))
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    main()
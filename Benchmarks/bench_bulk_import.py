@@ -0,0 +1,54 @@
+#!/usr/bin/python
+"""Measures how long a running deployment takes to import and export a large catalog through the bulk endpoints of
+the Inventory service. The goods are generated with names unique to the run, so runs do not interfere with each other.
+
+    python bench_bulk_import.py --goods 1000000
+"""
+import argparse
+import csv
+import io
+import time
+import uuid
+import requests
+
+CATEGORIES = ("food", "clothes", "accessories", "electronics")
+
+def catalog(goods, run_id):
+    """Generates the csv file of the catalog, a few thousand lines at a time
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(("name", "category", "price", "description", "count"))
+    for i in range(goods):
+        writer.writerow(("bench-{}-{}".format(run_id, i), CATEGORIES[i % 4], (i % 10000) / 100,
+                         "Benchmark good number {}".format(i), i % 50))
+        if i % 5000 == 4999:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inventory", default="http://172.17.0.4:7000")
+    parser.add_argument("--goods", type=int, default=1000000)
+    options = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    start = time.perf_counter()
+    summary = requests.post(options.inventory + "/api/import/goods", params={"format": "csv"},
+                            data=catalog(options.goods, run_id)).json()
+    elapsed = time.perf_counter() - start
+    print("import: {} read, {} inserted, {} invalid in {:.1f}s, {:.0f} goods/s".format(
+        summary["read"], summary["inserted"], summary["invalid"], elapsed, summary["read"] / elapsed))
+
+    for format in ("csv", "ndjson"):
+        start = time.perf_counter()
+        size = 0
+        with requests.get(options.inventory + "/api/export/goods", params={"format": format}, stream=True) as response:
+            for chunk in response.iter_content(chunk_size=None):
+                size += len(chunk)
+        print("export {:<6}: {:.1f}MB in {:.1f}s".format(format, size / 1e6, time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""Measures the latency of the filtered goods listings of the Database service (goods.by_price,
+goods.by_category_price and their _desc variants) on growing catalogs, for the first page and for a page deep into
+the listing reached through its cursor, and shows the query plan of each listing. The database is generated in a
+temporary directory, the service code is loaded from ../Database.
+
+    python bench_filter.py --goods 10000 100000 1000000 --listings 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from measure import percentile
+
+CATEGORIES = ("food", "clothes", "accessories", "electronics")
+
+def listing(options):
+    """Returns the arguments of a listing of a random category and price band
+    """
+    low = random.uniform(0, 900)
+    return [random.choice(CATEGORIES), low, low + 100, 1, None, options.limit]
+
+def timed(conn, sql, options, depth):
+    """Runs a listing once for each sample, after reading depth pages of it, and returns the latencies of the last
+    page in milliseconds
+    """
+    samples = []
+    for _ in range(options.listings):
+        args = listing(options)
+        for _ in range(depth):
+            rows = conn.execute(sql, args).fetchall()
+            if len(rows) < options.limit:
+                break
+            args[1], args[4] = rows[-1][3], rows[-1][1]
+        start = time.perf_counter()
+        conn.execute(sql, args).fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--goods", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--listings", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=20)
+    options = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    generated = 0
+    for goods in options.goods:
+        with database.connect(database.DATABASE) as conn:
+            conn.executemany("INSERT INTO goods (name, category, price, description, count) VALUES (?, ?, ?, ?, ?)",
+                             (("good{}".format(i), random.choice(CATEGORIES), round(random.uniform(0, 1000), 2),
+                               "Good number {}".format(i), random.randrange(5)) for i in range(generated, goods)))
+            conn.execute("ANALYZE")
+        generated = goods
+        with database.pool.connection() as conn:
+            for op in ("goods.by_price", "goods.by_category_price"):
+                sql = database.OPERATIONS[op].sql
+                if goods == options.goods[0]:
+                    plan = conn.execute("EXPLAIN QUERY PLAN " + sql, listing(options)).fetchall()
+                    print("{:<26} {}".format(op, "; ".join(row[3] for row in plan)))
+                for depth in (0, options.depth):
+                    samples = timed(conn, sql, options, depth)
+                    print("{:>8} goods  {:<24} page {:>3}  p50 {:8.3f}ms  p99 {:8.3f}ms".format(
+                        goods, op, depth + 1, percentile(samples, 50), percentile(samples, 99)))
+
+if __name__ == "__main__":
+    main()
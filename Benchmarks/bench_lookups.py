@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""Measures the latency of the user.by_username and history.by_user operations of the Database service on a large
+database. The database is generated in a temporary directory, the service code is loaded from ../Database.
+
+    python bench_lookups.py --users 1000000 --history 10000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from measure import percentile
+
+def populate(conn, users, history, items):
+    """Fills the users and history tables with generated rows
+    """
+    conn.executemany("INSERT INTO users (fullname, username, password, age, address, gender, marital_status, wallet) "
+                     "VALUES (?, ?, 'pw', '30', 'Beirut', 'male', 'single', 100)",
+                     (("User {}".format(i), "user{}".format(i)) for i in range(users)))
+    conn.executemany("INSERT INTO history (name, item, amount) VALUES (?, ?, ?)",
+                     (("user{}".format(random.randrange(users)), "item{}".format(random.randrange(items)), 1)
+                      for _ in range(history)))
+    conn.commit()
+
+def run(pool, op, args, lookups):
+    """Runs an operation on random arguments and returns its latencies in milliseconds
+    """
+    samples = []
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        for _ in range(lookups):
+            start = time.perf_counter()
+            op.run(cur, args())
+            samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--history", type=int, default=10000000)
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    options = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    start = time.perf_counter()
+    conn = database.connect(database.DATABASE)
+    populate(conn, options.users, options.history, options.items)
+    conn.close()
+    print("populated {} users and {} history rows in {:.1f}s".format(options.users, options.history,
+                                                                     time.perf_counter() - start))
+    username = lambda: ("user{}".format(random.randrange(options.users)),)
+    for name in ("user.by_username", "history.by_user"):
+        samples = run(database.pool, database.OPERATIONS[name], username, options.lookups)
+        print("{:<18} p50 {:.3f}ms  p99 {:.3f}ms  max {:.3f}ms".format(
+            name, percentile(samples, 50), percentile(samples, 99), max(samples)))
+
+if __name__ == "__main__":
+    main()
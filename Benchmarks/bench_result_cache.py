@@ -0,0 +1,60 @@
+#!/usr/bin/python
+"""Measures the latency of goods.by_name and goods.list_prices requests to the /api/get endpoint of the Database
+service with and without the result cache, with a write to the goods table every --write-every requests. The requests
+go through the Flask test client, the database is generated in a temporary directory and the service code is loaded
+from ../Database.
+
+    python bench_result_cache.py --goods 10000 --requests 20000 --write-every 100
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from measure import percentile
+
+def run(client, query, requests, write_every):
+    """Sends read requests and returns their latencies in milliseconds
+    """
+    samples = []
+    for i in range(requests):
+        if write_every and i % write_every == 0:
+            client.put('/api/put', json={"op": "goods.update", "args": ["good0", "food", random.randrange(100),
+                                                                        "Good 0", 10, "good0"]})
+        body = query()
+        start = time.perf_counter()
+        client.get('/api/get', json=body)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--goods", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--hot", type=int, default=100, help="number of distinct goods looked up")
+    parser.add_argument("--write-every", type=int, default=100)
+    options = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    with database.connect(database.DATABASE) as conn:
+        conn.executemany("INSERT INTO goods (name, category, price, description, count) VALUES (?, 'food', ?, ?, 10)",
+                         (("good{}".format(i), i % 100, "Good {}".format(i)) for i in range(options.goods)))
+    client = database.app.test_client()
+    queries = {"goods.by_name": lambda: {"op": "goods.by_name", "args": ["good{}".format(random.randrange(options.hot))]},
+               "goods.list_prices": lambda: {"op": "goods.list_prices"}}
+    max_bytes = database.result_cache.max_bytes
+    for cache in ("off", "on"):
+        database.result_cache.max_bytes = max_bytes if cache == "on" else 0
+        for name, query in queries.items():
+            requests = options.requests if name == "goods.by_name" else max(1, options.requests // 100)
+            samples = run(client, query, requests, options.write_every)
+            print("{:<18} cache {:<3}  p50 {:.3f}ms  p99 {:.3f}ms  max {:.3f}ms".format(
+                name, cache, percentile(samples, 50), percentile(samples, 99), max(samples)))
+    print(database.result_cache.stats())
+
+if __name__ == "__main__":
+    main()
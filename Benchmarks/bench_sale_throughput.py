@@ -0,0 +1,151 @@
+#!/usr/bin/python
+"""Measures sale throughput of a running deployment of the four services. Run it once per worker setting, restarting
+the containers in between, for example:
+
+    for n in 1 4 16; do
+        # restart the four containers with -e WORKERS=$n
+        python bench_sale_throughput.py --label "$n workers"
+    done
+
+or let it start the four services with gunicorn on this machine, with a fresh database for each worker setting:
+
+    python bench_sale_throughput.py --spawn 1 4 16
+
+Every run registers its own users and good, so runs do not interfere with each other.
+"""
+import argparse
+import concurrent.futures
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import requests
+from measure import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#Directory, module and port of each service, started in this order by --spawn
+SERVICES = (("Database", "database", 5000), ("Customer", "customer", 3000), ("Inventory", "inventory", 7000),
+            ("Sales", "sales", 8000))
+
+def setup(options, run_id):
+    """Registers the buyers, fills their wallets and adds a good with enough stock for the whole run
+    """
+    good = "bench-{}".format(run_id)
+    requests.post(options.inventory + "/api/goods/add", json={"name": good, "category": "food", "price": 1,
+                                                             "description": "benchmark item", "count": 10 ** 9})
+    users = []
+    for i in range(options.users):
+        username = "bench-{}-{}".format(run_id, i)
+        requests.post(options.customer + "/api/users/add", json={
+            "fullname": "Bench User", "username": username, "password": "pw", "age": "30", "address": "Beirut",
+            "gender": "male", "marital_status": "single"})
+        requests.put(options.customer + "/api/users/charge/{}".format(username), json=10 ** 9)
+        users.append(username)
+    return users, good
+
+def wait_listening(port, timeout=30):
+    """Waits until a service accepts connections on a port of this machine
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+def spawn(workers, directory):
+    """Starts the four services with gunicorn on this machine, each with the given number of workers and the database
+    files in directory
+    :return: the gunicorn processes
+    """
+    env = dict(os.environ, WORKERS=str(workers), QUEUE_REPORT_INTERVAL="0",
+               DATABASE_URL="http://127.0.0.1:5000", CUSTOMER_URL="http://127.0.0.1:3000",
+               INVENTORY_URL="http://127.0.0.1:7000")
+    processes = []
+    for service, module, port in SERVICES:
+        path = os.path.join(ROOT, service)
+        command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(path, "gunicorn.conf.py"), "--pythonpath", path,
+                   module + ":app"]
+        processes.append(subprocess.Popen(command, cwd=directory, env=env, stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL))
+        wait_listening(port)
+    return processes
+
+def stop(processes):
+    """Stops the gunicorn processes started by spawn(), letting them finish the requests they are serving
+    """
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+def measure(options):
+    """Runs sales against the services for options.duration seconds and prints the throughput and latencies
+    """
+    users, good = setup(options, uuid.uuid4().hex[:8])
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + options.duration
+    local = threading.local()
+
+    def buyer(n):
+        #One keep-alive session per thread, as a real client would do
+        session = getattr(local, "session", None) or requests.Session()
+        local.session = session
+        done = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = session.post("{}/api/sale/{},{}".format(options.sales, users[(n + done) % len(users)], good),
+                                    json=1)
+            elapsed = time.perf_counter() - start
+            ok = response.status_code == 200 and response.json().get("status") == "Purchase successful"
+            with lock:
+                latencies.append(elapsed)
+                failures[0] += not ok
+            done += 1
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(options.concurrency) as pool:
+        list(pool.map(buyer, range(options.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    print("{} {:.1f} sales/s  p50 {:.1f}ms  p99 {:.1f}ms  {} sales  {} failed".format(
+        options.label, len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        len(latencies), failures[0]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customer", default="http://172.17.0.3:3000")
+    parser.add_argument("--inventory", default="http://172.17.0.4:7000")
+    parser.add_argument("--sales", default="http://172.17.0.5:8000")
+    parser.add_argument("--spawn", type=int, nargs="+", metavar="WORKERS",
+                        help="start the services on this machine once per number of workers instead")
+    parser.add_argument("--users", type=int, default=50, help="distinct buyers")
+    parser.add_argument("--concurrency", type=int, default=64, help="sales in flight at any time")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--label", default="")
+    options = parser.parse_args()
+    if not options.spawn:
+        measure(options)
+        return
+    options.customer, options.inventory, options.sales = ("http://127.0.0.1:3000", "http://127.0.0.1:7000",
+                                                          "http://127.0.0.1:8000")
+    for workers in options.spawn:
+        with tempfile.TemporaryDirectory() as directory:
+            processes = spawn(workers, directory)
+            try:
+                options.label = "{} workers".format(workers)
+                measure(options)
+            finally:
+                stop(processes)
+
+if __name__ == "__main__":
+    main()
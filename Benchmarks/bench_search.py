@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""Compares the latency of the goods.search operation of the Database service, backed by the full-text index, with a
+LIKE scan of the name and the description of every good, for growing catalogs. The goods are described with words
+drawn from a vocabulary with a Zipf distribution, like product text, and the searches pick words of the vocabulary
+at random, so most of them are rare words. The database is generated in a temporary directory, the service code is
+loaded from ../Database.
+
+    python bench_search.py --goods 10000 100000 1000000 --searches 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from measure import percentile
+
+SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ze", "bo", "da", "fe", "gi", "ho", "ju")
+WORDS = sorted({a + b + c + d for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES for d in SYLLABLES[:2]})[:5000]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(WORDS))]
+
+def text(count):
+    """Returns count words of the vocabulary, the first words being the most frequent
+    """
+    return " ".join(random.choices(WORDS, WEIGHTS, k=count))
+
+def timed(conn, sql, args, searches):
+    """Runs a statement once for each search and returns its latencies in milliseconds
+    """
+    samples = []
+    for _ in range(searches):
+        word = random.choice(WORDS)
+        start = time.perf_counter()
+        conn.execute(sql, args(word)).fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--goods", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=20)
+    options = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    search = database.OPERATIONS["goods.search"].sql
+    scan = "SELECT * FROM goods WHERE name LIKE ? OR description LIKE ? LIMIT ?"
+    generated = 0
+    for goods in options.goods:
+        with database.connect(database.DATABASE) as conn:
+            conn.executemany("INSERT INTO goods (name, category, price, description, count) VALUES (?, 'food', 1, ?, 1)",
+                             (("{} {}".format(text(2), i), text(8)) for i in range(generated, goods)))
+        generated = goods
+        with database.pool.connection() as conn:
+            for name, sql, args in (("fts5", search, lambda word: ('"{}"'.format(word), options.limit, 0)),
+                                    ("like", scan, lambda word: ("%{}%".format(word), "%{}%".format(word),
+                                                                 options.limit)),
+                                    ("fts5 deep", search, lambda word: ('"{}"'.format(word), options.limit, 1000))):
+                samples = timed(conn, sql, args, options.searches)
+                print("{:>8} goods  {:<10} p50 {:8.3f}ms  p99 {:8.3f}ms".format(
+                    goods, name, percentile(samples, 50), percentile(samples, 99)))
+
+if __name__ == "__main__":
+    main()
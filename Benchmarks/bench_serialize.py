@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""Compares the ways the Database service can serialize the full user listing: the previous code, which copied every
+column by hand out of sqlite3.Row objects, the generic records() serializer and the compact columnar() format. Each
+one is timed from the query to the encoded json body and the size of the body is reported.
+
+    python bench_serialize.py --users 100000
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+def previous(conn):
+    """Serialization done by api_get before the generic serializer, kept here as the baseline
+    """
+    conn.row_factory = sqlite3.Row
+    res1 = []
+    for i in conn.execute("SELECT * FROM users").fetchall():
+        user = {}
+        user["user_id"] = i["user_id"]
+        user["fullname"] = i["fullname"]
+        user["username"] = i["username"]
+        user["password"] = i["password"]
+        user["age"] = i["age"]
+        user["address"] = i["address"]
+        user["gender"] = i["gender"]
+        user["marital_status"] = i["marital_status"]
+        user["wallet"] = i["wallet"]
+        res1.append(user)
+    conn.row_factory = None
+    return json.dumps(res1, sort_keys=True)
+
+def generic(serializer):
+    """Serialization done by the user.list operation with the given serializer
+    """
+    def run(conn):
+        cur = conn.execute("SELECT * FROM users")
+        return json.dumps(serializer([column[0] for column in cur.description], cur.fetchall()))
+    return run
+
+def measure(run, conn, repeat):
+    """Returns the best time of a few runs in seconds and the size of the body in bytes
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = run(conn)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body.encode())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    with database.connect(database.DATABASE) as conn:
+        conn.executemany("INSERT INTO users (fullname, username, password, age, address, gender, marital_status, wallet) "
+                         "VALUES (?, ?, 'pw', '30', 'Beirut', 'male', 'single', 100)",
+                         (("User {}".format(i), "user{}".format(i)) for i in range(options.users)))
+        conn.commit()
+        baseline = None
+        for name, run in (("previous", previous), ("records", generic(database.records)),
+                          ("columnar", generic(database.columnar))):
+            elapsed, size = measure(run, conn, options.repeat)
+            baseline = baseline or elapsed
+            print("{:<9} {:8.1f}ms  {:6.2f}us/row  {:6.2f}x  {:10d} bytes".format(
+                name, elapsed * 1000, elapsed * 1e6 / options.users, baseline / elapsed, size))
+
+if __name__ == "__main__":
+    main()
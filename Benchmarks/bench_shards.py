@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""Measures the throughput of wallet updates (user.add_wallet) of the Database service for several numbers of shards.
+Each number of shards runs in its own process, with the database generated in a temporary directory and the service
+code loaded from ../Database. The updates are sent to random users through execute_write(), by --threads threads in
+each of --processes forked processes, like the workers of gunicorn, which compete for the write lock of each file.
+
+    python bench_shards.py --shards 1 2 4 8 --processes 8 --threads 8 --updates 40000
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+def run(options):
+    """Fills the users and sends the updates, in the process started for one number of shards
+    """
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    rows = [["User number {}".format(i), "user{}".format(i), "password", "30", "Hamra street, Beirut", "male", "single",
+             0] for i in range(options.users)]
+    database.execute_bulk({"op": "user.import", "rows": rows})
+    per_thread = options.updates // (options.processes * options.threads)
+
+    def send():
+        for _ in range(per_thread):
+            result, status = database.execute_write({"op": "user.add_wallet",
+                                                     "args": [1, "user{}".format(random.randrange(options.users))]})
+            assert status == 200, result
+
+    def worker():
+        threads = [threading.Thread(target=send) for _ in range(options.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    processes = [multiprocessing.get_context("fork").Process(target=worker) for _ in range(options.processes)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    updates = per_thread * options.threads * options.processes
+    print("{:>2} shards  {:>6} updates in {:.2f}s  {:>8.0f} updates/s".format(database.shards.count, updates, elapsed,
+                                                                            updates / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--updates", type=int, default=40000)
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.run:
+        return run(options)
+    for shards in options.shards:
+        #The number of shards is read when the service module is loaded, so each one needs a fresh process
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--run", "--processes", str(options.processes),
+                        "--threads", str(options.threads), "--users", str(options.users),
+                        "--updates", str(options.updates)],
+                       env=dict(os.environ, SHARDS=str(shards)), stdout=None, check=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""Measures how long a snapshot of the Database service takes and the latency it adds to the /api/get requests and the
+writes running during the copy, for several page steps. The requests go through the Flask test client from reader and
+writer threads, the database is generated in a temporary directory and the service code is loaded from ../Database.
+
+    python bench_snapshot.py --goods 200000 --pages 64 256 1024 --sleep 0.005
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from measure import percentile
+
+def traffic(database, goods, stop, reads, writes):
+    """Sends reads and, one time in ten, writes until stop is set, and appends their latencies in milliseconds
+    """
+    client = database.app.test_client()
+    while not stop.is_set():
+        name = "good{}".format(random.randrange(goods))
+        start = time.perf_counter()
+        if random.randrange(10):
+            client.get('/api/get', json={"op": "goods.by_name", "args": [name]})
+            reads.append((time.perf_counter() - start) * 1000)
+        else:
+            client.put('/api/put', json={"op": "goods.update", "args": [name, "food", random.randrange(100), "A good",
+                                                                         10, name]})
+            writes.append((time.perf_counter() - start) * 1000)
+
+def measure(database, goods, threads, during):
+    """Runs the traffic while during() runs, or for one second if during is None, and returns the latencies
+    """
+    stop = threading.Event()
+    reads, writes = [], []
+    workers = [threading.Thread(target=traffic, args=(database, goods, stop, reads, writes)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    result = during() if during else time.sleep(1)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return result, reads, writes
+
+def report(label, reads, writes):
+    print("{:<24} reads p50 {:.3f}ms p99 {:.3f}ms  writes p50 {:.3f}ms p99 {:.3f}ms".format(
+        label, percentile(reads, 50), percentile(reads, 99), percentile(writes, 50), percentile(writes, 99)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--goods", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--pages", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--sleep", type=float, default=0.005)
+    options = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    with database.connect(database.DATABASE) as conn:
+        conn.executemany("INSERT INTO goods (name, category, price, description, count) VALUES (?, 'food', ?, ?, 10)",
+                         (("good{}".format(i), i % 100, "Good number {}".format(i)) for i in range(options.goods)))
+    _, reads, writes = measure(database, options.goods, options.threads, None)
+    report("no snapshot", reads, writes)
+    for pages in options.pages:
+        snapshots = database.Snapshots(database.DATABASE, pages=pages, sleep=options.sleep)
+        snapshot, reads, writes = measure(database, options.goods, options.threads, snapshots.take)
+        report("snapshot {} pages".format(pages), reads, writes)
+        print("{:<24} {} pages in {} steps, copy {:.2f}s, total {:.2f}s, {:.1f}MB compressed".format(
+            "", snapshot["pages"], snapshot["steps"], snapshot["copy_seconds"], snapshot["seconds"],
+            snapshot["bytes"] / 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""Compares the payload size and the encode and decode time of json and MessagePack for the results of get_users
+(user.list) and get_prices (goods.list_prices), in the records and the columnar formats. The database is generated in
+a temporary directory, the service code is loaded from ../Database. Needs msgpack installed.
+
+    python bench_wire_format.py --rows 10000 100000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import msgpack
+
+def best(function, repeat):
+    """Returns the fastest of several runs of a function, in milliseconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+def populate(conn, rows):
+    """Fills the users and goods tables with generated rows
+    """
+    conn.execute("DELETE FROM users")
+    conn.execute("DELETE FROM goods")
+    conn.executemany("INSERT INTO users (fullname, username, password, age, address, gender, marital_status, wallet) "
+                     "VALUES (?, ?, 'password', '30', 'Hamra street, Beirut', 'male', 'single', ?)",
+                     (("User number {}".format(i), "user{}".format(i), i % 1000) for i in range(rows)))
+    conn.executemany("INSERT INTO goods (name, category, price, description, count) VALUES (?, 'food', ?, 'A good', 10)",
+                     (("good{}".format(i), (i % 1000) / 4) for i in range(rows)))
+    conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Database"))
+    import database
+
+    for rows in options.rows:
+        with database.connect(database.DATABASE) as conn:
+            populate(conn, rows)
+        with database.pool.connection() as conn:
+            for name in ("user.list", "goods.list_prices"):
+                for format in ("records", "columnar"):
+                    result = database.OPERATIONS[name].run(conn.cursor(), (), format)
+                    for mimetype, decode in ((database.JSON, json.loads), (database.MSGPACK, msgpack.unpackb)):
+                        body = database.encode(result, mimetype)
+                        print("{:>7} rows {:<18} {:<9} {:<19} {:>10} bytes  encode {:8.2f}ms  decode {:8.2f}ms".format(
+                            rows, name, format, mimetype, len(body),
+                            best(lambda: database.encode(result, mimetype), options.repeat),
+                            best(lambda: decode(body), options.repeat)))
+
+if __name__ == "__main__":
+    main()
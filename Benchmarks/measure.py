@@ -0,0 +1,8 @@
+"""Helpers shared by the benchmarks
+"""
+
+def percentile(samples, p):
+    """Returns the p-th percentile of a list of samples
+    """
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
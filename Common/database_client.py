@@ -0,0 +1,219 @@
+"""Writes, batches, bulk imports and exports sent to the Database service, shared by the Customer and Inventory
+services
+"""
+import csv
+import io
+import json
+import os
+import requests
+from serving import ACCEPT, decode, respond
+
+#Address of the Database service, by default the one it has on the docker network
+DATABASE_URL = os.environ.get('DATABASE_URL', 'http://172.17.0.2:5000')
+#Rows of a bulk import are sent to the database IMPORT_CHUNK_SIZE at a time, each chunk in one transaction. The first
+#IMPORT_MAX_ERRORS invalid rows are reported with the reason, the others are only counted.
+IMPORT_CHUNK_SIZE = 10000
+IMPORT_MAX_ERRORS = 100
+#Bytes of csv an export gathers before sending them
+EXPORT_BUFFER_SIZE = 64 * 1024
+FORMATS = ("csv", "ndjson")
+MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class ImportFailed(Exception):
+    pass
+
+
+class DatabaseError(Exception):
+    """Raised when the database cannot be reached or answers a write with an error
+    :param message: the error given by the database
+    :type message: string
+    :param status: the http status of the answer of the database, 503 if it cannot be reached
+    :type status: int
+    """
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def write(method, path, query):
+    """Sends a write to the database and decodes its answer
+    :param method: http method of the request
+    :type method: string
+    :param path: path of the api of the database, like /api/post
+    :type path: string
+    :param query: the body of the request
+    :type query: dictionary
+    :raises DatabaseError: if the database cannot be reached or answers with an error, with the status it answered
+    :return: the decoded answer
+    """
+    try:
+        response = requests.request(method, DATABASE_URL + path, json=query, headers=ACCEPT)
+    except requests.RequestException as e:
+        raise DatabaseError("The database cannot be reached: {}".format(e), 503)
+    #The status is read before the body, which is an error message and not the result when the write failed
+    if not response.ok:
+        try:
+            error = decode(response).get("error")
+        except (ValueError, AttributeError):
+            error = None
+        raise DatabaseError(error or "The database answered {}".format(response.status_code), response.status_code)
+    return decode(response)
+
+
+def failed(error, result):
+    """Answers a request whose write failed in the database with the status the database answered
+    :param error: the error of the write
+    :type error: DatabaseError
+    :param result: what the request answers when it fails, its message gets the error of the database
+    :return: the response and its http status
+    """
+    message = result[0] if isinstance(result, tuple) else result
+    message["error"] = str(error)
+    return respond(result), error.status
+
+
+def batch(*ops, idempotency_key=None):
+    """Runs operations on the database in a single round-trip and a single transaction
+    :param ops: (name of the operation, arguments) pairs, run in order
+    :type ops: tuples
+    :param idempotency_key: key of a batch that writes, sent again with the same key it is not run again and gets the
+        results of the first one
+    :type idempotency_key: string
+    :raises DatabaseError: if the database cannot be reached or fails to run the batch
+    :return: the result of each operation
+    :rtype: list
+    """
+    query = {"ops": [{"op": op, "args": args} for op, args in ops]}
+    if idempotency_key is not None:
+        query["idempotency_key"] = idempotency_key
+    return write('POST', '/api/batch', query)["results"]
+
+
+def import_format(filename=None, mimetype=None):
+    """Guesses the format of a bulk import from the name of its file or the content type of its request
+    :rtype: string
+    """
+    if (filename or "").endswith((".ndjson", ".jsonl")) or mimetype in ("application/x-ndjson", "application/json"):
+        return "ndjson"
+    return "csv"
+
+
+def read_rows(lines, format):
+    """Parses the rows of a bulk import one line at a time
+    :param lines: lines of text of the file
+    :type lines: iterable of strings
+    :param format: "csv", with a header line naming the columns, or "ndjson", one json object per line
+    :type format: string
+    :return: (line number, row) pairs, the row is a dictionary, or None for a line that is not valid json
+    :rtype: generator
+    """
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else None
+
+
+def column(row, field):
+    """Returns a column of a row of a bulk import, which must hold text or a number, the values SQLite stores
+    :param row: the columns of the row
+    :type row: dictionary
+    :param field: name of the column
+    :type field: string
+    :raises ValueError: if the column is missing or holds another value, like a json object or list
+    :rtype: string, int or float
+    """
+    value = row.get(field)
+    if value is None:
+        raise ValueError("Missing {}".format(field))
+    if not isinstance(value, (str, int, float)):
+        raise ValueError("{} must be text or a number".format(field.capitalize()))
+    return value
+
+
+def bulk_import(rows, op, parse):
+    """Checks the rows of a bulk import and writes the valid ones to the database IMPORT_CHUNK_SIZE at a time, each
+    chunk with a single executemany in a single transaction. Rows already in the database are skipped.
+    :param rows: (line number, row) pairs, see read_rows()
+    :type rows: iterable
+    :param op: the bulk write operation of the database
+    :type op: string
+    :param parse: turns a row into the arguments of the operation, raises KeyError, TypeError, AttributeError or
+        ValueError for an invalid row
+    :type parse: function
+    :return: the status of the import, the rows read, inserted, skipped and invalid, and the first IMPORT_MAX_ERRORS
+        invalid lines with the reason
+    :rtype: dictionary
+    """
+    summary = {"status": "Successful import", "read": 0, "inserted": 0, "skipped": 0, "invalid": 0, "errors": []}
+    chunk = []
+
+    def send():
+        result = decode(requests.post(DATABASE_URL + '/api/bulk', json={"op": op, "rows": chunk},
+                                      headers=ACCEPT))
+        if "rowcount" not in result:
+            raise ImportFailed(result.get("error", "The database refused the rows"))
+        summary["inserted"] += result["rowcount"]
+        summary["skipped"] += len(chunk) - result["rowcount"]
+
+    try:
+        for line, row in rows:
+            summary["read"] += 1
+            try:
+                if row is None:
+                    raise ValueError("Line is not a json object")
+                chunk.append(parse(row))
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                summary["invalid"] += 1
+                if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+                    reason = "Missing {}".format(e.args[0]) if isinstance(e, KeyError) else str(e)
+                    summary["errors"].append({"line": line, "error": reason})
+                continue
+            if len(chunk) == IMPORT_CHUNK_SIZE:
+                send()
+                chunk = []
+        if chunk:
+            send()
+    except (ImportFailed, requests.RequestException, ValueError, csv.Error) as e:
+        #The chunks sent before are kept, the summary tells how far the import went
+        summary["status"] = "Import stopped: {}".format(e)
+    return summary
+
+
+def bulk_export(op, fields, format):
+    """Streams every row of a listing operation of the database as csv or newline delimited json, converting the
+    rows as they arrive
+    :param op: the listing operation of the database
+    :type op: string
+    :param fields: the columns written to the csv, in order
+    :type fields: tuple
+    :param format: "csv" or "ndjson"
+    :type format: string
+    :return: chunks of the file
+    :rtype: generator
+    """
+    with requests.get(DATABASE_URL + '/api/stream', json={"op": op}, headers=ACCEPT, stream=True) as response:
+        if format == "ndjson":
+            for chunk in response.iter_content(chunk_size=None):
+                yield chunk
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for line in response.iter_lines():
+            if line:
+                row = json.loads(line)
+                writer.writerow([row[field] for field in fields])
+                if buffer.tell() >= EXPORT_BUFFER_SIZE:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+        yield buffer.getvalue()
@@ -0,0 +1,178 @@
+"""Encoding, decoding and compression of the requests and responses of the services, shared by all four of them. The
+Dockerfile of each service copies this directory next to the service, and the services find it in ../Common when they
+run from the repository.
+"""
+import json
+import os
+import zlib
+import requests
+from flask import current_app, request, Response
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#Other services are asked for MessagePack when msgpack is installed, and answered in it when they ask for it.
+#Everything else, like browsers and external clients, gets json.
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+#Compressed answers are asked for in the encodings requests can decode, which it does transparently.
+ACCEPT = {"Accept-Encoding": requests.utils.DEFAULT_ACCEPT_ENCODING}
+if msgpack is not None:
+    ACCEPT["Accept"] = MSGPACK + ", application/json;q=0.5"
+#Responses are compressed when they are streamed or at least COMPRESS_MIN_SIZE bytes long, in the best of the
+#ENCODINGS the caller accepts. COMPRESS_LEVEL is the level of gzip and deflate, zstd and brotli use fast levels.
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESS_CHUNK_SIZE = 64 * 1024
+ENCODINGS = tuple(encoding for encoding, module in
+                  (("zstd", zstandard), ("br", brotli), ("gzip", zlib), ("deflate", zlib)) if module is not None)
+
+
+def decode(response):
+    """Decodes the body of a response from another service, MessagePack or json depending on its content type
+    :param response: response to a request sent with the ACCEPT headers
+    :type response: requests.Response
+    :return: the decoded body
+    """
+    if msgpack is not None and response.headers.get('Content-Type', '').startswith(MSGPACK):
+        return msgpack.unpackb(response.content)
+    return response.json()
+
+
+def response_mimetype():
+    """Returns the format to answer the current request in: MessagePack if the caller accepts it and msgpack is
+    installed, json otherwise. Callers that send no Accept header, or accept anything, get json.
+    :rtype: string
+    """
+    if msgpack is not None and request.accept_mimetypes.best_match((JSON, MSGPACK)) == MSGPACK:
+        return MSGPACK
+    return JSON
+
+
+def encode(result, mimetype=JSON, sort_keys=False):
+    """Encodes a result in MessagePack, or in compact json ending with a newline like jsonify() does
+    :param result: the result to encode
+    :param mimetype: MSGPACK or JSON
+    :type mimetype: string
+    :param sort_keys: True to sort the keys of the json
+    :type sort_keys: bool
+    :rtype: bytes or string
+    """
+    if mimetype == MSGPACK:
+        return msgpack.packb(result)
+    return json.dumps(result, separators=(",", ":"), sort_keys=sort_keys) + "\n"
+
+
+def respond(result, status=200):
+    """Builds the response carrying a result, in the format the caller asked for, see response_mimetype(). The keys of
+    the json are sorted when the json settings of the app say so, like with jsonify().
+    :param result: the result to send
+    :param status: http status of the response
+    :type status: int
+    :rtype: flask.Response
+    """
+    mimetype = response_mimetype()
+    return Response(encode(result, mimetype, current_app.json.sort_keys), status, mimetype=mimetype)
+
+
+class Compressor:
+    """Compresses a body piece by piece in one of the ENCODINGS
+    :param encoding: name of the encoding, as sent in the Content-Encoding header
+    :type encoding: string
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=4)
+        else:
+            self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+
+    def compress(self, data):
+        """Returns the compressed bytes of data that are ready, the compressor may hold back the rest
+        :rtype: bytes
+        """
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """Returns everything held back, so the caller can decode all the data given so far
+        :rtype: bytes
+        """
+        if self.encoding == "br":
+            return self._compressor.flush()
+        if self.encoding == "zstd":
+            return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """Returns the end of the compressed body
+        :rtype: bytes
+        """
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compressed(chunks, encoding, streamed):
+    """Compresses the chunks of a body as they are produced. The chunks of a streamed body are flushed one by one, so
+    each of them reaches the caller without waiting for the next.
+    :param chunks: the chunks of the body
+    :type chunks: iterable of bytes or strings
+    :param encoding: one of the ENCODINGS
+    :type encoding: string
+    :param streamed: True for a body whose chunks are produced over time
+    :type streamed: bool
+    :return: the compressed body
+    :rtype: generator
+    """
+    compressor = Compressor(encoding)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if streamed:
+                data += compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        #Closing the body releases what produces it, like the database connection of a stream
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress(response):
+    """Compresses the response in the best encoding the caller accepts when it is streamed or at least
+    COMPRESS_MIN_SIZE bytes long. Other responses, and callers accepting none of the ENCODINGS, are left as they are.
+    Services register it with app.after_request(compress).
+    :param response: the response of the request
+    :type response: flask.Response
+    :rtype: flask.Response
+    """
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if (encoding is None or response.direct_passthrough or "Content-Encoding" in response.headers
+            or response.status_code in (204, 304)):
+        return response
+    if response.is_streamed:
+        response.response = compressed(response.response, encoding, True)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        chunks = (body[i:i + COMPRESS_CHUNK_SIZE] for i in range(0, len(body), COMPRESS_CHUNK_SIZE))
+        response.response = compressed(chunks, encoding, False)
+    response.headers["Content-Encoding"] = encoding
+    response.headers.pop("Content-Length", None)
+    response.vary.add("Accept-Encoding")
+    return response
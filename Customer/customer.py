@@ -1,10 +1,27 @@
 #!/usr/bin/python 
+import argparse
+import codecs
+import json
+import math
+import os
+import sys
 import requests
-from flask import Flask,request,jsonify
+from flask import Flask,request,Response
 from flask_cors import CORS
+#The modules shared by the services are copied next to this one in the image, and are in ../Common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Common"))
+from serving import ACCEPT, compress, decode, respond
+from database_client import (DATABASE_URL, FORMATS, MIMETYPES, DatabaseError, batch, bulk_export, bulk_import,
+                             column, failed, import_format, read_rows, write)
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+app.after_request(compress)
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+#Listings may be served by a read replica of the database up to this many seconds old
+LISTING_MAX_STALENESS = 5
 
 class InsufficientAmount(Exception):
     pass
@@ -12,34 +29,44 @@ class InsufficientAmount(Exception):
 class UserAlreadyTaken(Exception):
     pass
 
+class UserNotFound(Exception):
+    pass
+
+#Columns of a users import or export, the wallet can be left out of an import and is 0 then
+USER_FIELDS = ("fullname", "username", "password", "age", "address", "gender", "marital_status", "wallet")
+
 def register(user):
     """Registers the user in the database, checks if the username is already in use, and creates a wallet for the user 
     initialized to 0$
     :param user: contains all information about the customer
     :type user: dictionary
     :raises UserAlreadyTaken: if the user's username is already in the database, it doesn't allow him to register
+    :raises DatabaseError: if the database fails to insert the user for another reason
     :return: A message confirming registration status and the infromation of the registered user
     :rtype: Both are dictionaries
     """
     registered_user = {}
     message ={}
     try:
-        if get_user_by_username(user['username']) != {}:
-            raise UserAlreadyTaken("Username already taken")
-        query = {"1":"INSERT INTO users (fullname, username, password, age, address, gender, marital_status, wallet) VALUES (?, ?, ?, ?, ?, ?, ?, 0)"
-                , "2":(user['fullname'], user['username'], user['password'], user['age'], user['address'], user['gender'], user['marital_status']) }
-        requests.post('http://172.17.0.2:5000/api/post', json=query)
+        query = {"op":"user.insert",
+                 "args":(user['fullname'], user['username'], user['password'], user['age'], user['address'], user['gender'], user['marital_status']) }
+        try:
+            write('POST', '/api/post', query)
+        except DatabaseError as e:
+            if e.status == 409:
+                raise UserAlreadyTaken("Username already taken")
+            raise
         message["status"] = "Successful Registration"
         registered_user = user
     except UserAlreadyTaken as e:
         message["status"] = "Username already taken"
-    finally:
-        return message,registered_user
+    return message,registered_user
 
 def delete(username):
     """Deletes the user, if found, from the database
     :param username: the username of the user to be deleted
     :type user: string
+    :raises DatabaseError: if the database fails to delete the user
     :return: A message confirming deletion status
     :rtype: Dictionary
     """
@@ -48,56 +75,88 @@ def delete(username):
     if user == {}:
         message["status"] = "User not found"
         return message
-    try: 
-        query={"1":"DELETE from users WHERE username = ?", 
-               "2":(username,)}
-        requests.delete('http://172.17.0.2:5000/api/delete', json=query)
-        message["status"] = "User deleted successfully" 
-    except: 
-        message["status"] = "Cannot delete user" 
-    finally: 
-        return message
+    query={"op":"user.delete",
+           "args":(username,)}
+    write('DELETE', '/api/delete', query)
+    message["status"] = "User deleted successfully" 
+    return message
 
 def update_user(user):
     """Updates the user in the database having the same username as the user passed as a parameter. It check if the 
     user is found in the database. The wallet can't be updated using this function.
     :param user: contains all information about the updated customer
     :type user: dictionary
+    :raises DatabaseError: if the database fails to update the user
     :return: The information of the updated user if update is complete, a message if update fails
     :rtype: Both are dictionaries
     """
     username = user["username"]
     message = {}
     updated_user = {} 
-    l = get_user_by_username(username)
-    if l == {}:
-        message["status"] = 'User not found'
-        return message,updated_user
     try:
-        query = {"1":"UPDATE users SET fullname = ?, username = ?, password= ?, age= ?, address= ?, gender= ?, marital_status= ? WHERE username =?", 
-                 "2": (user["fullname"], user["username"], user["password"], user["age"], user["address"],user["gender"],user["marital_status"], user["username"],)}
-        requests.put('http://172.17.0.2:5000/api/put', json=query)
+        updated, updated_user = batch(("user.update", (user["fullname"], user["username"], user["password"], user["age"], user["address"],user["gender"],user["marital_status"], username,)),
+                                      ("user.by_username", (username,)))
+        if updated["rowcount"] == 0:
+            raise UserNotFound("User not found")
         message["status"] = "Succefully updated customer"
-        updated_user = get_user_by_username(user["username"])
+    except UserNotFound:
+        message["status"] = 'User not found'
+        updated_user = {}
+    except DatabaseError:
+        raise
     except:
          message["status"] = "Unsuccessful update"
          updated_user = {} 
-    finally: 
-        return message,updated_user
+    return message,updated_user
 
-def get_users():
+def get_users(columnar=False):
     """Get all users from the database
+    :param columnar: True to get the users in the compact format {"columns": [names], "rows": [[values], ...]}
+    :type columnar: bool
     :return: list containing information of all users
     :rtype: List of dictionaries
     """
     users = []
     try:
-        query = {"1":"SELECT * FROM users"}
-        users = requests.get('http://172.17.0.2:5000/api/get', json=query).json()
+        query = {"op":"user.list", "max_staleness":LISTING_MAX_STALENESS}
+        if columnar:
+            query["format"] = "columnar"
+        users = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
     except:
         users = []
     return users
 
+def get_users_page(after, limit):
+    """Get one page of users ordered by user_id. The page starts after a user_id instead of at an offset, so every
+    page costs the same to read however deep into the table it is.
+    :param after: user_id of the last user of the previous page, 0 for the first page
+    :type after: int
+    :param limit: maximum number of users in the page
+    :type limit: int
+    :return: the users of the page and the user_id to ask the next page after, None on the last page
+    :rtype: Dictionary
+    """
+    page = {"users": [], "next_after": None}
+    try:
+        query = {"op":"user.page", "max_staleness":LISTING_MAX_STALENESS,
+                 "args":(after, limit)}
+        result = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
+        page = {"users": result["rows"], "next_after": result["next_after"]}
+    except:
+        page = {"users": [], "next_after": None}
+    return page
+
+def stream_users():
+    """Streams all users from the database as newline delimited json, passing the rows on as they arrive instead of
+    loading the whole list in memory
+    :return: chunks of newline delimited json
+    :rtype: generator
+    """
+    query = {"op":"user.list", "max_staleness":LISTING_MAX_STALENESS}
+    with requests.get(DATABASE_URL + '/api/stream', json=query, headers=ACCEPT, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=None):
+            yield chunk
+
 def get_user_by_username(username): 
     """Gets information of a specific user through his username
     :param username: The username of the wanted customer
@@ -107,82 +166,157 @@ def get_user_by_username(username):
     """
     user = {}
     try:
-        query = {"1":"SELECT * FROM users WHERE username = ?",
-                "2":(username,)}
-        user = requests.get('http://172.17.0.2:5000/api/get', json=query).json()
+        query = {"op":"user.by_username",
+                "args":(username,)}
+        user = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
     except:
         user = {}
     return user
 
-def charge(username,amount):
+def charge(username,amount,key=None):
     """Increasing the wallet of the user by a number (amount)
     :param username: the username of the user whose wallet is to be modified
     :type username: string
     :param amount: amount we want to add to the wallet
     :type amount: float
+    :param key: idempotency key of the request, a request sent again with the same key does not charge again and gets
+        the answer of the first one
+    :type key: string
     :raises TypeError: if the amount given is not in integers nor float, it raises the error
+    :raises UserNotFound: if no user has this username, the error is raised
+    :raises DatabaseError: if the database fails to charge the wallet
     :return: A message confirming the status of charging and the updated user
     :rtype: Both are dictionaries
     """
     message = {}
-    user = get_user_by_username(username)
     message["status"] = "Successfully charged!"
     updated_user = {} 
     try:
         if type(amount)!= float and type(amount)!= int:
             raise TypeError
-        query= {"1":"UPDATE users SET  wallet= ? WHERE username =?", 
-                "2": (user["wallet"]+amount, user["username"],) }
-        requests.put('http://172.17.0.2:5000/api/put', json=query)
-        updated_user = get_user_by_username(user["username"]) 
+        charged, updated_user = batch(("user.add_wallet", (amount, username)),
+                                      ("user.by_username", (username,)),
+                                      idempotency_key=None if key is None else "users.charge:" + key)
+        if charged["rowcount"] == 0:
+            raise UserNotFound("User not found")
+    except UserNotFound:
+         message["status"] = 'User not found'
+         updated_user = {} 
+    except DatabaseError:
+        raise
     except:
          message["status"] = "Amount should be a number" 
          updated_user = {} 
-    finally: 
-        return message,updated_user
+    return message,updated_user
 
     
-def deduce_wallet(username,amount):
+def deduce_wallet(username,amount,key=None):
     """Decreasing the wallet of the user by a number (amount)
     :param username: the username of the user whose wallet is to be modified
     :type username: string
     :param amount: amount we want to reduce from the wallet
     :type amount: float
+    :param key: idempotency key of the request, a request sent again with the same key does not reduce the wallet
+        again and gets the answer of the first one
+    :type key: string
     :raises TypeError: if the amount given is not in integers nor float, it raises the error
+    :raises ValueError: if the amount is not above 0, since a negative one would raise the wallet
     :raises InsufficientAmount: if the user's wallet has less then the amount to be reduced, the error is raised
+    :raises UserNotFound: if no user has this username, the error is raised
+    :raises DatabaseError: if the database fails to reduce the wallet
     :return: A message confirming the status of reducing and the updated user
     :rtype: Both are dictionaries
     """
     message = {}
     message["status"] = "Successfully reduced!"
-    user = get_user_by_username(username)
     updated_user = {} 
     try:
         if type(amount)!= float and type(amount)!= int:
             raise TypeError
-        if user["wallet"] < amount:
+        if not amount > 0:
+            raise ValueError("Amount should be above 0")
+        #The wallet is only reduced if it holds enough, checked and updated in the same statement
+        deduced, updated_user = batch(("user.deduct_wallet", (amount, username, amount, amount)),
+                                      ("user.by_username", (username,)),
+                                      idempotency_key=None if key is None else "users.deduce:" + key)
+        if updated_user == {}:
+            raise UserNotFound("User not found")
+        if deduced["rowcount"] == 0:
             raise InsufficientAmount('Not enough available to spend {}'.format(amount))
-        query = {"1":"UPDATE users SET  wallet= ? WHERE username =?", 
-                 "2":(user["wallet"]-amount, user["username"],)}
-        requests.put('http://172.17.0.2:5000/api/put', json=query)
-        updated_user = get_user_by_username(user["username"]) 
+    except UserNotFound:
+         message["status"] = 'User not found'
+         updated_user = {} 
     except InsufficientAmount:
          message["status"] = 'Not enough available to spend {}'.format(amount)
          updated_user = {} 
+    except ValueError:
+         message["status"] = "Amount should be above 0"
+         updated_user = {} 
+    except DatabaseError:
+        raise
     except:
          message["status"] = "Amount should be a number" 
          updated_user = {} 
-    finally: 
-        return message,updated_user
+    return message,updated_user
+
 
+def parse_user(row):
+    """Turns a row of a users import into the arguments of user.import
+    :param row: the columns of the row
+    :type row: dictionary
+    :raises ValueError: if a column is missing or holds neither text nor a number, the username is empty or the wallet
+        is not a finite number of at least 0
+    :return: the columns of USER_FIELDS
+    :rtype: list
+    """
+    values = [column(row, field) for field in USER_FIELDS[:-1]]
+    if not row["username"]:
+        raise ValueError("Username is empty")
+    #A wallet can hold cents, like the amounts charge() adds to it
+    wallet = float(column(row, "wallet") if row.get("wallet") else 0)
+    if not math.isfinite(wallet) or wallet < 0:
+        raise ValueError("Wallet must be a number of at least 0")
+    values.append(wallet)
+    return values
+
+def import_users(lines, format):
+    """Registers the users of a csv or ndjson file in bulk, see bulk_import(). Users whose username is already taken
+    are skipped.
+    :param lines: lines of text of the file
+    :type lines: iterable of strings
+    :param format: "csv" or "ndjson"
+    :type format: string
+    :return: the summary of the import
+    :rtype: dictionary
+    """
+    return bulk_import(read_rows(lines, format), "user.import", parse_user)
+
+def export_users(format):
+    """Streams every user of the database as csv or ndjson, in a file import_users() can read back
+    :param format: "csv" or "ndjson"
+    :type format: string
+    :return: chunks of the file
+    :rtype: generator
+    """
+    return bulk_export("user.list", USER_FIELDS, format)
 
 @app.route('/api/users', methods=['GET'])
 def api_get_users():
-    """API implementation of get_users()
+    """API implementation of get_users(), ?format=columnar returns them in the compact columnar format. With
+    ?after=<user_id>&limit=N it returns one page of users instead, see get_users_page(), and with ?format=ndjson it
+    streams all users as newline delimited json, see stream_users()
     :return: the information of all users in the database
     :rtype: json object
     """
-    return jsonify(get_users())
+    if request.args.get('format') == 'columnar':
+        return respond(get_users(columnar=True))
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_users(), mimetype='application/x-ndjson')
+    if 'after' in request.args or 'limit' in request.args:
+        after = request.args.get('after', 0, type=int)
+        limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        return respond(get_users_page(after, limit))
+    return respond(get_users())
 
 @app.route('/api/users/<username>', methods=['GET'])
 def api_get_user(username):
@@ -192,7 +326,7 @@ def api_get_user(username):
     :return: the information of the user
     :rtype: json object
     """
-    return jsonify(get_user_by_username(username))
+    return respond(get_user_by_username(username))
 
 @app.route('/api/users/add', methods = ['POST'])
 def api_add_user():
@@ -201,7 +335,10 @@ def api_add_user():
     :rtype: json object
     """
     user = request.get_json()
-    return jsonify(register(user))
+    try:
+        return respond(register(user))
+    except DatabaseError as e:
+        return failed(e, ({"status": "Unsuccessful registration"}, {}))
 
 @app.route('/api/users/update', methods = ['PUT'])
 def api_update_user():
@@ -210,7 +347,10 @@ def api_update_user():
     :rtype: json object
     """
     user = request.get_json()
-    return jsonify(update_user(user))
+    try:
+        return respond(update_user(user))
+    except DatabaseError as e:
+        return failed(e, ({"status": "Unsuccessful update"}, {}))
 
 @app.route('/api/users/delete/<username>', methods = ['DELETE'])
 def api_delete_user(username):
@@ -220,32 +360,79 @@ def api_delete_user(username):
     :return: A message confirming deletion status
     :rtype: json object
     """
-    return jsonify(delete(username))
+    try:
+        return respond(delete(username))
+    except DatabaseError as e:
+        return failed(e, {"status": "Cannot delete user"})
 
 
 @app.route('/api/users/charge/<username>', methods = ['PUT'])
 def api_charge(username):
-    """API implementation of charge()
+    """API implementation of charge(), with the idempotency key of the request in its Idempotency-Key header
     :param username: the username of the user whose wallet we're charging
     :type username: string
     :return: A message confirming the status of charging and the updated user
     :rtype: json object
     """
     amount = request.get_json()
-    return jsonify(charge(username,amount))
+    try:
+        return respond(charge(username,amount,request.headers.get('Idempotency-Key')))
+    except DatabaseError as e:
+        return failed(e, ({"status": "Cannot charge the wallet"}, {}))
 
 @app.route('/api/users/deduce/<username>', methods = ['PUT'])
 def api_reduce(username):
-    """API implementation of deduce_wallet()
+    """API implementation of deduce_wallet(), with the idempotency key of the request in its Idempotency-Key header
     :param username: the username of the user whose wallet we're decreasing
     :type username: string
     :return: A message confirming the status of deducing and the updated user
     :rtype: json object
     """
     amount = request.get_json()
-    return jsonify(deduce_wallet(username,amount))
+    try:
+        return respond(deduce_wallet(username,amount,request.headers.get('Idempotency-Key')))
+    except DatabaseError as e:
+        return failed(e, ({"status": "Cannot reduce the wallet"}, {}))
+
+@app.route('/api/import/users', methods = ['POST'])
+def api_import_users():
+    """API implementation of import_users(). The body is the file, read as it arrives, in the format given by
+    ?format=csv|ndjson or guessed from its content type
+    :return: the summary of the import
+    :rtype: json object
+    """
+    format = request.args.get('format') or import_format(mimetype=request.mimetype)
+    if format not in FORMATS:
+        return respond({"error": "Unknown format {}".format(format)}), 400
+    return respond(import_users(codecs.iterdecode(request.stream, 'utf-8'), format))
+
+@app.route('/api/export/users', methods = ['GET'])
+def api_export_users():
+    """API implementation of export_users(), ?format=csv|ndjson, csv by default
+    :return: every user, streamed
+    :rtype: csv or newline delimited json
+    """
+    format = request.args.get('format', 'csv')
+    if format not in FORMATS:
+        return respond({"error": "Unknown format {}".format(format)}), 400
+    return Response(export_users(format), mimetype=MIMETYPES[format])
 
 if __name__ == "__main__":
-    """Runs the flask app
+    """Runs the flask app, or the bulk command given on the command line
     """
-    app.run(host="0.0.0.0",port=3000) #run app   
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Customer service")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("import", help="register the users of a csv or ndjson file in the database")
+    command.add_argument("file", help="the file to import, - for the standard input")
+    command.add_argument("--format", choices=FORMATS, help="format of the file, guessed from its name by default")
+    command = commands.add_parser("export", help="write every user of the database to the standard output")
+    command.add_argument("--format", choices=FORMATS, default="csv")
+    args = parser.parse_args()
+    if args.command == "import":
+        lines = sys.stdin if args.file == "-" else open(args.file, newline='', encoding='utf-8')
+        print(json.dumps(import_users(lines, args.format or import_format(args.file)), indent=2))
+    elif args.command == "export":
+        for chunk in export_users(args.format):
+            sys.stdout.buffer.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+    else:
+        app.run(host="0.0.0.0",port=3000) #run app   
\ No newline at end of file
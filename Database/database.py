@@ -1,200 +1,2805 @@
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import os
+import queue
+import shutil
 import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from urllib.parse import quote
 import requests
-from flask import Flask,request, jsonify
+from flask import Flask,request, Response
+#The modules shared by the services are copied next to this one in the image, and are in ../Common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Common"))
+from serving import JSON, MSGPACK, compress, encode, respond, response_mimetype
 
 app = Flask(__name__)
+#Responses are read by programs, sorting the keys of every row only costs time
+app.json.sort_keys = False
+app.after_request(compress)
 
+DATABASE = 'database.db'
+POOL_MAX_IDLE = int(os.environ.get('POOL_MAX_IDLE', 32))
+#Settings applied to every connection, picked by name with SQLITE_PROFILE. Each setting can be overridden on its own
+#from the environment, for example SQLITE_MMAP_SIZE=0. busy_timeout is how many seconds a connection waits for another
+#connection, possibly in another worker process, to release the write lock. cache_size is in KiB when negative, and is
+#the page cache of each connection, with mmap_size bytes of the file read through memory mapping on top of it.
+#durable: a commit survives a power loss. balanced: a commit survives the service crashing, the last commits can be
+#lost on a power loss. throughput: nothing is synced, a crash of the machine can corrupt the database.
+SQLITE_PROFILES = {
+    "durable": {"journal_mode": "wal", "synchronous": "full", "cache_size": -8000, "mmap_size": 256 * 1024 * 1024,
+                "temp_store": "default", "busy_timeout": 5.0},
+    "balanced": {"journal_mode": "wal", "synchronous": "normal", "cache_size": -16000, "mmap_size": 256 * 1024 * 1024,
+                 "temp_store": "memory", "busy_timeout": 5.0},
+    "throughput": {"journal_mode": "wal", "synchronous": "off", "cache_size": -64000, "mmap_size": 1024 * 1024 * 1024,
+                   "temp_store": "memory", "busy_timeout": 5.0},
+}
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'durable')
+#Values SQLite accepts for the settings given by name
+SQLITE_CHOICES = {"journal_mode": ("delete", "truncate", "persist", "memory", "wal", "off"),
+                  "synchronous": ("off", "normal", "full", "extra"),
+                  "temp_store": ("default", "file", "memory")}
+STATEMENT_CACHE_SIZE = 256
+STREAM_BATCH_SIZE = 500
+#Statements running for at least SLOW_QUERY_MS milliseconds are logged, 0 logs every statement. The last
+#SLOW_QUERY_LOG_SIZE of them are also kept for /api/stats.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100))
+#A group commit holds at most WRITE_GROUP_SIZE writes, and waits at most WRITE_GROUP_DELAY seconds for more writes to
+#arrive once the first one is taken. With no delay a group is whatever queued up while the previous group committed.
+WRITE_GROUP_SIZE = int(os.environ.get('WRITE_GROUP_SIZE', 64))
+WRITE_GROUP_DELAY = float(os.environ.get('WRITE_GROUP_DELAY', 0))
+#Seconds a request waits for the commit of its write before being answered 503. The write may still be committed
+#later, a request sent again with the same idempotency key does not write twice.
+WRITE_TIMEOUT = float(os.environ.get('WRITE_TIMEOUT', 30))
+#Number of read replica files, 0 serves every read from the database itself. A replica is a copy of the database made
+#with the SQLite backup API every REPLICA_REFRESH_INTERVAL seconds. A read is served by a replica only if the replica
+#is not older than the staleness bound of the read, its max_staleness or REPLICA_MAX_STALENESS by default.
+READ_REPLICAS = int(os.environ.get('READ_REPLICAS', 0))
+REPLICA_REFRESH_INTERVAL = float(os.environ.get('REPLICA_REFRESH_INTERVAL', 5))
+REPLICA_MAX_STALENESS = float(os.environ.get('REPLICA_MAX_STALENESS', 0))
+#Snapshots are copied SNAPSHOT_PAGES pages at a time with a pause of SNAPSHOT_SLEEP seconds between two steps, and the
+#last SNAPSHOT_KEEP of them are kept in SNAPSHOT_DIR. When the database file does not exist at startup, it is restored
+#from RESTORE_SNAPSHOT, the path of a snapshot or "latest" for the newest one in SNAPSHOT_DIR. A snapshot holds one
+#database file, so a database with more than one shard can neither take nor restore them.
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_PAGES = int(os.environ.get('SNAPSHOT_PAGES', 256))
+SNAPSHOT_SLEEP = float(os.environ.get('SNAPSHOT_SLEEP', 0.005))
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', 5))
+RESTORE_SNAPSHOT = os.environ.get('RESTORE_SNAPSHOT')
+#Purchases older than ARCHIVE_AFTER_DAYS days are moved to the ARCHIVE_DATABASE file every ARCHIVE_INTERVAL seconds,
+#0 turns the archival job off, ARCHIVE_BATCH rows per transaction. The changes and the idempotency keys are pruned by
+#their own job every PRUNE_INTERVAL seconds, 0 turns it off.
+ARCHIVE_DATABASE = os.environ.get('ARCHIVE_DATABASE', 'archive.db')
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', 10000))
+PRUNE_INTERVAL = float(os.environ.get('PRUNE_INTERVAL', 600))
+#The users and their purchases are spread over SHARDS database files by a hash of the username, see Shards. Changing
+#the number of shards of a database takes "python database.py reshard N" while the service is stopped.
+SHARDS = int(os.environ.get('SHARDS', 1))
+SHARDED_TABLES = ("users", "history", "history_summary", "history_rollup")
+#Triggers record every change of the CHANGE_TABLES in the changes table of their shard, served by /api/changes. The
+#prune job keeps the last CHANGES_KEEP changes of each shard. A long-poll waits at most CHANGES_MAX_WAIT seconds and
+#looks for new changes every CHANGES_POLL_INTERVAL seconds, an event stream sends a heartbeat every CHANGES_HEARTBEAT.
+CHANGE_TABLES = ("users", "goods", "history")
+CHANGES_KEEP = int(os.environ.get('CHANGES_KEEP', 1000000))
+CHANGES_BATCH = 500
+CHANGES_MAX_WAIT = float(os.environ.get('CHANGES_MAX_WAIT', 25))
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 0.05))
+CHANGES_HEARTBEAT = float(os.environ.get('CHANGES_HEARTBEAT', 15))
+#The result of a write sent with an idempotency key is kept IDEMPOTENCY_TTL seconds, until the prune job removes it,
+#and a write sent again with the same key during that time gets the kept result instead of running again, see
+#idempotent()
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+#Bytes of encoded results each process keeps in its result cache, 0 turns the cache off. A single result larger than
+#an eighth of the cache is never cached, so one big listing cannot push out every lookup.
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 32 * 1024 * 1024))
+#Tables that operations read and write, each one has a change counter in the table versions file
+TABLES = ("users", "goods", "history", "history_summary", "history_rollup", "idempotency")
+EVENT_STREAM = 'text/event-stream'
 
-def create_db_table(): 
-    #Creates the 3 tables user, inventory, and history
-    try: 
-        conn = sqlite3.connect('database.db')
-        conn.execute(''' 
-                     CREATE TABLE users ( 
-                      user_id INTEGER PRIMARY KEY NOT NULL,
-                      fullname TEXT NOT NULL,
-                      username TEXT NOT NULL,
-                      password TEXT NOT NULL,
-                      age TEXT NOT NULL,
-                      address TEXT NOT NULL,
-                      gender TEXT NOT NULL,
-                      marital_status TEXT NOT NULL,
-                      wallet INTEGER NOT NULL DEFAULT 0
-                      ); 
-                    ''')
-        conn.commit() 
-        print("User table created successfully") 
-    except: 
-        print("User table creation failed - Maybe table") 
-
-    try:
-        conn.execute(''' 
-                     CREATE TABLE goods ( 
-                      user_id INTEGER PRIMARY KEY NOT NULL,
-                      name TEXT NOT NULL,
-                      category TEXT NOT NULL,
-                      price FLOAT NOT NULL,
-                      description TEXT NOT NULL,
-                      count INTEGER NOT NULL
-                      ); 
-                    ''')   
-        conn.commit() 
-        print("Goods table created successfully") 
-    except: 
-        print("Goods table creation failed - Maybe table")
-    try:
-        conn.execute(''' 
-                    CREATE TABLE history ( 
-                    user_id INTEGER PRIMARY KEY NOT NULL,
-                    name TEXT NOT NULL,
-                    item TEXT NOT NULL,
-                    amount INTEGER NOT NULL DEFAULT 0
-                    ); 
-                ''')   
-        conn.commit() 
-        print("History table created successfully") 
-    except: 
-        print("History table creation failed - Maybe table") 
-
-    finally: 
-        conn.close()
 
-sqlite3.connect('database.db')
-create_db_table()
+def sqlite_settings(profile=SQLITE_PROFILE, environ=os.environ):
+    """Returns the settings of a profile, with the overrides found in the environment
+    :param profile: name of one of the SQLITE_PROFILES
+    :type profile: string
+    :param environ: the environment, where SQLITE_<SETTING> overrides a setting
+    :type environ: dictionary
+    :raises ValueError: if the profile does not exist or a setting has a value SQLite does not accept
+    :rtype: dictionary
+    """
+    if profile not in SQLITE_PROFILES:
+        raise ValueError("Unknown SQLite profile {}, expected one of {}".format(profile, ", ".join(SQLITE_PROFILES)))
+    settings = dict(SQLITE_PROFILES[profile])
+    for name, value in settings.items():
+        override = environ.get('SQLITE_' + name.upper())
+        if override is not None:
+            settings[name] = type(value)(override.lower() if isinstance(value, str) else override)
+        if name in SQLITE_CHOICES and settings[name] not in SQLITE_CHOICES[name]:
+            raise ValueError("Invalid SQLite {} {}".format(name, settings[name]))
+    return settings
 
-@app.route('/api/get',methods=['GET'])
-def api_get():
-    '''Receives API Get requests from other containers and process them
-    '''
-    res = {}
-    res1 = []
-    query = request.get_json()
-    try:
-        conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
-        if query["1"] == "SELECT * FROM users":
-            cur.execute(query["1"])
-            rows = cur.fetchall()
-            for i in rows:
-                user = {}
-                user["user_id"] = i["user_id"] 
-                user["fullname"] = i["fullname"] 
-                user["username"] = i["username"] 
-                user["password"] = i["password"] 
-                user["age"] = i["age"] 
-                user["address"] = i["address"] 
-                user["gender"] = i["gender"] 
-                user["marital_status"] = i["marital_status"] 
-                user["wallet"] = i["wallet"]
-                res1.append(user)
+SQLITE_SETTINGS = sqlite_settings()
+SQLITE_BUSY_TIMEOUT = SQLITE_SETTINGS["busy_timeout"]
+
+
+def applied_settings(conn):
+    """Reads back the settings SQLite applied to a connection, which can differ from the ones asked for, for example
+    when SQLite was built with a lower limit on mmap_size
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :rtype: dictionary
+    """
+    pragma = lambda name: conn.execute('PRAGMA {}'.format(name)).fetchone()[0]
+    return {"journal_mode": pragma('journal_mode'),
+            "synchronous": SQLITE_CHOICES["synchronous"][pragma('synchronous')],
+            "cache_size": pragma('cache_size'),
+            "mmap_size": pragma('mmap_size'),
+            "temp_store": SQLITE_CHOICES["temp_store"][pragma('temp_store')],
+            "busy_timeout": pragma('busy_timeout') / 1000}
+
+
+def connect(path, readonly=False, immutable=False):
+    """Opens a connection to the database with the settings shared by every connection of the service, see
+    SQLITE_PROFILES. The journal mode and the synchronous setting only matter to connections that write.
+    :param path: path of the SQLite database file
+    :type path: string
+    :param readonly: True to open the file with a mode=ro uri, which SQLite refuses to write through
+    :type readonly: bool
+    :param immutable: True for a read only file that is never modified while open, like a replica, so SQLite skips
+        locking it
+    :type immutable: bool
+    :rtype: sqlite3.Connection
+    """
+    if readonly or immutable:
+        uri = 'file:{}?mode=ro{}'.format(quote(os.path.abspath(path)), '&immutable=1' if immutable else '')
+        conn = sqlite3.connect(uri, uri=True, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute('PRAGMA journal_mode={}'.format(SQLITE_SETTINGS["journal_mode"]))
+        conn.execute('PRAGMA synchronous={}'.format(SQLITE_SETTINGS["synchronous"]))
+    #Reads of a memory mapped database copy pages straight from the page cache of the system instead of making a
+    #system call for each page
+    conn.execute('PRAGMA mmap_size={}'.format(int(SQLITE_SETTINGS["mmap_size"])))
+    conn.execute('PRAGMA cache_size={}'.format(int(SQLITE_SETTINGS["cache_size"])))
+    conn.execute('PRAGMA temp_store={}'.format(SQLITE_SETTINGS["temp_store"]))
+    return conn
+
+
+class ConnectionPool:
+    """Keeps long-lived SQLite connections open between requests so that a request only pays for its query and not
+    for opening the file, parsing the schema and warming a fresh page cache. Connections are handed out one thread at a
+    time and returned to the pool when the request is done. Every connection runs the database in WAL journal mode,
+    which lets readers keep going while a writer commits.
+    :param path: path of the SQLite database file
+    :type path: string
+    :param max_idle: maximum number of idle connections kept open, extra connections are closed when released
+    :type max_idle: int
+    :param readonly: True to open read only connections, see connect()
+    :type readonly: bool
+    :param immutable: True to open connections to a file that never changes, see connect()
+    :type immutable: bool
+    """
+    def __init__(self, path, max_idle=POOL_MAX_IDLE, readonly=False, immutable=False):
+        self.path = path
+        self.max_idle = max_idle
+        self.readonly = readonly
+        self.immutable = immutable
+        self.closed = False
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.size = 0
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+
+    def _open(self):
+        return connect(self.path, self.readonly, self.immutable)
+
+    def _check_fork(self):
+        #Connections must never cross a fork, a child process starts with an empty pool
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self.size = 0
+            self.in_use = 0
+
+    def acquire(self):
+        """Takes an idle connection from the pool, or opens a new one if none is idle
+        :return: an open connection to the database
+        :rtype: sqlite3.Connection
+        """
+        with self._lock:
+            self._check_fork()
+            self.in_use += 1
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.size += 1
+            self.created += 1
+        try:
+            return self._open()
+        except:
+            with self._lock:
+                self.size -= 1
+                self.in_use -= 1
+            raise
+
+    def release(self, conn):
+        """Gives a connection back to the pool. Any transaction left open is rolled back first so the next user gets a
+        clean connection.
+        :param conn: connection obtained from acquire()
+        :type conn: sqlite3.Connection
+        """
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn = None
+        with self._lock:
+            self.in_use -= 1
+            if conn is not None and not self.closed and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self.size -= 1
+        if conn is not None:
             conn.close()
-            return res1
-        
-        elif query["1"] == "SELECT * FROM goods":
-            cur.execute(query["1"])
-            rows = cur.fetchall()
-            for i in rows:
-                good = {}
-                good["name"] = i["name"] 
-                good["price"] = i["price"] 
-                res1.append(good)
+
+    def close(self):
+        """Closes the idle connections, the ones in use are closed when they are released
+        """
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self.size -= len(idle)
+        for conn in idle:
             conn.close()
-            return res1
-        
-        else:
-            cur.execute(query["1"],tuple(query["2"]))
-            
-            if query["1"] == "SELECT * FROM users WHERE username = ?":
-                row = cur.fetchone()
-                res["user_id"] = row["user_id"] 
-                res["fullname"] = row["fullname"] 
-                res["username"] = row["username"] 
-                res["password"] = row["password"] 
-                res["age"] = row["age"] 
-                res["address"] = row["address"] 
-                res["gender"] = row["gender"] 
-                res["marital_status"] = row["marital_status"]  
-                res["wallet"] = row["wallet"]
-                conn.close()
-                return res
 
-            elif query["1"] == "SELECT * FROM goods WHERE name = ?":
-                row = cur.fetchone()
-                res["user_id"] = row["user_id"] 
-                res["name"] = row["name"] 
-                res["category"] = row["category"] 
-                res["price"] = row["price"] 
-                res["description"] = row["description"] 
-                res["count"] = row["count"] 
+    @contextmanager
+    def connection(self):
+        """Context manager form of acquire() and release()
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        """Returns the pool size and the connection reuse counters
+        :return: open, idle and in use connections, and how many checkouts opened or reused a connection
+        :rtype: dictionary
+        """
+        with self._lock:
+            return {"size": self.size, "idle": len(self._idle), "in_use": self.in_use, "max_idle": self.max_idle,
+                    "created": self.created, "reused": self.reused}
+
+
+class WriterUnavailable(sqlite3.OperationalError):
+    """Raised when the writer thread stopped before committing a write, or did not commit it within WRITE_TIMEOUT
+    seconds. The request can be sent again, the next write starts a new writer thread.
+    """
+
+
+def write_result(future):
+    """Waits at most WRITE_TIMEOUT seconds for the result of a queued write
+    :param future: the future result of the write, see Writer.enqueue()
+    :type future: concurrent.futures.Future
+    :raises WriterUnavailable: if the write is not committed in time
+    :raises sqlite3.Error: the error of the write
+    :return: the result of the write
+    """
+    try:
+        return future.result(timeout=WRITE_TIMEOUT)
+    except FutureTimeout:
+        raise WriterUnavailable("The write was not committed within {} seconds".format(WRITE_TIMEOUT))
+
+
+class Writer:
+    """Runs every write of this process on a single connection owned by a dedicated thread. Callers queue their writes
+    and wait; the thread takes the writes that are waiting, runs each one in its own savepoint and commits them all
+    with a single fsync. A write that fails only rolls back its own savepoint, and each caller is answered once the
+    commit of its group is durable, with its own result or error. If the thread stops, every write it still holds
+    fails with WriterUnavailable and the next write starts a new thread.
+    :param path: path of the SQLite database file
+    :type path: string
+    :param max_group: maximum number of writes committed together
+    :type max_group: int
+    :param max_delay: seconds to wait for more writes before committing a group that is not full
+    :type max_delay: float
+    :param on_commit: called with the set of tables changed by a group once it is committed, before the callers of the
+        group are answered
+    :type on_commit: function
+    """
+    def __init__(self, path, max_group=WRITE_GROUP_SIZE, max_delay=WRITE_GROUP_DELAY, on_commit=None):
+        self.path = path
+        self.max_group = max_group
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.groups = 0
+        self.writes = 0
+        self.failed = 0
+        self.max_group_size = 0
+        self.commit_time = 0.0
+        self.max_commit_time = 0.0
+
+    def _start(self):
+        #The thread is started by the first write of each process, a forked worker never shares the parent's thread,
+        #and started again once it stopped. Called with the lock held.
+        if self._pid != os.getpid():
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, args=(self._queue,), name="writer", daemon=True).start()
+        return self._queue
+
+    def submit(self, job, tables=()):
+        """Queues a write and waits until it is committed
+        :param job: function running the write on the connection it receives and returning its result
+        :type job: function
+        :param tables: names of the tables the job writes
+        :type tables: iterable
+        :raises WriterUnavailable: if the write is not committed within WRITE_TIMEOUT seconds or the thread stopped
+        :raises sqlite3.Error: the error raised by the job, or by the commit of its group
+        :return: what the job returned
+        """
+        return write_result(self.enqueue(job, tables))
+
+    def enqueue(self, job, tables=()):
+        """Queues a write without waiting for it, see submit()
+        :return: the future result of the job, set once its group is committed
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        #Queued under the lock, a stopping thread answers every write of its queue and none is queued after
+        with self._lock:
+            self._start().put((job, tables, future))
+        return future
+
+    def _take_group(self, waiting):
+        group = [waiting.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(group) < self.max_group:
+            try:
+                group.append(waiting.get_nowait())
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(waiting.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return group
+
+    def _run(self, waiting):
+        conn = None
+        group = []
+        try:
+            conn = connect(self.path)
+            conn.isolation_level = None
+            while True:
+                group = self._take_group(waiting)
+                self._commit(conn, group)
+                group = []
+        except Exception as e:
+            app.logger.error("Writer of %s stopped: %s", self.path, e)
+            error = WriterUnavailable("The writer stopped: {}".format(e))
+            error.__cause__ = e
+            with self._lock:
+                if self._queue is waiting:
+                    self._pid = None
+                while not waiting.empty():
+                    group.append(waiting.get_nowait())
+            for job, tables, future in group:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+
+    def _commit(self, conn, group):
+        outcomes = []
+        changed = set()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job, tables, future in group:
+                conn.execute('SAVEPOINT write')
+                try:
+                    outcomes.append((future, job(conn), None))
+                    conn.execute('RELEASE write')
+                    changed.update(tables)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    outcomes.append((future, None, e))
+            start = time.perf_counter()
+            conn.execute('COMMIT')
+            self._record(len(group), sum(1 for outcome in outcomes if outcome[2] is not None),
+                         time.perf_counter() - start)
+        except sqlite3.Error as e:
+            #Nothing of the group was committed, every caller gets the error. A failing ROLLBACK stops the thread.
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self._record(len(group), len(group), 0)
+            outcomes = [(future, None, e) for job, tables, future in group]
+            changed = set()
+        if changed and self.on_commit is not None:
+            try:
+                self.on_commit(changed)
+            except Exception as e:
+                app.logger.error("Commit hook of the writer failed: %s", e)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _record(self, size, failed, commit_time):
+        with self._lock:
+            self.groups += 1
+            self.writes += size
+            self.failed += failed
+            self.max_group_size = max(self.max_group_size, size)
+            self.commit_time += commit_time
+            self.max_commit_time = max(self.max_commit_time, commit_time)
+
+    def stats(self):
+        """Returns the number of writes and groups committed, the group sizes and the commit latency
+        :rtype: dictionary
+        """
+        with self._lock:
+            return {"writes": self.writes, "failed": self.failed, "groups": self.groups,
+                    "queued": self._queue.qsize() if self._pid == os.getpid() else 0,
+                    "avg_group_size": round(self.writes / self.groups, 2) if self.groups else 0,
+                    "max_group_size": self.max_group_size,
+                    "avg_commit_ms": round(self.commit_time * 1000 / self.groups, 3) if self.groups else 0,
+                    "max_commit_ms": round(self.max_commit_time * 1000, 3)}
+
+
+class Replica:
+    """A read replica of the database: a file refreshed by replacing it with a new copy, never modified in place. Its
+    age is the modification time of the file, which is set to the moment the copy started, so every process of the
+    service sees the same age. Connections are opened on the current file and dropped once a newer copy replaces it.
+    :param path: path of the replica file
+    :type path: string
+    """
+    def __init__(self, path):
+        self.path = path
+        self.reads = 0
+        self._pool = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def age(self):
+        """Returns how many seconds old the data of the replica is, None if the replica was not created yet
+        :rtype: float
+        """
+        try:
+            return time.time() - os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def pool(self):
+        """Returns the connection pool of the current replica file
+        :rtype: ConnectionPool
+        """
+        stat = os.stat(self.path)
+        with self._lock:
+            self.reads += 1
+            if self._file != (stat.st_ino, stat.st_mtime_ns):
+                if self._pool is not None:
+                    self._pool.close()
+                self._pool = ConnectionPool(self.path, immutable=True)
+                self._file = (stat.st_ino, stat.st_mtime_ns)
+            return self._pool
+
+    def refresh(self, source):
+        """Copies the database into a new replica file with the SQLite backup API and puts it in place of the current
+        one. Readers of the current file keep reading it until they are done.
+        :param source: path of the database file
+        :type source: string
+        """
+        started = time.time()
+        copy = self.path + '.tmp'
+        src = connect(source, readonly=True)
+        dst = sqlite3.connect(copy)
+        try:
+            src.backup(dst)
+            dst.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            dst.close()
+            src.close()
+        os.utime(copy, (started, started))
+        os.replace(copy, self.path)
+
+
+class Replicas:
+    """The read replicas of the database and the thread keeping them fresh. Only one process of the service refreshes
+    the replicas, the one holding the lock on the replica lock file, the others only read them.
+    :param source: path of the database file
+    :type source: string
+    :param count: number of replicas
+    :type count: int
+    :param interval: seconds between two refreshes of a replica
+    :type interval: float
+    """
+    def __init__(self, source, count=READ_REPLICAS, interval=REPLICA_REFRESH_INTERVAL):
+        self.source = source
+        self.interval = interval
+        self.replicas = [Replica('{}.replica-{}'.format(source, i)) for i in range(count)]
+        self.primary_reads = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self._next = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="replicas", daemon=True).start()
+
+    def _run(self):
+        with open(self.source + '.replica-lock', 'w') as lock:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(self.interval)
+            while True:
+                for replica in self.replicas:
+                    try:
+                        replica.refresh(self.source)
+                        self.refreshes += 1
+                    except (sqlite3.Error, OSError) as e:
+                        self.refresh_failures += 1
+                        app.logger.error("Refreshing %s failed: %s", replica.path, e)
+                time.sleep(self.interval)
+
+    def choose(self, max_staleness):
+        """Returns the pool to read from: the next replica in turn that is fresh enough, or the pool of the database
+        :param max_staleness: how many seconds old the data read may be
+        :type max_staleness: float
+        :rtype: ConnectionPool
+        """
+        if self.replicas and max_staleness > 0:
+            self._start()
+            for _ in range(len(self.replicas)):
+                self._next = (self._next + 1) % len(self.replicas)
+                replica = self.replicas[self._next]
+                age = replica.age()
+                if age is not None and age <= max_staleness:
+                    try:
+                        return replica.pool()
+                    except FileNotFoundError:
+                        continue
+        self.primary_reads += 1
+        return pool
+
+    def stats(self):
+        """Returns the age of every replica and how many reads each one served
+        :rtype: dictionary
+        """
+        return {"primary_reads": self.primary_reads, "refreshes": self.refreshes,
+                "refresh_failures": self.refresh_failures,
+                "replicas": [{"path": replica.path, "reads": replica.reads,
+                              "age": round(replica.age(), 3) if replica.age() is not None else None}
+                             for replica in self.replicas]}
+
+
+def file_sha256(path):
+    """Returns the sha256 checksum of a file, in hexadecimal
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SnapshotRunning(Exception):
+    pass
+
+
+class SnapshotUnsupported(Exception):
+    pass
+
+
+class Snapshots:
+    """Online snapshots of the database. A snapshot is copied with the SQLite backup API a few pages at a time, with a
+    pause between steps so that reads and writes keep going during the copy. The copy holds one read transaction from
+    start to end: every step reads the same version of the database, and writes committed meanwhile neither block it
+    nor make it start over. The copy is compressed with gzip into a file of the snapshot directory, next to a sha256
+    checksum file in the format of sha256sum. Only one snapshot runs at a time across the processes of the service.
+    A snapshot copies a single database file, so a sharded database, whose shard files would have to be copied as one
+    consistent set, has no snapshots.
+    :param source: path of the database file
+    :type source: string
+    :param directory: directory of the snapshot files, created if missing
+    :type directory: string
+    :param pages: number of pages copied by each step
+    :type pages: int
+    :param sleep: seconds to pause between two steps
+    :type sleep: float
+    :param keep: number of snapshots kept, the oldest ones are deleted after a new one is written
+    :type keep: int
+    """
+    def __init__(self, source, directory=SNAPSHOT_DIR, pages=SNAPSHOT_PAGES, sleep=SNAPSHOT_SLEEP,
+                 keep=SNAPSHOT_KEEP):
+        self.source = source
+        self.directory = directory
+        self.pages = pages
+        self.sleep = sleep
+        self.keep = keep
+        self.running = False
+        self.taken = 0
+        self.failed = 0
+        self.last = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def files(self):
+        """Returns the snapshot files, oldest first
+        :rtype: list
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(names) if name.endswith('.db.gz')]
+
+    def take(self):
+        """Takes a snapshot now and waits until it is written
+        :raises SnapshotRunning: if a snapshot is already running in this process or in another one
+        :raises SnapshotUnsupported: if the database has more than one shard
+        :raises sqlite3.Error: if the copy fails
+        :return: the path, checksum, size and duration of the snapshot
+        :rtype: dictionary
+        """
+        self._reserve()
+        return self._run()
+
+    def _reserve(self):
+        if SHARDS > 1:
+            raise SnapshotUnsupported("A snapshot covers a single database file, the database has {} shards"
+                                      .format(SHARDS))
+        with self._lock:
+            if self.running:
+                raise SnapshotRunning("A snapshot is already running")
+            self.running = True
+
+    def _run(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raise SnapshotRunning("A snapshot is already running in another process")
+                try:
+                    self.last = self._take()
+                    self.taken += 1
+                    self.last_error = None
+                    return self.last
+                except Exception as e:
+                    self.failed += 1
+                    self.last_error = str(e)
+                    raise
+        finally:
+            self.running = False
+
+    def _take(self):
+        started = time.time()
+        #Microseconds in the name keep two snapshots of the same second apart, and the names still sort oldest first
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(started)) + '.{:06d}'.format(int(started % 1 * 1000000))
+        name = os.path.join(self.directory, 'snapshot-{}.db'.format(stamp))
+        copy = name + '.tmp'
+        steps = [0, 0]
+
+        def progress(status, remaining, total):
+            steps[0] += 1
+            steps[1] = total
+            time.sleep(self.sleep)
+
+        src = connect(self.source, readonly=True)
+        dst = sqlite3.connect(copy)
+        try:
+            src.execute('BEGIN')
+            src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            src.backup(dst, pages=self.pages, progress=progress)
+            dst.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            dst.close()
+            src.close()
+        copied = time.time()
+        #The snapshot and its checksum are written under temporary names, the checksum is renamed into place first so
+        #a snapshot listed by files() always has its checksum
+        try:
+            with open(copy, 'rb') as raw, gzip.open(name + '.gz.tmp', 'wb', compresslevel=6) as packed:
+                shutil.copyfileobj(raw, packed, 1024 * 1024)
+            digest = file_sha256(name + '.gz.tmp')
+            with open(name + '.gz.sha256.tmp', 'w') as checksum:
+                checksum.write('{}  {}\n'.format(digest, os.path.basename(name) + '.gz'))
+            os.replace(name + '.gz.sha256.tmp', name + '.gz.sha256')
+            os.replace(name + '.gz.tmp', name + '.gz')
+        finally:
+            for path in (copy, name + '.gz.tmp', name + '.gz.sha256.tmp'):
+                if os.path.exists(path):
+                    os.remove(path)
+        for old in self.files()[:-self.keep] if self.keep > 0 else []:
+            for path in (old, old + '.sha256'):
+                if os.path.exists(path):
+                    os.remove(path)
+        return {"path": name + '.gz', "sha256": digest, "bytes": os.path.getsize(name + '.gz'),
+                "pages": steps[1], "steps": steps[0], "copy_seconds": round(copied - started, 3),
+                "seconds": round(time.time() - started, 3), "at": started}
+
+    def start(self):
+        """Takes a snapshot in a background thread
+        :raises SnapshotRunning: if a snapshot is already running in this process
+        :raises SnapshotUnsupported: if the database has more than one shard
+        """
+        self._reserve()
+
+        def run():
+            try:
+                self._run()
+            except (SnapshotRunning, sqlite3.Error, OSError) as e:
+                app.logger.error("Snapshot failed: %s", e)
+
+        threading.Thread(target=run, name="snapshot", daemon=True).start()
+
+    def stats(self):
+        """Returns whether a snapshot is running, the counters and the last snapshot taken by this process, and the
+        snapshot files
+        :rtype: dictionary
+        """
+        return {"running": self.running, "taken": self.taken, "failed": self.failed, "last": self.last,
+                "last_error": self.last_error, "pages_per_step": self.pages, "sleep": self.sleep,
+                "files": [{"path": path, "bytes": os.path.getsize(path)} for path in self.files()]}
+
+
+class Archiver:
+    """The thread running archive_history() on every shard every interval seconds, each shard into its own archive
+    file. Only one process of the service archives, the one holding the lock on the archive lock file.
+    :param source: path of the database file
+    :type source: string
+    :param interval: seconds between two runs, 0 to never archive in the background
+    :type interval: float
+    """
+    #Name of the job, of its thread and of its lock file
+    name = "archive"
+
+    def __init__(self, source, interval=ARCHIVE_INTERVAL):
+        self.source = source
+        self.interval = interval
+        self.runs = 0
+        self.archived = 0
+        self.failures = 0
+        self.last_run = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts the thread of this process, if it is not running yet
+        """
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name=self.name, daemon=True).start()
+
+    def _run(self):
+        with open('{}.{}-lock'.format(self.source, self.name), 'w') as lock:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(self.interval)
+            while True:
+                try:
+                    self._work()
+                    self.runs += 1
+                    self.last_run = time.time()
+                except (sqlite3.Error, OSError, ArchiveConflict) as e:
+                    self.failures += 1
+                    app.logger.error("The %s job failed: %s", self.name, e)
+                time.sleep(self.interval)
+
+    def _work(self):
+        for number, path in enumerate(shards.paths):
+            self.archived += archive_history(path, shard_path(number, ARCHIVE_DATABASE))
+
+    def stats(self):
+        """Returns the counters of the archival job of this process
+        :rtype: dictionary
+        """
+        return {"interval": self.interval, "after_days": ARCHIVE_AFTER_DAYS, "runs": self.runs,
+                "archived": self.archived, "failures": self.failures, "last_run": self.last_run}
+
+
+class Pruner(Archiver):
+    """The thread running prune_changes() and prune_idempotency() on every shard every interval seconds. It runs
+    whether the archival job is on or not, so the changes and the idempotency keys never grow without end. Only one
+    process of the service prunes, the one holding the lock on the prune lock file.
+    :param source: path of the database file
+    :type source: string
+    :param interval: seconds between two runs, 0 to never prune in the background
+    :type interval: float
+    """
+    name = "prune"
+
+    def __init__(self, source, interval=PRUNE_INTERVAL):
+        super().__init__(source, interval)
+        self.pruned = 0
+        self.expired = 0
+
+    def _work(self):
+        for path in shards.paths:
+            self.pruned += prune_changes(path)
+            self.expired += prune_idempotency(path)
+
+    def stats(self):
+        """Returns the counters of the prune job of this process
+        :rtype: dictionary
+        """
+        return {"interval": self.interval, "runs": self.runs, "pruned_changes": self.pruned,
+                "expired_idempotency_keys": self.expired, "failures": self.failures, "last_run": self.last_run}
+
+
+def shard_path(number, path=DATABASE):
+    """Returns the path of a shard file. The first shard is the file itself, so a database with a single shard is the
+    same file as before sharding.
+    :param number: number of the shard, from 0
+    :type number: int
+    :param path: path of the file of the first shard
+    :type path: string
+    :rtype: string
+    """
+    if number == 0:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}-shard-{}{}'.format(root, number, extension)
+
+
+def shard_of(username, shards=SHARDS):
+    """Returns the shard of a user, from a hash of the username that is the same in every process and after restarts,
+    unlike hash()
+    :param username: username of the user
+    :type username: string
+    :param shards: number of shards
+    :type shards: int
+    :rtype: int
+    """
+    return zlib.crc32(str(username).encode('utf-8')) % shards
+
+
+class ShardError(Exception):
+    pass
+
+
+class Shards:
+    """The database files the users and their purchases are spread over, by shard_of() their username. The first shard
+    is the database file itself, which also holds everything that is not sharded, like the goods, and is the one read
+    through the read replicas. Each shard has its own write lock and writer thread, so the writes of users of different
+    shards commit in parallel. Each file records its number and the number of shards in its shard_info table.
+    :param count: number of shards
+    :type count: int
+    :param path: path of the database file, the first shard
+    :type path: string
+    """
+    def __init__(self, count=SHARDS, path=DATABASE):
+        self.count = count
+        self.paths = [shard_path(number, path) for number in range(count)]
+        #The first shard is read and written through the pool and the writer of the database
+        self.pools = [pool] + [ConnectionPool(shard, readonly=True) for shard in self.paths[1:]]
+        self.writers = [writer] + [Writer(shard, on_commit=tables_changed) for shard in self.paths[1:]]
+
+    def route(self, op, args):
+        """Returns the shard an operation runs on: the shard of the username in its shard_by arguments for the
+        operations on the users and their purchases, the first shard for the others, None for a read that runs on
+        every shard
+        :param op: the operation
+        :type op: Operation
+        :param args: parameters of the operation
+        :type args: list
+        :raises ShardError: if the arguments of the operation name users of different shards, or it is a write on the
+            sharded tables that names no user
+        :rtype: int
+        """
+        if self.count == 1 or not any(table in SHARDED_TABLES for table in op.tables):
+            return 0
+        if op.shard_by is None:
+            if op.is_write:
+                raise ShardError("{} does not name the user it writes".format(op.name))
+            return None
+        try:
+            numbers = {shard_of(args[i], self.count) for i in op.shard_by}
+        except (IndexError, TypeError, KeyError):
+            raise ShardError("{} is missing the username in its arguments".format(op.name))
+        if len(numbers) > 1:
+            raise ShardError("{} would move a user to another shard".format(op.name))
+        return numbers.pop()
+
+    def reader(self, number, max_staleness):
+        """Returns the pool to read a shard from, or a read replica of the first shard that is fresh enough
+        :param number: number of the shard
+        :type number: int
+        :param max_staleness: how many seconds old the data read may be, see Replicas.choose()
+        :type max_staleness: float
+        :rtype: ConnectionPool
+        """
+        return replicas.choose(max_staleness) if number == 0 else self.pools[number]
+
+    def check(self):
+        """Records their number in the shard files that hold no user or purchase yet
+        :raises ShardError: if a shard file holding users or purchases was made for another number of shards
+        """
+        for number, path in enumerate(self.paths):
+            conn = connect(path)
+            try:
+                shard, count = conn.execute("SELECT shard, shards FROM shard_info").fetchone()
+                if (shard, count) == (number, self.count):
+                    continue
+                used = conn.execute("SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM history) "
+                                    "OR EXISTS (SELECT 1 FROM history_rollup)").fetchone()[0]
+                if used:
+                    raise ShardError("{} is shard {} of {}, run SHARDS={} python database.py reshard {} first".format(
+                        path, shard, count, count, self.count))
+                with conn:
+                    conn.execute("UPDATE shard_info SET shard = ?, shards = ?", (number, self.count))
+            finally:
                 conn.close()
-                return res
 
-            elif query["1"] == "SELECT * FROM history WHERE name = ?":
-                rows = cur.fetchall()
-                for row in rows:
-                    if row["item"] in res:
-                        res[row["item"]] += row["amount"]
+    def stats(self):
+        """Returns the path, connection pool and writer counters of every shard
+        :rtype: list
+        """
+        return [{"path": path, "pool": shard_pool.stats(), "writer": shard_writer.stats()}
+                for path, shard_pool, shard_writer in zip(self.paths, self.pools, self.writers)]
+
+
+class TableVersions:
+    """Change counters of the tables, kept in a small file that every process of the service maps in memory. A counter
+    is increased after each commit that changed its table, so any process can tell whether a table changed since it
+    last read it without asking SQLite.
+    :param path: path of the counters file, created if missing
+    :type path: string
+    :param tables: names of the tables with a counter
+    :type tables: tuple
+    """
+    def __init__(self, path, tables=TABLES):
+        self.path = path
+        self.slots = {table: 8 * i for i, table in enumerate(tables)}
+        self._map = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _mapping(self):
+        #The mapping is shared, a forked worker keeps using the one of the master
+        if self._map is None:
+            with self._lock:
+                if self._map is None:
+                    self._file = open(self.path, 'a+b')
+                    size = 8 * len(self.slots)
+                    if os.fstat(self._file.fileno()).st_size < size:
+                        self._file.truncate(size)
+                    self._map = mmap.mmap(self._file.fileno(), size)
+        return self._map
+
+    def read(self, tables):
+        """Returns the current counters of some tables
+        :param tables: names of the tables
+        :type tables: tuple
+        :rtype: tuple
+        """
+        mapping = self._mapping()
+        return tuple(struct.unpack_from('<Q', mapping, self.slots[table])[0] for table in tables)
+
+    def bump(self, tables):
+        """Increases the counters of the tables changed by a commit
+        :param tables: names of the changed tables
+        :type tables: iterable
+        """
+        mapping = self._mapping()
+        #The writers of other processes commit concurrently, the file lock keeps their increments from being lost
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                for table in tables:
+                    offset = self.slots[table]
+                    struct.pack_into('<Q', mapping, offset, struct.unpack_from('<Q', mapping, offset)[0] + 1)
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+
+class ResultCache:
+    """Least recently used cache of the encoded results of read operations, keyed by operation, arguments and format.
+    Each entry is stamped with the counters of the tables its operation reads, taken before the read ran, and is only
+    served while those counters have not moved. Writes of this process drop the entries of the tables they changed right
+    away, the entries made stale by writes of other processes are dropped when they are next looked up.
+    :param versions: change counters of the tables
+    :type versions: TableVersions
+    :param max_bytes: total size of the cached results
+    :type max_bytes: int
+    """
+    def __init__(self, versions, max_bytes=RESULT_CACHE_BYTES):
+        self.versions = versions
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._by_table = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._entries = OrderedDict()
+            self._by_table = {}
+            self.bytes = 0
+
+    def _remove(self, key):
+        body, tables, stamp = self._entries.pop(key)
+        self.bytes -= len(body)
+        for table in tables:
+            self._by_table[table].discard(key)
+
+    def get(self, key, tables):
+        """Returns the cached result of a read if it is still current
+        :param key: (operation name, arguments, format) of the read
+        :type key: tuple
+        :param tables: names of the tables the operation reads
+        :type tables: tuple
+        :return: the encoded result, None if it is not cached or stale
+        :rtype: string
+        """
+        stamp = self.versions.read(tables)
+        with self._lock:
+            self._check_fork()
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+        return None
+
+    def put(self, key, body, tables, stamp):
+        """Caches the encoded result of a read, unless one of its tables changed while it ran
+        :param key: (operation name, arguments, format) of the read
+        :type key: tuple
+        :param body: the encoded result
+        :type body: string
+        :param tables: names of the tables the operation reads
+        :type tables: tuple
+        :param stamp: counters of the tables taken before the read ran, see TableVersions.read()
+        :type stamp: tuple
+        """
+        if len(body) > self.max_bytes // 8 or self.versions.read(tables) != stamp:
+            return
+        with self._lock:
+            self._check_fork()
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, tables, stamp)
+            self.bytes += len(body)
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        """Drops the cached results of the operations reading any of the tables
+        :param tables: names of the changed tables
+        :type tables: iterable
+        """
+        with self._lock:
+            self._check_fork()
+            for table in tables:
+                for key in list(self._by_table.get(table, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def stats(self):
+        """Returns the size of the cache and its hit, miss, eviction and invalidation counters
+        :rtype: dictionary
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "invalidations": self.invalidations}
+
+
+def tables_changed(tables):
+    """Records a commit that changed some tables, so that no process serves a cached result read before it
+    :param tables: names of the changed tables
+    :type tables: iterable
+    """
+    table_versions.bump(tables)
+    result_cache.invalidate(tables)
+
+
+#Reads go through read only connections, writes through the writer thread
+pool = ConnectionPool(DATABASE, readonly=True)
+writer = Writer(DATABASE, on_commit=tables_changed)
+replicas = Replicas(DATABASE)
+table_versions = TableVersions(DATABASE + '.versions')
+result_cache = ResultCache(table_versions)
+snapshots = Snapshots(DATABASE)
+archiver = Archiver(DATABASE)
+pruner = Pruner(DATABASE)
+shards = Shards()
+
+
+class MigrationError(Exception):
+    pass
+
+
+def check_unique(table, column):
+    """Returns a migration step that stops the migration while a column about to get a unique index holds duplicates,
+    so that they are resolved by hand instead of deleted
+    :param table: name of the table
+    :type table: string
+    :param column: name of the column
+    :type column: string
+    :return: the step, called with the connection of the migration
+    :rtype: function
+    """
+    def check(conn):
+        duplicates = conn.execute("SELECT {0}, COUNT(*) FROM {1} GROUP BY {0} HAVING COUNT(*) > 1 ORDER BY {0} LIMIT 20"
+                                  .format(column, table)).fetchall()
+        if duplicates:
+            raise MigrationError("The {} table has rows with the same {}, keep one row of each before starting the "
+                                 "service again: {}".format(table, column, ", ".join(
+                                     "{!r} ({} rows)".format(value, count) for value, count in duplicates)))
+    return check
+
+
+def keep_history_ids_above(conn, floor):
+    """Makes the next purchases of a database get ids above floor, like the ids of the purchases already archived
+    :param conn: connection to the database, in a write transaction
+    :type conn: sqlite3.Connection
+    :param floor: highest id the purchases must not get again
+    :type floor: int
+    """
+    if not conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'history'", (floor,)).rowcount:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('history', ?)", (floor,))
+
+
+def autoincrement_history(conn):
+    """Migration step rebuilding the history table with an AUTOINCREMENT key. Without it SQLite gives the ids of the
+    newest purchases again once they are archived and deleted, and the archive holds other purchases under those ids.
+    The indexes and the triggers of the table are created again as they were, and the next purchases get ids above
+    every purchase of the history and of the archive of the file.
+    :param conn: connection to the database, in the transaction of the migration
+    :type conn: sqlite3.Connection
+    """
+    schema = [sql for sql, in conn.execute("SELECT sql FROM sqlite_master WHERE tbl_name = 'history' "
+                                           "AND type IN ('index', 'trigger') AND sql IS NOT NULL")]
+    conn.execute('''CREATE TABLE history_autoincrement (
+                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    amount INTEGER NOT NULL DEFAULT 0,
+                    purchased_at INTEGER NOT NULL DEFAULT 0
+                    )''')
+    conn.execute("INSERT INTO history_autoincrement (user_id, name, item, amount, purchased_at) "
+                 "SELECT user_id, name, item, amount, purchased_at FROM history")
+    conn.execute("DROP TABLE history")
+    conn.execute("ALTER TABLE history_autoincrement RENAME TO history")
+    for sql in schema:
+        conn.execute(sql)
+    archive = shard_path(conn.execute("SELECT shard FROM shard_info").fetchone()[0], ARCHIVE_DATABASE)
+    if os.path.exists(archive):
+        copy = sqlite3.connect(archive)
+        try:
+            archived = copy.execute("SELECT COALESCE(MAX(user_id), 0) FROM history").fetchone()[0]
+        except sqlite3.OperationalError:
+            archived = 0
+        finally:
+            copy.close()
+        keep_history_ids_above(conn, archived)
+
+
+#Schema migrations as (version, description, statements). A statement is SQL, or a function called with the
+#connection for a step SQL cannot express. The version of the last applied migration is kept in the user_version of
+#the database file. New migrations are appended at the end, an applied migration is never edited.
+MIGRATIONS = [
+    (1, "create the users, goods and history tables", [
+        '''CREATE TABLE IF NOT EXISTS users (
+           user_id INTEGER PRIMARY KEY NOT NULL,
+           fullname TEXT NOT NULL,
+           username TEXT NOT NULL,
+           password TEXT NOT NULL,
+           age TEXT NOT NULL,
+           address TEXT NOT NULL,
+           gender TEXT NOT NULL,
+           marital_status TEXT NOT NULL,
+           wallet INTEGER NOT NULL DEFAULT 0
+           )''',
+        '''CREATE TABLE IF NOT EXISTS goods (
+           user_id INTEGER PRIMARY KEY NOT NULL,
+           name TEXT NOT NULL,
+           category TEXT NOT NULL,
+           price FLOAT NOT NULL,
+           description TEXT NOT NULL,
+           count INTEGER NOT NULL
+           )''',
+        '''CREATE TABLE IF NOT EXISTS history (
+           user_id INTEGER PRIMARY KEY NOT NULL,
+           name TEXT NOT NULL,
+           item TEXT NOT NULL,
+           amount INTEGER NOT NULL DEFAULT 0
+           )''',
+    ]),
+    (2, "index users.username, goods.name and history(name, item)", [
+        #Duplicates may hold purchases or stock, which only someone looking at them can merge
+        check_unique("users", "username"),
+        check_unique("goods", "name"),
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS goods_name ON goods (name)",
+        "CREATE INDEX IF NOT EXISTS history_name_item ON history (name, item)",
+    ]),
+    (3, "maintain the per-user purchase totals in history_summary", [
+        '''CREATE TABLE IF NOT EXISTS history_summary (
+           name TEXT NOT NULL,
+           item TEXT NOT NULL,
+           total INTEGER NOT NULL DEFAULT 0,
+           PRIMARY KEY (name, item)
+           ) WITHOUT ROWID''',
+        #History rows are only ever inserted, the trigger keeps the totals in the same transaction as the purchase
+        '''CREATE TRIGGER IF NOT EXISTS history_summary_insert AFTER INSERT ON history
+           BEGIN
+               INSERT INTO history_summary (name, item, total) VALUES (NEW.name, NEW.item, NEW.amount)
+               ON CONFLICT (name, item) DO UPDATE SET total = total + excluded.total;
+           END''',
+        "DELETE FROM history_summary",
+        "INSERT INTO history_summary (name, item, total) SELECT name, item, SUM(amount) FROM history GROUP BY name, item",
+    ]),
+    (4, "timestamp purchases and keep the monthly totals of archived purchases in history_rollup", [
+        #The time of the purchases made before this migration is unknown, they count as made in January 1970
+        "ALTER TABLE history ADD COLUMN purchased_at INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS history_purchased_at ON history (purchased_at)",
+        '''CREATE TABLE IF NOT EXISTS history_rollup (
+           name TEXT NOT NULL,
+           month TEXT NOT NULL,
+           item TEXT NOT NULL,
+           total INTEGER NOT NULL DEFAULT 0,
+           purchases INTEGER NOT NULL DEFAULT 0,
+           PRIMARY KEY (name, month, item)
+           ) WITHOUT ROWID''',
+    ]),
+    (5, "record the shard of the database file", [
+        #floor is the highest user id given before the file was last resharded, see NEXT_USER_ID
+        '''CREATE TABLE IF NOT EXISTS shard_info (
+           shard INTEGER NOT NULL,
+           shards INTEGER NOT NULL,
+           floor INTEGER NOT NULL DEFAULT 0
+           )''',
+        "INSERT INTO shard_info (shard, shards) VALUES (0, 1)",
+    ]),
+    (6, "index the name and the description of the goods for full-text search", [
+        #The index only holds the words, the rows are read from goods through their user_id
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS goods_search USING fts5(
+           name,
+           description,
+           content='goods',
+           content_rowid='user_id',
+           tokenize='unicode61 remove_diacritics 2',
+           prefix='2 3'
+           )''',
+        '''CREATE TRIGGER IF NOT EXISTS goods_search_insert AFTER INSERT ON goods
+           BEGIN
+               INSERT INTO goods_search (rowid, name, description) VALUES (NEW.user_id, NEW.name, NEW.description);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS goods_search_delete AFTER DELETE ON goods
+           BEGIN
+               INSERT INTO goods_search (goods_search, rowid, name, description)
+               VALUES ('delete', OLD.user_id, OLD.name, OLD.description);
+           END''',
+        #Selling a good only changes its count, which leaves the index alone
+        '''CREATE TRIGGER IF NOT EXISTS goods_search_update AFTER UPDATE OF name, description ON goods
+           BEGIN
+               INSERT INTO goods_search (goods_search, rowid, name, description)
+               VALUES ('delete', OLD.user_id, OLD.name, OLD.description);
+               INSERT INTO goods_search (rowid, name, description) VALUES (NEW.user_id, NEW.name, NEW.description);
+           END''',
+        "INSERT INTO goods_search (goods_search) VALUES ('rebuild')",
+    ]),
+    (7, "index the goods by category and price for the filtered listings", [
+        #Both indexes hold every column a listing returns, so a listing never reads the goods table itself
+        "CREATE INDEX IF NOT EXISTS goods_category_price ON goods (category COLLATE NOCASE, price, name, count)",
+        "CREATE INDEX IF NOT EXISTS goods_price ON goods (price, name, category, count)",
+    ]),
+    (8, "record the changes of the users, goods and purchases in the changes table", [
+        #seq never goes back, even once the oldest changes are pruned, so a consumer can resume after the last it read
+        '''CREATE TABLE IF NOT EXISTS changes (
+           seq INTEGER PRIMARY KEY AUTOINCREMENT,
+           table_name TEXT NOT NULL,
+           row_key TEXT NOT NULL,
+           operation TEXT NOT NULL,
+           data TEXT,
+           changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s','now') AS INTEGER))
+           )''',
+        #The rows are keyed by the username or the name of the good, which the other services look them up by. The
+        #passwords are left out of the changes.
+        '''CREATE TRIGGER IF NOT EXISTS users_changes_insert AFTER INSERT ON users
+           BEGIN
+               INSERT INTO changes (table_name, row_key, operation, data)
+               VALUES ('users', NEW.username, 'insert', json_object('user_id', NEW.user_id, 'fullname', NEW.fullname,
+                       'username', NEW.username, 'age', NEW.age, 'address', NEW.address, 'gender', NEW.gender,
+                       'marital_status', NEW.marital_status, 'wallet', NEW.wallet));
+           END''',
+        #Renaming a row is recorded as the deletion of the old key followed by the update of the new one
+        '''CREATE TRIGGER IF NOT EXISTS users_changes_update
+           AFTER UPDATE OF fullname, username, age, address, gender, marital_status, wallet ON users
+           BEGIN
+               INSERT INTO changes (table_name, row_key, operation)
+               SELECT 'users', OLD.username, 'delete' WHERE OLD.username IS NOT NEW.username;
+               INSERT INTO changes (table_name, row_key, operation, data)
+               VALUES ('users', NEW.username, 'update', json_object('user_id', NEW.user_id, 'fullname', NEW.fullname,
+                       'username', NEW.username, 'age', NEW.age, 'address', NEW.address, 'gender', NEW.gender,
+                       'marital_status', NEW.marital_status, 'wallet', NEW.wallet));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_changes_delete AFTER DELETE ON users
+           BEGIN
+               INSERT INTO changes (table_name, row_key, operation) VALUES ('users', OLD.username, 'delete');
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS goods_changes_insert AFTER INSERT ON goods
+           BEGIN
+               INSERT INTO changes (table_name, row_key, operation, data)
+               VALUES ('goods', NEW.name, 'insert', json_object('user_id', NEW.user_id, 'name', NEW.name,
+                       'category', NEW.category, 'price', NEW.price, 'description', NEW.description,
+                       'count', NEW.count));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS goods_changes_update AFTER UPDATE ON goods
+           BEGIN
+               INSERT INTO changes (table_name, row_key, operation)
+               SELECT 'goods', OLD.name, 'delete' WHERE OLD.name IS NOT NEW.name;
+               INSERT INTO changes (table_name, row_key, operation, data)
+               VALUES ('goods', NEW.name, 'update', json_object('user_id', NEW.user_id, 'name', NEW.name,
+                       'category', NEW.category, 'price', NEW.price, 'description', NEW.description,
+                       'count', NEW.count));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS goods_changes_delete AFTER DELETE ON goods
+           BEGIN
+               INSERT INTO changes (table_name, row_key, operation) VALUES ('goods', OLD.name, 'delete');
+           END''',
+        #Purchases are only added, archiving moves them without changing them and is not recorded
+        '''CREATE TRIGGER IF NOT EXISTS history_changes_insert AFTER INSERT ON history
+           BEGIN
+               INSERT INTO changes (table_name, row_key, operation, data)
+               VALUES ('history', NEW.name, 'insert', json_object('user_id', NEW.user_id, 'name', NEW.name,
+                       'item', NEW.item, 'amount', NEW.amount, 'purchased_at', NEW.purchased_at));
+           END''',
+    ]),
+    (9, "keep the results of the writes sent with an idempotency key", [
+        #request is a digest of the operation and its arguments, a key sent again with another request is refused
+        '''CREATE TABLE IF NOT EXISTS idempotency (
+           key TEXT PRIMARY KEY,
+           request BLOB NOT NULL,
+           result TEXT NOT NULL,
+           created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s','now') AS INTEGER))
+           ) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idempotency_created_at ON idempotency (created_at)",
+    ]),
+    (10, "never give the id of a purchase again once it is archived", [
+        autoincrement_history,
+    ]),
+]
+
+#seq of the last change recorded in a database file, even if it was pruned
+CHANGES_SEQ = "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'changes'), 0)"
+
+#Lifetime purchase totals from the recent purchases and the monthly totals of the archived ones
+REBUILD_HISTORY_SUMMARY = ("INSERT INTO history_summary (name, item, total) "
+                           "SELECT name, item, SUM(total) FROM (SELECT name, item, amount AS total FROM history "
+                           "UNION ALL SELECT name, item, total FROM history_rollup) GROUP BY name, item")
+
+
+def schema_version(conn):
+    """Returns the version of the last migration applied to the database
+    :param conn: connection to the database
+    :type conn: sqlite3.Connection
+    :rtype: int
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(path=DATABASE):
+    """Brings the database schema up to date by applying, in order, every migration newer than the version recorded in
+    the database. Each migration runs in its own transaction together with the update of the recorded version, so a
+    failed migration leaves the database at the previous version. The version is read again once the write lock is
+    held, which lets several processes start at the same time without applying a migration twice.
+    :param path: path of the SQLite database file
+    :type path: string
+    :raises MigrationError: if the data of the database stops a migration, which is then not applied
+    :return: the schema version of the database
+    :rtype: int
+    """
+    conn = connect(path)
+    try:
+        for version, description, statements in MIGRATIONS:
+            if schema_version(conn) >= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if schema_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
                     else:
-                        res[row["item"]] = row["amount"]
-                conn.close()
-                return res
-    except:
-       conn.rollback()
+                        conn.execute(statement)
+                conn.execute('PRAGMA user_version = {}'.format(version))
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+            print("Applied migration {}: {}".format(version, description))
+        return schema_version(conn)
     finally:
-       conn.close()
-    return {}
+        conn.close()
 
-@app.route('/api/post',methods=['POST'])
-def api_post():
-    '''Receives API POST requests from other containers and process them
-    '''
+def restore_snapshot(snapshot, path=DATABASE):
+    """Replaces the database with a snapshot, once the snapshot matches its checksum file and passes an integrity
+    check. No process may have the database open while it is restored.
+    :param snapshot: path of the snapshot file
+    :type snapshot: string
+    :param path: path of the SQLite database file
+    :type path: string
+    :raises SnapshotUnsupported: if the database has more than one shard, a snapshot holds only one of them
+    :raises ValueError: if the snapshot does not match its checksum or is corrupt
+    :return: the sha256 checksum of the snapshot
+    :rtype: string
+    """
+    if SHARDS > 1:
+        raise SnapshotUnsupported("A snapshot holds a single database file, the database has {} shards".format(SHARDS))
+    with open(snapshot + '.sha256') as checksum:
+        expected = checksum.read().split()[0]
+    if file_sha256(snapshot) != expected:
+        raise ValueError("Snapshot {} does not match its checksum".format(snapshot))
+    copy = path + '.restore'
+    with gzip.open(snapshot, 'rb') as packed, open(copy, 'wb') as raw:
+        shutil.copyfileobj(packed, raw, 1024 * 1024)
+    conn = sqlite3.connect(copy)
+    try:
+        check = conn.execute('PRAGMA quick_check').fetchone()[0]
+    finally:
+        conn.close()
+    if check != 'ok':
+        os.remove(copy)
+        raise ValueError("Snapshot {} is corrupt: {}".format(snapshot, check))
+    #The journal of the previous database must not be replayed into the restored one
+    for journal in (path + '-wal', path + '-shm'):
+        if os.path.exists(journal):
+            os.remove(journal)
+    os.replace(copy, path)
+    return expected
+
+#A fresh deployment with an empty volume starts from the configured snapshot, an existing database is never replaced
+if RESTORE_SNAPSHOT and not os.path.exists(DATABASE):
+    restore = snapshots.files()[-1:] if RESTORE_SNAPSHOT == 'latest' else [RESTORE_SNAPSHOT]
+    for snapshot in restore:
+        restore_snapshot(snapshot)
+        print("Restored snapshot {}".format(snapshot))
+
+for path in shards.paths:
+    migrate(path)
+shards.check()
+
+
+def rebuild_history_summary(path=DATABASE):
+    """Recomputes the history_summary totals from every row of the history table and the monthly totals of the
+    archived rows, in one transaction
+    :param path: path of the SQLite database file
+    :type path: string
+    :return: the number of (user, item) totals in the summary
+    :rtype: int
+    """
+    conn = connect(path)
     try:
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        query = request.get_json()
-        cur.execute(query["1"],tuple(query["2"]))
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute("DELETE FROM history_summary")
+        conn.execute(REBUILD_HISTORY_SUMMARY)
         conn.commit()
+        tables_changed(("history_summary",))
+        return conn.execute("SELECT COUNT(*) FROM history_summary").fetchone()[0]
     except:
         conn.rollback()
+        raise
     finally:
         conn.close()
-    return {}
-    
-@app.route('/api/put',methods=['PUT'])
-def api_put():
-    '''Receives API PUT requests from other containers and process them
-    '''
+
+class ArchiveConflict(Exception):
+    pass
+
+
+def archive_history(path=DATABASE, archive=ARCHIVE_DATABASE, after_days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH):
+    """Moves the purchases older than after_days days from the history table to the history table of the archive
+    database, and adds them to the monthly totals of history_rollup, batch rows at a time. The rows of a batch are
+    copied to the archive first, then added to the totals and deleted in one short transaction, so purchases keep being
+    written in between and a failure never loses a row. The lifetime totals of history_summary do not change.
+    :param path: path of the SQLite database file
+    :type path: string
+    :param archive: path of the archive database file, created if missing
+    :type archive: string
+    :param after_days: age in days of the purchases to archive
+    :type after_days: float
+    :param batch: number of rows moved by each transaction
+    :type batch: int
+    :raises ArchiveConflict: if the archive holds another purchase with the id of a purchase to archive
+    :return: the number of purchases archived
+    :rtype: int
+    """
+    cutoff = int(time.time() - after_days * 86400)
+    conn = connect(path)
     try:
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        query = request.get_json()
-        cur.execute(query["1"],tuple(query["2"]))
+        conn.execute("ATTACH DATABASE ? AS archive", (archive,))
+        conn.execute('''CREATE TABLE IF NOT EXISTS archive.history (
+                        user_id INTEGER PRIMARY KEY NOT NULL,
+                        name TEXT NOT NULL,
+                        item TEXT NOT NULL,
+                        amount INTEGER NOT NULL,
+                        purchased_at INTEGER NOT NULL
+                        )''')
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS archiving (user_id INTEGER PRIMARY KEY NOT NULL)")
+        #The archive may come from before the ids were never given again, or from another copy of the database
+        highest = conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM archive.history").fetchone()[0]
+        keep_history_ids_above(conn, highest)
         conn.commit()
-    except:
-        conn.rollback()
+        archived = 0
+        while True:
+            conn.execute("DELETE FROM archiving")
+            conn.execute("INSERT INTO archiving SELECT user_id FROM history WHERE purchased_at < ? LIMIT ?",
+                         (cutoff, batch))
+            conn.commit()
+            #A row already in the archive was copied by a run that failed before deleting it, another purchase with the
+            #same id stops the archival before anything of the batch is deleted
+            conflicts = conn.execute("SELECT history.user_id FROM history JOIN archive.history AS archived "
+                                     "ON archived.user_id = history.user_id "
+                                     "WHERE history.user_id IN (SELECT user_id FROM archiving) "
+                                     "AND NOT (archived.name = history.name AND archived.item = history.item "
+                                     "AND archived.amount = history.amount "
+                                     "AND archived.purchased_at = history.purchased_at) LIMIT 20").fetchall()
+            if conflicts:
+                raise ArchiveConflict("The archive {} holds other purchases with the ids {}, move them away before "
+                                      "archiving again".format(archive, ", ".join(str(id) for id, in conflicts)))
+            conn.execute("INSERT INTO archive.history "
+                         "SELECT user_id, name, item, amount, purchased_at FROM history "
+                         "WHERE user_id IN (SELECT user_id FROM archiving) "
+                         "AND user_id NOT IN (SELECT user_id FROM archive.history)")
+            conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute("INSERT INTO history_rollup (name, month, item, total, purchases) "
+                             "SELECT name, strftime('%Y-%m', purchased_at, 'unixepoch'), item, SUM(amount), COUNT(*) "
+                             "FROM history WHERE user_id IN (SELECT user_id FROM archiving) GROUP BY 1, 2, 3 "
+                             "ON CONFLICT (name, month, item) DO UPDATE "
+                             "SET total = total + excluded.total, purchases = purchases + excluded.purchases")
+                moved = conn.execute("DELETE FROM history WHERE user_id IN (SELECT user_id FROM archiving)").rowcount
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+            if moved:
+                tables_changed(("history", "history_rollup"))
+            archived += moved
+            if moved < batch:
+                return archived
     finally:
         conn.close()
-        return {}
-    
+
+
+def prune_changes(path=DATABASE, keep=CHANGES_KEEP):
+    """Deletes the changes older than the last keep changes of a database file
+    :param path: path of the SQLite database file
+    :type path: string
+    :param keep: number of changes to keep
+    :type keep: int
+    :return: the number of changes deleted
+    :rtype: int
+    """
+    conn = connect(path)
+    try:
+        with conn:
+            return conn.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?",
+                                (keep,)).rowcount
+    finally:
+        conn.close()
+
+def prune_idempotency(path=DATABASE, ttl=IDEMPOTENCY_TTL):
+    """Deletes the results of the writes sent with an idempotency key more than ttl seconds ago
+    :param path: path of the SQLite database file
+    :type path: string
+    :param ttl: seconds a result is kept
+    :type ttl: float
+    :return: the number of results deleted
+    :rtype: int
+    """
+    conn = connect(path)
+    try:
+        with conn:
+            return conn.execute("DELETE FROM idempotency WHERE created_at < ?", (int(time.time() - ttl),)).rowcount
+    finally:
+        conn.close()
+
+def reshard(count, path=DATABASE):
+    """Spreads the users and purchases of the current SHARDS shards over count shards, by shard_of() their username.
+    The new shard files are written next to the current ones and put in their place once all are complete. The service
+    must be stopped, and started again with SHARDS=count. The users keep their ids and the new users get ids above all
+    of them. The purchases get new ids above every id of the history and archive files, the archive files are left as
+    they are.
+    :param count: number of shards to spread the users over
+    :type count: int
+    :param path: path of the database file, the first shard
+    :type path: string
+    :return: the number of users in each new shard
+    :rtype: list
+    """
+    old = [shard_path(number, path) for number in range(SHARDS)]
+    new = [shard_path(number, path) for number in range(count)]
+    work = [shard + '.reshard' for shard in new]
+    for shard in work:
+        if os.path.exists(shard):
+            os.remove(shard)
+    sources = [connect(shard) for shard in old]
+    targets = []
+    try:
+        #Everything that is not sharded, like the goods, stays in the first shard
+        copy = sqlite3.connect(work[0])
+        try:
+            sources[0].backup(copy)
+        finally:
+            copy.close()
+        for shard in work[1:]:
+            migrate(shard)
+        targets = [connect(shard) for shard in work]
+        floor = max(conn.execute("SELECT MAX(COALESCE((SELECT MAX(user_id) FROM users), 0), floor) "
+                                 "FROM shard_info").fetchone()[0] for conn in sources)
+        history_id = max(conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM history").fetchone()[0]
+                         for conn in sources)
+        for number in range(max(SHARDS, count)):
+            archive = shard_path(number, ARCHIVE_DATABASE)
+            if os.path.exists(archive):
+                conn = sqlite3.connect(archive)
+                try:
+                    archived = conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM history").fetchone()[0]
+                    history_id = max(history_id, archived)
+                finally:
+                    conn.close()
+        for number, conn in enumerate(targets):
+            conn.execute('BEGIN IMMEDIATE')
+            for table in SHARDED_TABLES:
+                conn.execute("DELETE FROM {}".format(table))
+            conn.execute("UPDATE shard_info SET shard = ?, shards = ?, floor = ?", (number, count, floor))
+        for conn in sources:
+            users = conn.execute("SELECT * FROM users")
+            columns = column_names(users)
+            username = columns.index("username")
+            insert = "INSERT INTO users ({}) VALUES ({})".format(", ".join(columns), ", ".join("?" * len(columns)))
+            for row in users:
+                targets[shard_of(row[username], count)].execute(insert, row)
+            #The history_summary_insert trigger adds up the totals of the recent purchases again
+            for name, item, amount, purchased_at in conn.execute("SELECT name, item, amount, purchased_at FROM history "
+                                                                 "ORDER BY user_id"):
+                history_id += 1
+                targets[shard_of(name, count)].execute(
+                    "INSERT INTO history (user_id, name, item, amount, purchased_at) VALUES (?, ?, ?, ?, ?)",
+                    (history_id, name, item, amount, purchased_at))
+            for row in conn.execute("SELECT name, month, item, total, purchases FROM history_rollup"):
+                targets[shard_of(row[0], count)].execute(
+                    "INSERT INTO history_rollup (name, month, item, total, purchases) VALUES (?, ?, ?, ?, ?)", row)
+        #Copying the rows recorded them all as changes. They are dropped, and the changes of every new shard start
+        #after every change of the old shards, so no cursor of the old shards can read the new ones.
+        changes = max(conn.execute(CHANGES_SEQ).fetchone()[0] for conn in sources + targets)
+        users = []
+        for conn in targets:
+            conn.execute("DELETE FROM changes")
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = 'changes'")
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('changes', ?)", (changes,))
+            conn.execute("DELETE FROM history_summary")
+            conn.execute(REBUILD_HISTORY_SUMMARY)
+            users.append(conn.execute("SELECT COUNT(*) FROM users").fetchone()[0])
+        for conn in targets:
+            conn.commit()
+    finally:
+        for conn in sources + targets:
+            conn.close()
+    for number, shard in enumerate(new):
+        for journal in (shard + '-wal', shard + '-shm'):
+            if os.path.exists(journal):
+                os.remove(journal)
+        os.replace(work[number], shard)
+    #The shards that are no longer used are kept aside rather than deleted
+    for shard in old[count:]:
+        os.replace(shard, shard + '.resharded')
+    return users
+
+
+class ChangesGone(Exception):
+    """Raised when the changes after a cursor are no longer kept, or the cursor is ahead of the changes after a
+    restore, so a consumer must reload its copy of the rows and continue from the current cursor
+    :param cursor: the current cursor, after the last change of every shard
+    :type cursor: string
+    """
+    def __init__(self, message, cursor):
+        super().__init__(message)
+        self.cursor = cursor
+
+
+def format_cursor(seqs):
+    """Returns the cursor of the change feed after the given change of every shard
+    :param seqs: seq of the last change read from each shard
+    :type seqs: list
+    :rtype: string
+    """
+    return ".".join(str(seq) for seq in seqs)
+
+
+def current_cursor(tables=CHANGE_TABLES):
+    """Returns the cursor after the last change of every shard
+    :rtype: string
+    """
+    return read_changes(None, 0, tables)[1]
+
+
+def read_changes(cursor, limit=CHANGES_BATCH, tables=CHANGE_TABLES):
+    """Reads the changes of some tables made after a cursor, from the database files and not their read replicas.
+    The changes of a shard come in the order they were committed, the shards follow each other.
+    :param cursor: the cursor returned with the last change read, "0" to read from the oldest change kept, None for no
+        change but the current cursor
+    :type cursor: string
+    :param limit: maximum number of changes to read
+    :type limit: int
+    :param tables: names of the tables whose changes to read
+    :type tables: tuple
+    :raises ValueError: if the cursor is not a cursor
+    :raises ChangesGone: if some changes after the cursor are no longer kept, or it is ahead of the changes
+    :return: the changes, each {"seq", "shard", "table", "key", "operation", "data", "changed_at", "cursor"}, with data
+        None for a deletion, and the cursor after them
+    :rtype: tuple
+    """
+    if cursor is not None:
+        try:
+            seqs = [int(seq) for seq in str(cursor).split(".")]
+        except ValueError:
+            raise ValueError("{} is not a cursor of the change feed".format(cursor))
+        if seqs == [0]:
+            seqs = []
+            for source in shards.pools:
+                with source.connection() as conn:
+                    seqs.append(conn.execute("SELECT COALESCE((SELECT MIN(seq) FROM changes) - 1, ({}))".format(
+                        CHANGES_SEQ)).fetchone()[0])
+    changes, after, gone = [], [], None
+    in_tables = " AND table_name IN ({})".format(", ".join("?" * len(tables)))
+    for number, source in enumerate(shards.pools):
+        with source.connection() as conn:
+            #A single read transaction, so nothing is committed between the bounds and the rows
+            conn.execute('BEGIN')
+            try:
+                last = conn.execute(CHANGES_SEQ).fetchone()[0]
+                first = conn.execute("SELECT COALESCE(MIN(seq), ?) FROM changes", (last + 1,)).fetchone()[0]
+                if cursor is None:
+                    after.append(last)
+                    continue
+                if len(seqs) != shards.count:
+                    gone = "The cursor is for {} shards, the database has {}".format(len(seqs), shards.count)
+                elif seqs[number] + 1 < first:
+                    gone = "The changes of shard {} after {} are no longer kept".format(number, seqs[number])
+                elif seqs[number] > last:
+                    gone = "The cursor is after the last change {} of shard {}".format(last, number)
+                if gone is not None:
+                    after.append(last)
+                    continue
+                rows = conn.execute("SELECT seq, table_name, row_key, operation, data, changed_at FROM changes "
+                                    "WHERE seq > ? AND seq <= ?" + in_tables + " ORDER BY seq LIMIT ?",
+                                    [seqs[number], last, *tables, limit - len(changes)]).fetchall()
+            finally:
+                conn.commit()
+        #The cursor skips the changes of the other tables, up to the last change of the shard once all are read
+        seqs[number] = rows[-1][0] if len(changes) + len(rows) == limit else last
+        for seq, table, key, operation, data, changed_at in rows:
+            changes.append({"seq": seq, "shard": number, "table": table, "key": key, "operation": operation,
+                            "data": None if data is None else json.loads(data), "changed_at": changed_at,
+                            "cursor": format_cursor(seqs[:number] + [seq] + seqs[number + 1:])})
+        after.append(seqs[number])
+        if len(changes) == limit:
+            after += seqs[number + 1:]
+            break
+    if gone is not None:
+        raise ChangesGone(gone, format_cursor(after))
+    return changes, format_cursor(after)
+
+
+def wait_changes(cursor, limit=CHANGES_BATCH, tables=CHANGE_TABLES, wait=0):
+    """Reads the changes made after a cursor, waiting up to wait seconds for one if there is none yet. The writes of
+    every process bump the change counters of their tables, which are watched instead of the changes table.
+    :param cursor: see read_changes()
+    :type cursor: string
+    :param limit: maximum number of changes to read
+    :type limit: int
+    :param tables: names of the tables whose changes to read
+    :type tables: tuple
+    :param wait: seconds to wait for a change
+    :type wait: float
+    :return: the changes and the cursor after them, see read_changes()
+    :rtype: tuple
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        stamp = table_versions.read(tables)
+        changes, cursor = read_changes(cursor, limit, tables)
+        if changes or time.monotonic() >= deadline:
+            return changes, cursor
+        while table_versions.read(tables) == stamp and time.monotonic() < deadline:
+            time.sleep(CHANGES_POLL_INTERVAL)
+
+
+def change_tables(names):
+    """Returns the tables of the changes asked for in a comma separated list, every table of the feed if it is empty
+    :param names: names of tables separated by commas
+    :type names: string
+    :raises ValueError: if a table of the list has no changes recorded
+    :rtype: tuple
+    """
+    if not names:
+        return CHANGE_TABLES
+    tables = tuple(dict.fromkeys(name.strip() for name in names.split(",")))
+    for table in tables:
+        if table not in CHANGE_TABLES:
+            raise ValueError("The changes of {} are not recorded".format(table))
+    return tables
+
+
+def change_events(cursor, tables=CHANGE_TABLES):
+    """Streams the changes made after a cursor as server-sent events, each with its cursor as id, until the client goes
+    away. A comment is sent when nothing changed for CHANGES_HEARTBEAT seconds, so proxies keep the stream open.
+    :param cursor: see read_changes(), None to start at the current cursor
+    :type cursor: string
+    :param tables: names of the tables whose changes to stream
+    :type tables: tuple
+    :return: the events
+    :rtype: generator
+    """
+    try:
+        if cursor is None:
+            cursor = current_cursor(tables)
+        while True:
+            changes, cursor = wait_changes(cursor, CHANGES_BATCH, tables, CHANGES_HEARTBEAT)
+            if not changes:
+                yield ": heartbeat\n\n"
+            for change in changes:
+                yield "id: {}\nevent: change\ndata: {}\n\n".format(change["cursor"], json.dumps(change))
+    except ChangesGone as e:
+        yield "id: {}\nevent: gone\ndata: {}\n\n".format(e.cursor, json.dumps({"error": str(e),
+                                                                                  "cursor": e.cursor}))
+    except sqlite3.Error as e:
+        app.logger.error("Change stream stopped: %s", e)
+
+
+class UnknownOperation(Exception):
+    pass
+
+
+class IdempotencyConflict(Exception):
+    pass
+
+
+def request_digest(request):
+    """Returns a short digest of the operations and arguments of a write, the same in every process
+    :param request: the operations and arguments of the write, encodable as json
+    :rtype: bytes
+    """
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).digest()[:16]
+
+
+def idempotent(job, key, request, ttl=IDEMPOTENCY_TTL):
+    """Wraps a job of the writer thread so that it runs once per idempotency key. Its result is kept in the
+    idempotency table by the same transaction as its changes, so it is kept exactly when the changes are committed. A
+    job run again with the same key within ttl seconds returns the kept result without changing anything, which makes
+    it safe for the other services to retry a write whose answer they did not get. A job that fails keeps nothing and
+    runs again when retried.
+    :param job: the job, called with the connection of the writer
+    :type job: function
+    :param key: the idempotency key
+    :type key: string
+    :param request: digest of the operations and arguments of the write, see request_digest()
+    :type request: bytes
+    :param ttl: seconds a result is kept
+    :type ttl: float
+    :raises IdempotencyConflict: if the key was already used for another write
+    :return: the wrapped job
+    :rtype: function
+    """
+    def run(conn):
+        kept = conn.execute("SELECT request, result FROM idempotency WHERE key = ? AND created_at >= ?",
+                            (key, int(time.time() - ttl))).fetchone()
+        if kept is not None:
+            if kept[0] != request:
+                raise IdempotencyConflict("The idempotency key {} was used for another write".format(key))
+            return json.loads(kept[1])
+        result = job(conn)
+        conn.execute("INSERT OR REPLACE INTO idempotency (key, request, result) VALUES (?, ?, ?)",
+                     (key, request, json.dumps(result)))
+        return result
+    return run
+
+
+class LatencyHistogram:
+    """Counts latencies in buckets growing by a factor of 2 ** (1 / 4), from 10 microseconds up to about 20 seconds, so
+    that percentiles can be estimated within 19% from a fixed amount of memory. Each process of the service counts the
+    latencies of the requests it served.
+    """
+    SMALLEST = 0.00001
+    BUCKETS = 85
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.total = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """Counts one latency
+        :param seconds: the latency
+        :type seconds: float
+        """
+        bucket = math.ceil(4 * math.log2(seconds / self.SMALLEST)) if seconds > self.SMALLEST else 0
+        self.counts[min(bucket, self.BUCKETS - 1)] += 1
+        self.total += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the p-th percentile of the latencies, in seconds, or the
+        largest latency counted when it is lower, so a percentile never exceeds the maximum
+        :param p: the percentile, between 0 and 100
+        :type p: float
+        :rtype: float
+        """
+        rank = math.ceil(self.total * p / 100)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return min(self.SMALLEST * 2 ** (bucket / 4), self.max)
+        return 0.0
+
+
+#The statements that ran for at least SLOW_QUERY_MS, newest last
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+
+def records(columns, rows):
+    """Serializes rows as a list of {column: value} dictionaries
+    :param columns: names of the columns, read from the cursor
+    :type columns: list
+    :param rows: rows returned by the cursor
+    :type rows: list of tuples
+    :rtype: list of dictionaries
+    """
+    return [dict(zip(columns, row)) for row in rows]
+
+def columnar(columns, rows):
+    """Serializes rows in the compact columnar format, {"columns": [names], "rows": [[values], ...]}, which sends the
+    column names once instead of once per row and keeps the tuples returned by SQLite as they are
+    :param columns: names of the columns, read from the cursor
+    :type columns: list
+    :param rows: rows returned by the cursor
+    :type rows: list of tuples
+    :rtype: dictionary
+    """
+    return {"columns": columns, "rows": rows}
+
+def pairs(columns, rows):
+    """Serializes rows of two columns as a {first column: second column} dictionary
+    :param columns: names of the columns, read from the cursor
+    :type columns: list
+    :param rows: rows returned by the cursor
+    :type rows: list of tuples
+    :rtype: dictionary
+    """
+    return dict(rows)
+
+def nested(columns, rows):
+    """Serializes rows of three columns as a {first column: {second column: third column}} dictionary
+    :param columns: names of the columns, read from the cursor
+    :type columns: list
+    :param rows: rows returned by the cursor
+    :type rows: list of tuples
+    :rtype: dictionary
+    """
+    result = {}
+    for first, second, third in rows:
+        result.setdefault(first, {})[second] = third
+    return result
+
+def column_names(cur):
+    """Returns the names of the columns of the last statement executed by a cursor
+    :rtype: list
+    """
+    return [column[0] for column in cur.description]
+
+
+class Operation:
+    """A named database operation that the other services call by its id instead of sending SQL. The statement text
+    never changes, so sqlite3 prepares it once per pooled connection and keeps it in the statement cache.
+    :param name: id of the operation, for example user.by_username
+    :type name: string
+    :param sql: the statement run by the operation
+    :type sql: string
+    :param fetch: "one" for a single row, "all" for every row, "page" for one page of rows, None for writes which return
+        the number of changed rows
+    :type fetch: string
+    :param serializer: turns the column names and the rows of an "all" or "page" operation into its result, records()
+        by default. "one" operations always return a {column: value} dictionary, {} if there is no row
+    :type serializer: function
+    :param key: column a "page" operation is ordered by. Its last two arguments are the key to start after and the
+        page size, and its result is {"rows": [rows], "next_after": key of the last row, None on the last page}
+    :type key: string
+    :param tables: tables the statement reads, or writes, triggers included. They tag the cached results of a read and
+        invalidate them when a write commits.
+    :type tables: tuple
+    :param shard_by: indexes of the arguments holding the username of the user an operation on the SHARDED_TABLES
+        reads or writes, they must all name users of the same shard. A read without them runs on every shard, its
+        results are merged in the order of its key, see merge_shards().
+    :type shard_by: tuple
+    """
+    def __init__(self, name, sql, fetch=None, serializer=records, key=None, tables=(), shard_by=None):
+        self.name = name
+        self.sql = sql
+        self.fetch = fetch
+        self.serializer = serializer
+        self.key = key
+        self.tables = tables
+        self.shard_by = shard_by
+        self.calls = 0
+        self.errors = 0
+        self.error_types = {}
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = LatencyHistogram()
+        self._lock = threading.Lock()
+
+    @property
+    def is_write(self):
+        return self.fetch is None
+
+    def run(self, cur, args, format=None):
+        """Executes the operation on a cursor and serializes its result
+        :param cur: cursor of a pooled connection
+        :type cur: sqlite3.Cursor
+        :param args: parameters bound to the statement
+        :type args: list
+        :param format: "columnar" to get the rows of an "all" or "page" operation returning records in the columnar
+            format, see columnar()
+        :type format: string
+        :return: a dictionary for "one" and "page" operations and writes, the serialized rows for "all" operations
+        """
+        serializer = columnar if format == "columnar" and self.serializer is records else self.serializer
+        start = time.perf_counter()
+        error = None
+        count = 0
+        try:
+            cur.execute(self.sql, args)
+            if self.fetch == "one":
+                row = cur.fetchone()
+                count = 0 if row is None else 1
+                result = dict(zip(column_names(cur), row)) if row is not None else {}
+            elif self.fetch == "all":
+                rows = cur.fetchall()
+                count = len(rows)
+                result = serializer(column_names(cur), rows)
+            elif self.fetch == "page":
+                rows = cur.fetchall()
+                count = len(rows)
+                columns = column_names(cur)
+                result = serializer(columns, rows) if serializer is columnar else {"rows": serializer(columns, rows)}
+                result["next_after"] = rows[-1][columns.index(self.key)] if rows and len(rows) == args[-1] else None
+            else:
+                count = cur.rowcount
+                result = {"rowcount": cur.rowcount}
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(time.perf_counter() - start, error, count, args)
+        return result
+
+    def run_many(self, cur, rows):
+        """Executes a write operation once for each list of arguments, in a single executemany call which prepares the
+        statement once and stays in SQLite between the rows
+        :param cur: cursor of a connection inside a transaction
+        :type cur: sqlite3.Cursor
+        :param rows: the arguments of each execution
+        :type rows: list of lists
+        :return: {"rowcount": number of rows changed by all the executions}
+        :rtype: dictionary
+        """
+        start = time.perf_counter()
+        error = None
+        count = 0
+        try:
+            cur.executemany(self.sql, rows)
+            count = cur.rowcount
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(time.perf_counter() - start, error, count, rows[0] if rows else ())
+        return {"rowcount": count}
+
+    def stream(self, cur, args, size=STREAM_BATCH_SIZE):
+        """Executes an "all" operation and yields its rows as records a few hundred at a time, so the whole result is
+        never held in memory
+        :param cur: cursor of a pooled connection, busy until the generator is exhausted or closed
+        :type cur: sqlite3.Cursor
+        :param args: parameters bound to the statement
+        :type args: list
+        :param size: number of rows fetched from SQLite at a time
+        :type size: int
+        :return: lists of {column: value} dictionaries
+        :rtype: generator
+        """
+        #Only the time spent in SQLite is counted, not the time the caller takes to send each batch
+        elapsed = 0.0
+        error = None
+        count = 0
+        try:
+            start = time.perf_counter()
+            cur.execute(self.sql, args)
+            columns = column_names(cur)
+            rows = cur.fetchmany(size)
+            elapsed += time.perf_counter() - start
+            while rows:
+                count += len(rows)
+                yield records(columns, rows)
+                start = time.perf_counter()
+                rows = cur.fetchmany(size)
+                elapsed += time.perf_counter() - start
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(elapsed, error, count, args)
+
+    def _record(self, elapsed, error, count, args):
+        with self._lock:
+            self.calls += 1
+            self.rows += count
+            self.total_time += elapsed
+            if elapsed > self.max_time:
+                self.max_time = elapsed
+            self.histogram.record(elapsed)
+            if error is not None:
+                self.errors += 1
+                name = type(error).__name__
+                self.error_types[name] = self.error_types.get(name, 0) + 1
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            #Only the types of the parameters are kept, their values can be passwords
+            entry = {"op": self.name, "statement": self.sql, "args": [type(arg).__name__ for arg in args],
+                     "ms": round(elapsed * 1000, 3), "rows": count, "error": str(error) if error is not None else None,
+                     "at": time.time()}
+            slow_queries.append(entry)
+            app.logger.warning("Slow statement %s: %.3fms, %d rows, args %s%s", self.name, entry["ms"], count,
+                               entry["args"], ", failed: {}".format(error) if error is not None else "")
+
+    def stats(self):
+        """Returns the call count, error counts, row count and latency percentiles of the operation
+        :rtype: dictionary
+        """
+        with self._lock:
+            return {"statement": self.sql, "calls": self.calls, "errors": self.errors,
+                    "error_types": dict(self.error_types), "rows": self.rows,
+                    "avg_ms": round(self.total_time * 1000 / self.calls, 3) if self.calls else 0,
+                    "p50_ms": round(self.histogram.percentile(50) * 1000, 3),
+                    "p95_ms": round(self.histogram.percentile(95) * 1000, 3),
+                    "p99_ms": round(self.histogram.percentile(99) * 1000, 3),
+                    "max_ms": round(self.max_time * 1000, 3)}
+
+
+USERS = ("users",)
+GOODS = ("goods",)
+#A new user of shard k gets the next id equal to k modulo the number of shards, above every id of the shard and every
+#id given before the file was last resharded, so the ids stay unique across shards. With one shard it is the next rowid.
+NEXT_USER_ID = "(MAX(COALESCE((SELECT MAX(user_id) FROM users), 0), floor) / shards + 1) * shards + shard"
+def price_listing(name, by_category, descending):
+    """Builds an operation listing one page of the goods in a price band, cheapest or dearest first, from the
+    goods_category_price or the goods_price index. Its arguments are the category, ignored without by_category, the
+    lowest and the highest price, the lowest count, the name of the last good of the previous page or None on the
+    first page, and the page size. The next page starts at the price of the last good instead of the band limit, so
+    every page costs the same to read however deep into the listing it is.
+    :param name: id of the operation
+    :type name: string
+    :param by_category: True to only list the goods of the category, whatever its case
+    :type by_category: bool
+    :param descending: True to list the dearest goods first
+    :type descending: bool
+    :rtype: Operation
+    """
+    #Ties on the price are broken by the name, which is unique, so no good is listed twice or skipped
+    start, after, order = ("?3", "<", "DESC") if descending else ("?2", ">", "ASC")
+    sql = ("SELECT user_id, name, category, price, count FROM goods "
+           "WHERE {}price BETWEEN ?2 AND ?3 AND count >= ?4 AND (price <> {} OR ?5 IS NULL OR name {} ?5) "
+           "ORDER BY price {}, name {} LIMIT ?6").format("category = ?1 COLLATE NOCASE AND " if by_category else
+                                                           "?1 IS ?1 AND ", start, after, order, order)
+    return Operation(name, sql, "page", key="name", tables=GOODS)
+
+
+OPERATIONS = {op.name: op for op in [
+    Operation("user.list", "SELECT * FROM users", "all", key="user_id", tables=USERS),
+    Operation("user.page", "SELECT * FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", "page", key="user_id",
+              tables=USERS),
+    Operation("user.by_username", "SELECT * FROM users WHERE username = ?", "one", tables=USERS, shard_by=(0,)),
+    Operation("user.insert", "INSERT INTO users (user_id, fullname, username, password, age, address, gender, marital_status, wallet) SELECT " + NEXT_USER_ID + ", ?, ?, ?, ?, ?, ?, ?, 0 FROM shard_info", tables=USERS, shard_by=(1,)),
+    Operation("user.update", "UPDATE users SET fullname = ?, username = ?, password= ?, age= ?, address= ?, gender= ?, marital_status= ? WHERE username =?", tables=USERS, shard_by=(7, 1)),
+    Operation("user.add_wallet", "UPDATE users SET wallet = wallet + ? WHERE username = ?", tables=USERS, shard_by=(1,)),
+    Operation("user.deduct_wallet", "UPDATE users SET wallet = wallet - ? WHERE username = ? AND wallet >= ? AND ? > 0", tables=USERS, shard_by=(1,)),
+    Operation("user.delete", "DELETE FROM users WHERE username = ?", tables=USERS, shard_by=(0,)),
+    #Bulk imports skip the rows whose username or name is already taken instead of failing the whole chunk
+    Operation("user.import", "INSERT INTO users (user_id, fullname, username, password, age, address, gender, marital_status, wallet) SELECT " + NEXT_USER_ID + ", ?, ?, ?, ?, ?, ?, ?, ? FROM shard_info WHERE true ON CONFLICT (username) DO NOTHING", tables=USERS, shard_by=(1,)),
+    Operation("goods.list", "SELECT * FROM goods", "all", tables=GOODS),
+    Operation("goods.list_prices", "SELECT name, price FROM goods ORDER BY user_id", "all", tables=GOODS),
+    Operation("goods.page_prices", "SELECT user_id, name, price FROM goods WHERE user_id > ? ORDER BY user_id LIMIT ?",
+              "page", key="user_id", tables=GOODS),
+    Operation("goods.by_name", "SELECT * FROM goods WHERE name = ?", "one", tables=GOODS),
+    price_listing("goods.by_price", False, False),
+    price_listing("goods.by_price_desc", False, True),
+    price_listing("goods.by_category_price", True, False),
+    price_listing("goods.by_category_price_desc", True, True),
+    #Takes an FTS5 query, a page size and an offset. The best matches come first, by bm25 with a word found in the name
+    #weighing ten times one found in the description.
+    Operation("goods.search", "SELECT goods.* FROM goods_search JOIN goods ON goods.user_id = goods_search.rowid "
+              "WHERE goods_search MATCH ? ORDER BY bm25(goods_search, 10.0, 1.0) LIMIT ? OFFSET ?", "all",
+              tables=GOODS),
+    Operation("goods.insert", "INSERT INTO goods (name, category, price, description, count) VALUES (?, ?, ?, ?, ?)", tables=GOODS),
+    Operation("goods.update", "UPDATE goods SET name = ?, category = ?, price= ?, description= ?, count= ? WHERE name =?", tables=GOODS),
+    Operation("goods.deduct", "UPDATE goods SET count = count - ? WHERE name = ? AND count >= ? AND ? > 0", tables=GOODS),
+    Operation("goods.import", "INSERT INTO goods (name, category, price, description, count) VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO NOTHING", tables=GOODS),
+    #The history_summary_insert trigger updates the totals in the same statement
+    Operation("history.insert", "INSERT INTO history (name, item, amount, purchased_at) "
+              "VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))", tables=("history", "history_summary"),
+              shard_by=(0,)),
+    Operation("history.by_user", "SELECT item, total FROM history_summary WHERE name = ?", "all", pairs,
+              tables=("history_summary",), shard_by=(0,)),
+    #The months of the archived purchases come from their totals, the recent purchases are grouped by month
+    Operation("history.monthly", "SELECT month, item, SUM(total) FROM ("
+              "SELECT month, item, total FROM history_rollup WHERE name = ?1 UNION ALL "
+              "SELECT strftime('%Y-%m', purchased_at, 'unixepoch'), item, amount FROM history WHERE name = ?1) "
+              "GROUP BY month, item ORDER BY month, item", "all", nested, tables=("history", "history_rollup"),
+              shard_by=(0,)),
+    #A result kept under a key by another service, like the price of a sale, for the same time as the results of the
+    #writes. The first one kept under a key stays, and request tells what it was kept for.
+    Operation("idempotency.keep", "INSERT INTO idempotency (key, request, result) VALUES (?, ?, ?) "
+              "ON CONFLICT (key) DO NOTHING", tables=("idempotency",)),
+    Operation("idempotency.by_key", "SELECT request, result FROM idempotency WHERE key = ?", "one",
+              tables=("idempotency",)),
+]}
+
+
+def get_operation(query, write=None):
+    """Looks up the operation named in a request
+    :param query: body of the request, {"op": name, "args": [parameters]}
+    :type query: dictionary
+    :param write: True if the request came through a write endpoint, False for the read endpoint, None for a batch
+    :type write: bool
+    :raises UnknownOperation: if no operation has that name, or if it is a read sent to a write endpoint or the opposite
+    :return: the operation
+    :rtype: Operation
+    """
+    op = OPERATIONS.get(query.get("op"))
+    if op is None or (write is not None and op.is_write != write):
+        raise UnknownOperation("Unknown operation {}".format(query.get("op")))
+    return op
+
+
+def error_status(e):
+    """Maps a database error to the http status returned to the caller
+    :param e: the error raised while running an operation
+    :type e: sqlite3.Error
+    :rtype: int
+    """
+    if isinstance(e, sqlite3.ProgrammingError):
+        return 400
+    if isinstance(e, sqlite3.IntegrityError):
+        return 409
+    if isinstance(e, WriterUnavailable):
+        return 503
+    if isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e)):
+        #The write lock was not released in time, the request can be retried
+        return 503
+    return 500
+
+
+
+def diagnostics():
+    """Describes how the service runs SQLite: the profile, the settings it asks for, the settings SQLite applied to a
+    read connection and to a writing connection, and the size of the database
+    :rtype: dictionary
+    """
+    with pool.connection() as conn:
+        read = applied_settings(conn)
+        pages = {name: conn.execute('PRAGMA {}'.format(name)).fetchone()[0]
+                 for name in ('page_size', 'page_count', 'freelist_count')}
+    conn = connect(DATABASE)
+    try:
+        write = applied_settings(conn)
+    finally:
+        conn.close()
+    return {"sqlite_version": sqlite3.sqlite_version,
+            "profile": SQLITE_PROFILE,
+            "settings": SQLITE_SETTINGS,
+            "read_connection": read,
+            "write_connection": write,
+            "database": dict(pages, path=os.path.abspath(DATABASE), bytes=pages['page_size'] * pages['page_count'])}
+
+
+def merge_shards(op, results, args, format=None):
+    """Merges the results of a read operation run on every shard into its result on a single database: the row found
+    for a "one" operation, the rows of every shard in the order of the key of the operation for the others. A page
+    keeps the first rows of the merged pages, up to the page size.
+    :param op: the operation
+    :type op: Operation
+    :param results: the result of the operation on each shard
+    :type results: list
+    :param args: parameters of the operation
+    :type args: list
+    :param format: format of the results, see Operation.run()
+    :type format: string
+    """
+    if op.fetch == "one":
+        return next((result for result in results if result), {})
+    if format == "columnar" and op.serializer is records:
+        index = results[0]["columns"].index(op.key)
+        rows = sorted((row for result in results for row in result["rows"]), key=lambda row: row[index])
+        merged = {"columns": results[0]["columns"], "rows": rows}
+    else:
+        pages = results if op.fetch == "all" else [result["rows"] for result in results]
+        rows = sorted((row for page in pages for row in page), key=lambda row: row[op.key])
+        merged = rows if op.fetch == "all" else {"rows": rows}
+        index = op.key
+    if op.fetch == "page":
+        del rows[args[-1]:]
+        merged["next_after"] = rows[-1][index] if rows and len(rows) == args[-1] else None
+    return merged
+
+
+def execute_read(query, mimetype=JSON):
+    """Runs the read operation named in a request on a pooled connection and encodes its result. The result is served
+    from the result cache while the tables the operation reads have not changed, and cached for the next identical
+    read otherwise.
+    :param query: body of the request, {"op": name, "args": [parameters], "format": "columnar" to get rows in the
+        columnar format, "max_staleness": seconds of staleness a read accepts from a replica}
+    :type query: dictionary
+    :param mimetype: format of the encoded result, MSGPACK or JSON
+    :type mimetype: string
+    :return: the encoded result and the http status
+    """
+    try:
+        op = get_operation(query, False)
+    except UnknownOperation as e:
+        return encode({"error": str(e)}, mimetype), 400
+    args = query.get("args", ())
+    format = query.get("format")
+    try:
+        number = shards.route(op, args)
+    except ShardError as e:
+        return encode({"error": str(e)}, mimetype), 400
+    key = None
+    if result_cache.enabled:
+        try:
+            key = (op.name, tuple(args), format, mimetype)
+            hash(key)
+        except TypeError:
+            key = None
+    if key is not None:
+        body = result_cache.get(key, op.tables)
+        if body is not None:
+            return body, 200
+        stamp = table_versions.read(op.tables)
+    max_staleness = query.get("max_staleness", REPLICA_MAX_STALENESS)
+    sources = [shards.reader(n, max_staleness) for n in (range(shards.count) if number is None else (number,))]
+    try:
+        results = []
+        for source in sources:
+            with source.connection() as conn:
+                results.append(op.run(conn.cursor(), args, format))
+    except sqlite3.Error as e:
+        status = error_status(e)
+        #A failed read still answers {}, which the other services treat as not found
+        return encode({"error": str(e)} if status != 500 else {}, mimetype), status
+    body = encode(results[0] if number is not None else merge_shards(op, results, args, format), mimetype)
+    #A replica can be older than the table counters say, only results read from the database itself are cached
+    if key is not None and all(source in shards.pools for source in sources):
+        result_cache.put(key, body, op.tables, stamp)
+    return body, 200
+
+
+def queue_write(query):
+    """Queues the write operation named in a request on the writer thread of its shard, without waiting for it. A
+    request with an idempotency key runs once per key, see idempotent().
+    :param query: body of the request, {"op": name, "args": [parameters], "idempotency_key": key}
+    :type query: dictionary
+    :raises UnknownOperation: if the request names no write operation
+    :raises ShardError: if the arguments of the operation do not pick a shard, see Shards.route()
+    :return: the future result of the operation
+    :rtype: concurrent.futures.Future
+    """
+    op = get_operation(query, True)
+    args = query.get("args", ())
+    number = shards.route(op, args)
+    archiver.start()
+    pruner.start()
+    job = lambda conn: op.run(conn.cursor(), args)
+    if query.get("idempotency_key") is not None:
+        job = idempotent(job, str(query["idempotency_key"]), request_digest([op.name, args]))
+    return shards.writers[number].enqueue(job, op.tables)
+
+
+def execute_write(query):
+    """Runs the write operation named in a request through the writer thread
+    :param query: body of the request, {"op": name, "args": [parameters], "idempotency_key": key}
+    :type query: dictionary
+    :return: the result of the operation and the http status
+    """
+    try:
+        future = queue_write(query)
+    except (UnknownOperation, ShardError) as e:
+        return {"error": str(e)}, 400
+    try:
+        return write_result(future), 200
+    except IdempotencyConflict as e:
+        return {"error": str(e)}, 422
+    except sqlite3.Error as e:
+        return {"error": str(e)}, error_status(e)
+
+
+def execute_bulk(query):
+    """Runs a write operation once for each row of arguments, with executemany and in a single transaction through
+    the writer thread. Bulk imports send their rows in chunks of a few thousand, one request per chunk. The rows of
+    users of different shards are written by the writer of their shard, in one transaction per shard.
+    :param query: body of the request, {"op": name, "rows": [[parameters], ...]}
+    :type query: dictionary
+    :return: {"rowcount": number of rows changed} and the http status
+    """
+    try:
+        op = get_operation(query, True)
+    except UnknownOperation as e:
+        return {"error": str(e)}, 400
+    rows = query.get("rows")
+    if not isinstance(rows, list):
+        return {"error": "A bulk write needs a list of rows"}, 400
+    groups = {}
+    try:
+        for row in rows:
+            groups.setdefault(shards.route(op, row), []).append(row)
+    except ShardError as e:
+        return {"error": str(e)}, 400
+    try:
+        count = 0
+        for number, group in groups.items():
+            result = shards.writers[number].submit(lambda conn, group=group: op.run_many(conn.cursor(), group), op.tables)
+            count += result["rowcount"]
+        return {"rowcount": count}, 200
+    except sqlite3.Error as e:
+        return {"error": str(e)}, error_status(e)
+
+
+class BatchAborted(Exception):
+    """Raised when an operation of a batch run with abort_on_error fails
+    :param index: position of the failed operation in the batch
+    :type index: int
+    :param results: results of the operations run before it
+    :type results: list
+    :param error: the error raised by the operation
+    :type error: sqlite3.Error
+    """
+    def __init__(self, index, results, error):
+        super().__init__(str(error))
+        self.index = index
+        self.results = results
+        self.error = error
+
+
+def run_batch(cur, ops, abort):
+    """Runs the operations of a batch in order on a cursor that is already inside a transaction
+    :param cur: cursor of the connection running the batch
+    :type cur: sqlite3.Cursor
+    :param ops: (operation, arguments, format) of every operation of the batch
+    :type ops: list
+    :param abort: True to stop at the first failing operation, False to only roll back the failing operation
+    :type abort: bool
+    :raises BatchAborted: if an operation fails and abort is True
+    :return: the result of each operation, {"error": message} for the ones that failed
+    :rtype: list
+    """
+    results = []
+    for i, (op, args, format) in enumerate(ops):
+        if not abort:
+            cur.execute('SAVEPOINT batch_op')
+        try:
+            results.append(op.run(cur, args, format))
+        except sqlite3.Error as e:
+            if abort:
+                raise BatchAborted(i, results, e)
+            cur.execute('ROLLBACK TO batch_op')
+            results.append({"error": str(e)})
+        if not abort:
+            cur.execute('RELEASE batch_op')
+    return results
+
+
+def execute_batch(query):
+    """Runs a list of operations in order and inside one transaction, through the writer thread if any of them writes.
+    With abort_on_error, the default, the first failing operation rolls back the whole batch. Without it, only the
+    failing operation is rolled back, its result is replaced by an error, and the others are committed. All the
+    operations of a batch must run on the same shard. A batch that writes with an idempotency key runs once per key,
+    see idempotent().
+    :param query: body of the request, {"ops": [{"op": name, "args": [parameters]}, ...], "abort_on_error": bool,
+        "max_staleness": seconds of staleness a batch of reads accepts from a replica, "idempotency_key": key}
+    :type query: dictionary
+    :return: the results of the operations, in order, and the http status
+    """
+    try:
+        ops = [(get_operation(item), item.get("args", ()), item.get("format")) for item in query["ops"]]
+    except UnknownOperation as e:
+        return {"error": str(e)}, 400
+    except (KeyError, TypeError, AttributeError):
+        return {"error": "A batch needs a list of operations in ops"}, 400
+    abort = query.get("abort_on_error", True)
+    try:
+        numbers = {shards.route(op, args) for op, args, format in ops}
+    except ShardError as e:
+        return {"error": str(e)}, 400
+    if len(numbers) > 1 or None in numbers:
+        return {"error": "The operations of a batch must all run on the same shard"}, 400
+    number = numbers.pop() if numbers else 0
+    try:
+        if any(op.is_write for op, args, format in ops):
+            tables = {table for op, args, format in ops if op.is_write for table in op.tables}
+            job = lambda conn: run_batch(conn.cursor(), ops, abort)
+            if query.get("idempotency_key") is not None:
+                job = idempotent(job, str(query["idempotency_key"]),
+                                 request_digest([[op.name, args, format] for op, args, format in ops] + [abort]))
+            results = shards.writers[number].submit(job, tables)
+        else:
+            with shards.reader(number, query.get("max_staleness", REPLICA_MAX_STALENESS)).connection() as conn:
+                #A single read transaction gives every operation the same snapshot
+                conn.execute('BEGIN')
+                results = run_batch(conn.cursor(), ops, abort)
+                conn.commit()
+        return {"results": results}, 200
+    except BatchAborted as e:
+        return {"results": e.results, "failed": e.index, "error": str(e.error)}, error_status(e.error)
+    except IdempotencyConflict as e:
+        return {"error": str(e)}, 422
+    except sqlite3.Error as e:
+        return {"error": str(e)}, error_status(e)
+
+
+def stream(query):
+    """Runs a read operation returning every row and encodes its rows as newline delimited json while they are
+    fetched. The pooled connection is held until the last row is sent or the client goes away. An operation running
+    on every shard streams the rows of one shard after the other.
+    :param query: body of the request, {"op": name, "args": [parameters]}
+    :type query: dictionary
+    :return: lines of json, one per row
+    :rtype: generator
+    """
+    op = get_operation(query, False)
+    args = query.get("args", ())
+    number = shards.route(op, args)
+    for shard in range(shards.count) if number is None else (number,):
+        source = shards.reader(shard, query.get("max_staleness", REPLICA_MAX_STALENESS))
+        conn = source.acquire()
+        batches = op.stream(conn.cursor(), args)
+        try:
+            for rows in batches:
+                yield "".join(json.dumps(row) + "\n" for row in rows)
+        except sqlite3.Error as e:
+            app.logger.error("Stream of %s stopped: %s", op.name, e)
+            return
+        finally:
+            batches.close()
+            source.release(conn)
+
+
+def streamable(query):
+    """Tells whether a request names an operation that can be streamed, a read returning every row as records
+    :param query: body of the request, {"op": name, "args": [parameters]}
+    :type query: dictionary
+    :rtype: bool
+    """
+    op = OPERATIONS.get(query.get("op"))
+    return op is not None and op.fetch == "all" and op.serializer is records
+
+
+def service_stats():
+    """Returns the connection pool, writer and result cache counters, the latency percentiles and errors of every
+    operation, and the last slow statements of this process. Served by several worker processes, each request gets the
+    counters of the worker that answers it, they are not added up across workers.
+    :rtype: dictionary
+    """
+    return {"pool": pool.stats(),
+            "writer": writer.stats(),
+            "replicas": replicas.stats(),
+            "result_cache": result_cache.stats(),
+            "snapshots": snapshots.stats(),
+            "archiver": archiver.stats(),
+            "pruner": pruner.stats(),
+            "shards": shards.stats(),
+            "operations": {name: op.stats() for name, op in OPERATIONS.items()},
+            "slow_queries": list(slow_queries)}
+
+
+@app.route('/api/get',methods=['GET'])
+def api_get():
+    '''Receives API Get requests from other containers and process them
+    '''
+    mimetype = response_mimetype()
+    body, status = execute_read(request.get_json(), mimetype)
+    return Response(body, status, mimetype=mimetype)
+
+@app.route('/api/stream',methods=['GET'])
+def api_stream():
+    '''Receives API Get requests for whole tables from other containers and streams the rows back as they are read
+    '''
+    query = request.get_json()
+    if not streamable(query):
+        return respond({"error": "Operation {} cannot be streamed".format(query.get("op"))}, 400)
+    return Response(stream(query), mimetype='application/x-ndjson')
+
+@app.route('/api/post',methods=['POST'])
+def api_post():
+    '''Receives API POST requests from other containers and process them
+    '''
+    result, status = execute_write(request.get_json())
+    return respond(result, status)
+
+@app.route('/api/put',methods=['PUT'])
+def api_put():
+    '''Receives API PUT requests from other containers and process them
+    '''
+    result, status = execute_write(request.get_json())
+    return respond(result, status)
+
 @app.route('/api/delete',methods=['DELETE'])
 def api_delete():
     '''Receives API DELETE requests from other containers and process them
     '''
+    result, status = execute_write(request.get_json())
+    return respond(result, status)
+
+@app.route('/api/batch',methods=['POST'])
+def api_batch():
+    '''Receives a list of operations from other containers and runs them in a single transaction
+    '''
+    result, status = execute_batch(request.get_json())
+    return respond(result, status)
+
+@app.route('/api/bulk',methods=['POST'])
+def api_bulk():
+    '''Receives rows to write in bulk from other containers, see execute_bulk()
+    '''
+    result, status = execute_bulk(request.get_json())
+    return respond(result, status)
+
+@app.route('/api/snapshot',methods=['GET', 'POST'])
+def api_snapshot():
+    '''POST starts a snapshot of the database in the background, GET reports the snapshots, see Snapshots
+    '''
+    if request.method == 'POST':
+        try:
+            snapshots.start()
+        except (SnapshotRunning, SnapshotUnsupported) as e:
+            return respond({"error": str(e)}, 409)
+        return respond({"status": "Snapshot started"}, 202)
+    return respond(snapshots.stats())
+
+@app.route('/api/changes',methods=['GET'])
+def api_changes():
+    '''Serves the changes of the users, goods and purchases made after ?since=<cursor>, or the Last-Event-ID of a
+    reconnecting event stream, only those of ?tables=<names> if given. Callers accepting text/event-stream get every
+    change as a server-sent event, see change_events(). The others get {"changes": [...], "cursor": cursor} at once, or
+    as soon as a change is made within ?wait=<seconds>, see wait_changes(). A cursor whose changes are no longer kept
+    gets 410 and the current cursor.
+    '''
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('since')
     try:
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        query = request.get_json()
-        cur.execute(query["1"],tuple(query["2"]))
-        conn.commit()
-    except:
-        conn.rollback()
-    finally:
-        conn.close()
-        return {}
-    
+        tables = change_tables(request.args.get('tables'))
+        if request.accept_mimetypes.best_match((JSON, EVENT_STREAM)) == EVENT_STREAM:
+            return Response(change_events(cursor, tables), mimetype=EVENT_STREAM, headers={"Cache-Control": "no-cache"})
+        if cursor is None:
+            return respond({"changes": [], "cursor": current_cursor(tables)})
+        limit = max(1, min(request.args.get('limit', CHANGES_BATCH, type=int), CHANGES_BATCH))
+        wait = max(0, min(request.args.get('wait', 0, type=float), CHANGES_MAX_WAIT))
+        changes, cursor = wait_changes(cursor, limit, tables, wait)
+        return respond({"changes": changes, "cursor": cursor})
+    except ValueError as e:
+        return respond({"error": str(e)}, 400)
+    except ChangesGone as e:
+        return respond({"error": str(e), "cursor": e.cursor}, 410)
+    except sqlite3.Error as e:
+        return respond({"error": str(e)}, error_status(e))
+
+@app.route('/api/stats',methods=['GET'])
+def api_stats():
+    '''Reports the connection pool, writer and result cache counters, the latency percentiles and errors of every
+    operation, and the last slow statements of this process
+    '''
+    return respond(service_stats())
+
+@app.route('/api/diagnostics',methods=['GET'])
+def api_diagnostics():
+    '''Reports the SQLite profile and the settings of the connections, see diagnostics()
+    '''
+    return respond(diagnostics())
+
 if __name__ == "__main__":
-    """Runs the flask app
+    """Runs the flask app, or the maintenance command given on the command line
     """
-    app.run(host="0.0.0.0",port=5000) #run app  
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Database service")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("rebuild-summary", help="recompute the history_summary totals from the history table")
+    commands.add_parser("snapshot", help="take a snapshot of the database, the service can keep running")
+    command = commands.add_parser("restore", help="replace the database with a snapshot, the service must be stopped")
+    command.add_argument("snapshot", help="path of the snapshot file")
+    command = commands.add_parser("archive", help="move the old purchases to the archive database now")
+    command.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS, help="age in days of the purchases to move")
+    command = commands.add_parser("reshard", help="spread the users over another number of shards, the service must be "
+                                                  "stopped and SHARDS must be the current number of shards")
+    command.add_argument("shards", type=int, help="number of shards")
+    args = parser.parse_args()
+    if args.command == "rebuild-summary":
+        print("Rebuilt {} purchase totals".format(sum(rebuild_history_summary(path) for path in shards.paths)))
+    elif args.command == "reshard":
+        print("Resharded the users over {} shards: {}".format(args.shards, reshard(args.shards)))
+    elif args.command == "archive":
+        print("Archived {} purchases".format(sum(archive_history(path, shard_path(number, ARCHIVE_DATABASE), args.days)
+                                                 for number, path in enumerate(shards.paths))))
+    elif args.command == "snapshot":
+        print(json.dumps(snapshots.take(), indent=2))
+    elif args.command == "restore":
+        print("Restored snapshot {}, sha256 {}".format(args.snapshot, restore_snapshot(args.snapshot)))
+    else:
+        app.run(host="0.0.0.0",port=5000) #run app  
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""ASGI variant of the Database service, serving /api/get, /api/post, /api/put, /api/delete, /api/batch, /api/bulk,
+/api/stream, /api/changes and /api/stats like database.py, which it reuses for the operations, the shards, the writer
+threads and the result cache. Requests are served by an event
+loop, so thousands of pending calls from the other services only cost a coroutine each instead of a thread. The SQLite
+reads and the encoding of their results run on a pool of SQLITE_THREADS threads, and writes wait for the writer thread
+of their shard without holding any thread. Batches and bulk writes run on the same pool, and so does the reading of
+each chunk of a stream. The change feed waits for changes in the event loop, so a long-poll or an
+event stream only holds a thread while it reads the changes. Responses are not compressed.
+
+    uvicorn database_asgi:app --host 0.0.0.0 --port 5000 --workers 4
+"""
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, request, Response
+import database
+import serving
+from database import (JSON, MSGPACK, WRITE_TIMEOUT, IdempotencyConflict, ShardError, UnknownOperation, encode,
+                      error_status, execute_batch, execute_bulk, execute_read, queue_write, service_stats, stream,
+                      streamable)
+from database import (CHANGE_TABLES, CHANGES_BATCH, CHANGES_HEARTBEAT, CHANGES_MAX_WAIT, CHANGES_POLL_INTERVAL,
+                      EVENT_STREAM, ChangesGone, change_tables, read_changes)
+
+#Reads beyond SQLITE_THREADS wait for a thread in the queue of the pool, not in SQLite
+SQLITE_THREADS = int(os.environ.get('SQLITE_THREADS', 16))
+
+app = Quart(__name__)
+executor = ThreadPoolExecutor(max_workers=SQLITE_THREADS, thread_name_prefix="sqlite")
+
+
+def response_mimetype():
+    """Returns the format of the response, MSGPACK if the caller accepts it and msgpack is installed, JSON otherwise
+    :rtype: string
+    """
+    if serving.msgpack is not None and request.accept_mimetypes.best_match((JSON, MSGPACK)) == MSGPACK:
+        return MSGPACK
+    return JSON
+
+
+async def run_blocking(function, *args):
+    """Runs a blocking function of database.py on the thread pool
+    :return: what the function returns
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def stream_chunks(query):
+    """Passes on the chunks of database.stream(), each one read on the thread pool. The pooled connection of the stream
+    is released when the last chunk is sent or the client goes away.
+    :param query: body of the request, {"op": name, "args": [parameters]}
+    :type query: dictionary
+    :return: lines of json, one per row
+    :rtype: async generator
+    """
+    chunks = stream(query)
+    try:
+        while True:
+            chunk = await run_blocking(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk.encode()
+    finally:
+        await run_blocking(chunks.close)
+
+
+async def execute_write(query):
+    """Queues the write operation named in a request and waits for the commit of its group
+    :param query: body of the request, {"op": name, "args": [parameters], "idempotency_key": key}
+    :type query: dictionary
+    :return: the result of the operation and the http status
+    """
+    try:
+        future = queue_write(query)
+    except (UnknownOperation, ShardError) as e:
+        return {"error": str(e)}, 400
+    try:
+        #Shielded, a timeout must not cancel the future the writer thread answers
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), WRITE_TIMEOUT), 200
+    except asyncio.TimeoutError:
+        return {"error": "The write was not committed within {} seconds".format(WRITE_TIMEOUT)}, 503
+    except IdempotencyConflict as e:
+        return {"error": str(e)}, 422
+    except sqlite3.Error as e:
+        return {"error": str(e)}, error_status(e)
+
+
+async def write_response():
+    mimetype = response_mimetype()
+    result, status = await execute_write(await request.get_json())
+    return Response(encode(result, mimetype), status, mimetype=mimetype)
+
+
+@app.route('/api/get', methods=['GET'])
+async def api_get():
+    '''Receives API Get requests from other containers and process them on the thread pool
+    '''
+    mimetype = response_mimetype()
+    query = await request.get_json()
+    body, status = await run_blocking(execute_read, query, mimetype)
+    return Response(body, status, mimetype=mimetype)
+
+@app.route('/api/stream', methods=['GET'])
+async def api_stream():
+    '''Receives API Get requests for whole tables from other containers and streams the rows back as they are read
+    '''
+    query = await request.get_json()
+    if not streamable(query):
+        mimetype = response_mimetype()
+        return Response(encode({"error": "Operation {} cannot be streamed".format(query.get("op"))}, mimetype), 400,
+                        mimetype=mimetype)
+    return Response(stream_chunks(query), mimetype='application/x-ndjson')
+
+@app.route('/api/post', methods=['POST'])
+async def api_post():
+    '''Receives API POST requests from other containers and process them
+    '''
+    return await write_response()
+
+@app.route('/api/put', methods=['PUT'])
+async def api_put():
+    '''Receives API PUT requests from other containers and process them
+    '''
+    return await write_response()
+
+@app.route('/api/delete', methods=['DELETE'])
+async def api_delete():
+    '''Receives API DELETE requests from other containers and process them
+    '''
+    return await write_response()
+
+@app.route('/api/batch', methods=['POST'])
+async def api_batch():
+    '''Receives a list of operations from other containers and runs them in a single transaction
+    '''
+    mimetype = response_mimetype()
+    result, status = await run_blocking(execute_batch, await request.get_json())
+    return Response(encode(result, mimetype), status, mimetype=mimetype)
+
+@app.route('/api/bulk', methods=['POST'])
+async def api_bulk():
+    '''Receives rows to write in bulk from other containers, see database.execute_bulk()
+    '''
+    mimetype = response_mimetype()
+    result, status = await run_blocking(execute_bulk, await request.get_json())
+    return Response(encode(result, mimetype), status, mimetype=mimetype)
+
+@app.route('/api/stats', methods=['GET'])
+async def api_stats():
+    '''Reports the counters of this process, see database.service_stats()
+    '''
+    return Response(encode(service_stats()), mimetype=JSON)
+
+async def wait_changes(cursor, limit=CHANGES_BATCH, tables=CHANGE_TABLES, wait=0):
+    """Reads the changes made after a cursor on the thread pool, waiting up to wait seconds for one in the event loop,
+    see database.wait_changes()
+    :return: the changes and the cursor after them, see database.read_changes()
+    :rtype: tuple
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        stamp = database.table_versions.read(tables)
+        changes, cursor = await loop.run_in_executor(executor, read_changes, cursor, limit, tables)
+        if changes or loop.time() >= deadline:
+            return changes, cursor
+        while database.table_versions.read(tables) == stamp and loop.time() < deadline:
+            await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+
+async def change_events(cursor, tables=CHANGE_TABLES):
+    """Streams the changes made after a cursor as server-sent events, see database.change_events()
+    """
+    try:
+        if cursor is None:
+            cursor = (await wait_changes(None, 0, tables))[1]
+        while True:
+            changes, cursor = await wait_changes(cursor, CHANGES_BATCH, tables, CHANGES_HEARTBEAT)
+            if not changes:
+                yield b": heartbeat\n\n"
+            for change in changes:
+                yield "id: {}\nevent: change\ndata: {}\n\n".format(change["cursor"], json.dumps(change)).encode()
+    except ChangesGone as e:
+        yield "id: {}\nevent: gone\ndata: {}\n\n".format(e.cursor, json.dumps({"error": str(e),
+                                                                                  "cursor": e.cursor})).encode()
+    except sqlite3.Error as e:
+        app.logger.error("Change stream stopped: %s", e)
+
+
+@app.route('/api/changes', methods=['GET'])
+async def api_changes():
+    '''Serves the changes of the users, goods and purchases like database.api_changes()
+    '''
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        tables = change_tables(request.args.get('tables'))
+        if request.accept_mimetypes.best_match((JSON, EVENT_STREAM)) == EVENT_STREAM:
+            return Response(change_events(cursor, tables), mimetype=EVENT_STREAM, headers={"Cache-Control": "no-cache"})
+        limit = max(1, min(request.args.get('limit', CHANGES_BATCH, type=int), CHANGES_BATCH))
+        wait = max(0, min(request.args.get('wait', 0, type=float), CHANGES_MAX_WAIT)) if cursor is not None else 0
+        changes, cursor = await wait_changes(cursor, limit if cursor is not None else 0, tables, wait)
+        result, status = {"changes": changes, "cursor": cursor}, 200
+    except ValueError as e:
+        result, status = {"error": str(e)}, 400
+    except ChangesGone as e:
+        result, status = {"error": str(e), "cursor": e.cursor}, 410
+    except sqlite3.Error as e:
+        result, status = {"error": str(e)}, error_status(e)
+    return Response(encode(result), status, mimetype=JSON)
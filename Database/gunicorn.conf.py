@@ -0,0 +1,70 @@
+#Gunicorn settings of the Database service, read by `gunicorn database:app` from this directory. Every setting can be
+#overridden from the environment, for example WORKERS=4 THREADS=16 gunicorn database:app
+#Sending SIGHUP to the master process reloads gracefully: new workers are started with the new settings while the old
+#ones finish the requests they are serving before exiting. The app is preloaded in the master, so the new workers run
+#the code the master loaded: deploying new code takes SIGUSR2, which starts a new master next to the old one, or a
+#restart.
+import multiprocessing
+import os
+import threading
+import time
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+#SQLite takes one writer at a time, extra processes mostly add read capacity. Writers from every process are
+#safe: the database runs in WAL mode, every connection waits SQLITE_BUSY_TIMEOUT seconds for the write lock instead of
+#failing, and a batch takes the write lock before it reads anything. Each worker keeps its own counters and latency
+#percentiles, /api/stats reports the ones of the worker that answers it.
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", 8))
+backlog = int(os.environ.get("BACKLOG", 2048))
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+timeout = int(os.environ.get("TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+#The app is imported once in the master so migrations and the restore of RESTORE_SNAPSHOT run once, before any worker
+#starts
+preload_app = True
+accesslog = os.environ.get("ACCESSLOG")
+
+QUEUE_REPORT_INTERVAL = float(os.environ.get("QUEUE_REPORT_INTERVAL", 10))
+
+
+def queued_requests(worker):
+    """Returns how many accepted connections wait for one of the threads of the worker. The queue is an internal of the
+    gthread worker, so 0 is returned for a worker class or a gunicorn version without it.
+    """
+    try:
+        return worker.tpool._work_queue.qsize()
+    except AttributeError:
+        return 0
+
+
+def post_worker_init(worker):
+    """Starts a thread logging, every QUEUE_REPORT_INTERVAL seconds, how many requests the worker is serving and how
+    many are queued waiting for one of its threads
+    """
+    worker.in_flight = 0
+    worker.in_flight_lock = threading.Lock()
+    if QUEUE_REPORT_INTERVAL <= 0:
+        return
+
+    def report():
+        while worker.alive:
+            queued = queued_requests(worker)
+            if worker.in_flight or queued:
+                log = worker.log.warning if queued else worker.log.info
+                log("worker %s: %d requests in flight, %d queued, %d open connections",
+                    worker.pid, worker.in_flight, queued, getattr(worker, "nr_conns", 0))
+            time.sleep(QUEUE_REPORT_INTERVAL)
+
+    threading.Thread(target=report, name="queue-report", daemon=True).start()
+
+
+def pre_request(worker, req):
+    with worker.in_flight_lock:
+        worker.in_flight += 1
+
+
+def post_request(worker, req, environ, resp):
+    with worker.in_flight_lock:
+        worker.in_flight -= 1
@@ -1,8 +1,18 @@
 #!/usr/bin/python 
+import argparse
+import codecs
+import math
+import os
+import sys
 import requests
 import json
-from flask import Flask,request,jsonify
+from flask import Flask,request,Response
 from flask_cors import CORS
+#The modules shared by the services are copied next to this one in the image, and are in ../Common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Common"))
+from serving import ACCEPT, decode, respond
+from database_client import (DATABASE_URL, FORMATS, MIMETYPES, DatabaseError, batch, bulk_export, bulk_import,
+                             column, failed, import_format, read_rows, write)
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -19,66 +29,111 @@ class InsuffcientAmount(Exception):
 class AlreadyRegistered(Exception):
     pass
 
+class GoodNotFound(Exception):
+    pass
+
+class InvalidAmount(Exception):
+    pass
+
+CATEGORIES = ("food", "clothes", "accessories", "electronics")
+#Columns of a goods import or export
+GOOD_FIELDS = ("name", "category", "price", "description", "count")
+
+def valid_category(category):
+    """Tells if the shop sells goods of a category, whatever its case
+    :param category: the category of a good
+    :type category: string
+    :rtype: bool
+    """
+    return category.lower() in CATEGORIES
 
 def add_goods(good):
     """Adds the good to the database
     :param good: Contains information about the good
     :type user: dictionary
     :raises CategoryNotFound: if the category is invalid, the error will be raised
+    :raises AlreadyRegistered: if a good with the same name is already in the database, the error will be raised
+    :raises DatabaseError: if the database fails to insert the good for another reason
     :return: A message confirming registration status and the information of the registered good
     :rtype: Both are dictionaries
     """
     message ={}
     try:
-        if good["category"].lower() !="food" and  good["category"].lower() !="clothes" and good["category"].lower() !="accessories" and good["category"].lower() !="electronics":
+        if not valid_category(good["category"]):
             raise CategoryNotFound ("Category is invalid")
-        query = {"1":"INSERT INTO goods (name,category,price,description,count) VALUES (?, ?, ?, ?, ?)"
-                , "2": [good['name'], good['category'], good['price'], good['description'], good['count']]}
-        requests.post('http://172.17.0.2:5000/api/post', json=query)
+        query = {"op":"goods.insert",
+                 "args": [good['name'], good['category'], good['price'], good['description'], good['count']]}
+        try:
+            write('POST', '/api/post', query)
+        except DatabaseError as e:
+            if e.status == 409:
+                raise AlreadyRegistered("Good already registered")
+            raise
         message["status"] = "Successful Registration"
+    except AlreadyRegistered:
+        message["status"] = "Good already registered"
+        good = {}
+    except DatabaseError:
+        raise
     except:
         message["status"] = "Category is invalid"
         good = {}
-    finally:
-        return message,good
+    return message,good
 
-def deduce_good(name,amount):
-    """Reduces the count of the good by a certain number
+def deduce_good(name,amount,key=None):
+    """Reduces the count of the good by a certain number. The count is checked and reduced by the database in a single
+    statement, so two orders for the same good can never sell more than what is in stock.
     :param name: Name of the good whose count we want to reduce
     :type name: string
+    :param amount: number of items to take from the stock, above 0
+    :type amount: int
+    :param key: idempotency key of the request, a request sent again with the same key does not reduce the count again
+        and gets the answer of the first one
+    :type key: string
+    :raises InvalidAmount: when the amount is not a number above 0, since a negative one would raise the count
+    :raises GoodNotFound: when no good has this name, the error will be raised
     :raises OutOfStock: when the count of the good = 0 before deduction, the error will be raised
+    :raises InsuffcientAmount: when the count of the good is less than the amount, the error will be raised
+    :raises DatabaseError: if the database fails to reduce the count
     :return: A message confirming deduction status and the information of the updated good
     :rtype: Both are dictionaries
     """
-    good = get_good_by_name(name)
     updated_good = {}
     message = {}
-    if good == {}:
-       message["status"] = 'Good not found'
-       return message,updated_good
+    good = {}
     try:
-        if good["count"]  == 0:
-            raise OutOfStock ("Good is out of stock")
-        elif good["count"] - amount < 0:
+        if type(amount) not in (int, float) or not amount > 0:
+            raise InvalidAmount("Amount should be a number above 0")
+        deduced, good = batch(("goods.deduct", (amount, name, amount, amount)),
+                              ("goods.by_name", (name,)),
+                              idempotency_key=None if key is None else "goods.deduce:" + key)
+        if good == {}:
+            raise GoodNotFound("Good not found")
+        if deduced["rowcount"] == 0:
+            if good["count"]  == 0:
+                raise OutOfStock ("Good is out of stock")
             raise InsuffcientAmount("Not enough ")
-        query = {"1":"UPDATE goods SET count= ? WHERE name =?", 
-                "2":(good["count"] - amount, good["name"],)}
-        requests.put('http://172.17.0.2:5000/api/put', json=query)
-        updated_good = get_good_by_name(good["name"])
+        updated_good = good
         message["status"] = "Succefully deduced item"
+    except InvalidAmount:
+        message["status"] = "Amount should be a number above 0"
+    except GoodNotFound:
+        message["status"] = 'Good not found'
     except OutOfStock:
         message['status'] = "Good is out of stock"
     except InsuffcientAmount:
         message['status']='Not enough {} in stock'.format(good["name"])
+    except DatabaseError:
+        raise
     except:
          updated_good = {} 
-    finally: 
-        return message,updated_good
+    return message,updated_good
 
 def update_good(good):
     """Updates the information of a specified good
     :param good: contains the information of the specified good
     :type name: dictionary
+    :raises DatabaseError: if the database fails to update the good
     :return: A message confirming update status and the information of the updated good
     :rtype: Both are dictionaries
     """
@@ -89,18 +144,19 @@ def update_good(good):
        message["status"] = 'Good not found'
        return message,updated_good
     try:
-        if good["category"].lower() !="food" and  good["category"].lower() !="clothes" and good["category"].lower() !="accessories" and good["category"].lower() !="electronics":
+        if not valid_category(good["category"]):
             raise CategoryNotFound ("Category is invalid")
-        query = {"1": "UPDATE goods SET name = ?, category = ?, price= ?, description= ?, count= ? WHERE name =?", 
-                 "2": (good["name"], good["category"], good["price"], good["description"], good["count"], good["name"],)}
-        requests.put('http://172.17.0.2:5000/api/put', json=query)
+        query = {"op": "goods.update",
+                 "args": (good["name"], good["category"], good["price"], good["description"], good["count"], good["name"],)}
+        write('PUT', '/api/put', query)
         message["status"] = "Succefully updated good"
         updated_good = good
+    except DatabaseError:
+        raise
     except:
          updated_good = {}
          message["status"] = "Category is invalid"
-    finally:
-        return message,updated_good
+    return message,updated_good
 
 
 def get_good_by_name(name): 
@@ -112,13 +168,58 @@ def get_good_by_name(name):
     """
     good = {}
     try:
-        query = {"1":"SELECT * FROM goods WHERE name = ?",
-                 "2":(name,)}
-        good = requests.get('http://172.17.0.2:5000/api/get', json=query).json()
+        query = {"op":"goods.by_name",
+                 "args":(name,)}
+        good = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
     except:
         good = {}
     return good
 
+def parse_good(row):
+    """Turns a row of a goods import into the arguments of goods.import, checking it like add_goods() checks a good
+    :param row: the columns of the row
+    :type row: dictionary
+    :raises ValueError: if a column is missing or holds neither text nor a number, the category is invalid, the name
+        is empty, the price is not a finite number of at least 0 or the count is not a whole number of at least 0
+    :return: name, category, price, description and count
+    :rtype: list
+    """
+    for field in GOOD_FIELDS:
+        column(row, field)
+    if not valid_category(row["category"]):
+        raise ValueError("Category is invalid")
+    if not row["name"]:
+        raise ValueError("Name is empty")
+    price = float(row["price"])
+    if not math.isfinite(price) or price < 0:
+        raise ValueError("Price must be a number of at least 0")
+    #int() would cut 2.5 down to 2 instead of refusing it
+    count = float(row["count"])
+    if not count.is_integer() or count < 0:
+        raise ValueError("Count must be a whole number of at least 0")
+    return [row["name"], row["category"], price, row["description"], int(count)]
+
+def import_goods(lines, format):
+    """Adds the goods of a csv or ndjson file to the database in bulk, see bulk_import(). Goods whose name is already
+    registered are skipped.
+    :param lines: lines of text of the file
+    :type lines: iterable of strings
+    :param format: "csv" or "ndjson"
+    :type format: string
+    :return: the summary of the import
+    :rtype: dictionary
+    """
+    return bulk_import(read_rows(lines, format), "goods.import", parse_good)
+
+def export_goods(format):
+    """Streams every good of the database as csv or ndjson, in a file import_goods() can read back
+    :param format: "csv" or "ndjson"
+    :type format: string
+    :return: chunks of the file
+    :rtype: generator
+    """
+    return bulk_export("goods.list", GOOD_FIELDS, format)
+
 @app.route('/api/goods/add', methods = ['POST'])
 def api_add_user():
     """API implementation of add_goods()
@@ -126,18 +227,24 @@ def api_add_user():
     :rtype: json object
     """  
     good = request.get_json()
-    return jsonify(add_goods(good))
+    try:
+        return respond(add_goods(good))
+    except DatabaseError as e:
+        return failed(e, ({"status": "Unsuccessful registration"}, {}))
 
 @app.route('/api/goods/deduce/<name>', methods = ['PUT'])
 def api_reduce(name):
-    """API implementation of deduce_good()
+    """API implementation of deduce_good(), with the idempotency key of the request in its Idempotency-Key header
     :param name: the name of the good whose count we're reducing
     :type name: string
     :return: A message confirming deduction status and the information of the updated good
     :rtype: json object
     """
     amount = request.get_json()
-    return jsonify(deduce_good(name,amount))
+    try:
+        return respond(deduce_good(name,amount,request.headers.get('Idempotency-Key')))
+    except DatabaseError as e:
+        return failed(e, ({"status": "Cannot reduce the count"}, {}))
 
 @app.route('/api/goods/update', methods = ['PUT'])
 def api_update_user():
@@ -146,11 +253,52 @@ def api_update_user():
     :rtype: json object
     """
     good = request.get_json()
-    return jsonify(update_good(good))
+    try:
+        return respond(update_good(good))
+    except DatabaseError as e:
+        return failed(e, ({"status": "Unsuccessful update"}, {}))
+
+@app.route('/api/import/goods', methods = ['POST'])
+def api_import_goods():
+    """API implementation of import_goods(). The body is the file, read as it arrives, in the format given by
+    ?format=csv|ndjson or guessed from its content type
+    :return: the summary of the import
+    :rtype: json object
+    """
+    format = request.args.get('format') or import_format(mimetype=request.mimetype)
+    if format not in FORMATS:
+        return respond({"error": "Unknown format {}".format(format)}), 400
+    return respond(import_goods(codecs.iterdecode(request.stream, 'utf-8'), format))
+
+@app.route('/api/export/goods', methods = ['GET'])
+def api_export_goods():
+    """API implementation of export_goods(), ?format=csv|ndjson, csv by default
+    :return: every good, streamed
+    :rtype: csv or newline delimited json
+    """
+    format = request.args.get('format', 'csv')
+    if format not in FORMATS:
+        return respond({"error": "Unknown format {}".format(format)}), 400
+    return Response(export_goods(format), mimetype=MIMETYPES[format])
 
 if __name__ == "__main__":
-    """Runs the flask app
+    """Runs the flask app, or the bulk command given on the command line
     """
-    #app.debug = True
-    #app.run(debug=True)
-    app.run(host ='0.0.0.0',port=7000) #run app
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Inventory service")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("import", help="add the goods of a csv or ndjson file to the database")
+    command.add_argument("file", help="the file to import, - for the standard input")
+    command.add_argument("--format", choices=FORMATS, help="format of the file, guessed from its name by default")
+    command = commands.add_parser("export", help="write every good of the database to the standard output")
+    command.add_argument("--format", choices=FORMATS, default="csv")
+    args = parser.parse_args()
+    if args.command == "import":
+        lines = sys.stdin if args.file == "-" else open(args.file, newline='', encoding='utf-8')
+        print(json.dumps(import_goods(lines, args.format or import_format(args.file)), indent=2))
+    elif args.command == "export":
+        for chunk in export_goods(args.format):
+            sys.stdout.buffer.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+    else:
+        #app.debug = True
+        #app.run(debug=True)
+        app.run(host ='0.0.0.0',port=7000) #run app
\ No newline at end of file
@@ -1,11 +1,29 @@
 #!/usr/bin/python
+import os
+import re
+import sys
+import time
+import uuid
 import requests
 import json
-from flask import Flask,request,jsonify
+from flask import Flask,request,Response
 from flask_cors import CORS
+#The modules shared by the services are copied next to this one in the image, and are in ../Common in the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Common"))
+from serving import ACCEPT, compress, decode, respond
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+app.after_request(compress)
+
+#Addresses of the other services, by default the ones they have on the docker network
+DATABASE_URL = os.environ.get('DATABASE_URL', 'http://172.17.0.2:5000')
+CUSTOMER_URL = os.environ.get('CUSTOMER_URL', 'http://172.17.0.3:3000')
+INVENTORY_URL = os.environ.get('INVENTORY_URL', 'http://172.17.0.4:7000')
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+#Listings may be served by a read replica of the database up to this many seconds old
+LISTING_MAX_STALENESS = 5
 
 class InsufficientAmount(Exception):
     pass
@@ -13,65 +31,260 @@ class InsufficientAmount(Exception):
 class OutOfStock(Exception):
     pass
 
-def get_prices():
+class SaleInterrupted(Exception):
+    """Raised when a call of a sale to another service fails after its retries, or the wallet cannot be charged back,
+    leaving the sale half done. Every call of the sale is idempotent, so sending the sale again with the same key
+    finishes it without charging twice.
+    :param step: what the sale was doing when it failed
+    :type step: string
+    :param key: idempotency key of the sale
+    :type key: string
+    :param error: the error of the call
+    :type error: string
+    """
+    def __init__(self, step, key, error):
+        super().__init__("Sale interrupted while {}: {}".format(step, error))
+        self.step = step
+        self.key = key
+        self.error = error
+
+class SaleRefused(Exception):
+    """Raised when another service refuses a call of a sale with a client error, or the idempotency key of the sale
+    was used for another sale. Sending the sale again does not help.
+    :param step: what the sale was doing when it was refused
+    :type step: string
+    :param key: idempotency key of the sale
+    :type key: string
+    :param error: the error of the call
+    :type error: string
+    :param status: http status of the refusal, 422 when the key was used for another sale
+    :type status: int
+    """
+    def __init__(self, step, key, error, status):
+        super().__init__("Sale refused while {}: {}".format(step, error))
+        self.step = step
+        self.key = key
+        self.error = error
+        self.status = status
+
+#The calls of a sale to the other services give up after CALL_TIMEOUT seconds and are sent again up to CALL_RETRIES
+#times, CALL_BACKOFF seconds after the first failure and twice as long after each next one. Retrying a write is safe
+#because each one carries an idempotency key, see sale().
+CALL_TIMEOUT = float(os.environ.get('CALL_TIMEOUT', 2))
+CALL_RETRIES = int(os.environ.get('CALL_RETRIES', 3))
+CALL_BACKOFF = float(os.environ.get('CALL_BACKOFF', 0.05))
+
+def call(method, url, key=None, **kwargs):
+    """Sends a request to another service, again if it times out, cannot connect or gets an error of the server
+    :param method: http method of the request
+    :type method: string
+    :param url: url of the request
+    :type url: string
+    :param key: idempotency key of a write, sent in its Idempotency-Key header
+    :type key: string
+    :raises requests.RequestException: if the last attempt fails to get an answer
+    :raises requests.HTTPError: if the last attempt is answered with an error, with the error sent by the service. A
+        client error is answered at once, only server errors are retried.
+    :return: the response of the last attempt
+    :rtype: requests.Response
+    """
+    headers = dict(ACCEPT)
+    if key is not None:
+        headers["Idempotency-Key"] = key
+    for attempt in range(CALL_RETRIES + 1):
+        try:
+            response = requests.request(method, url, headers=headers, timeout=CALL_TIMEOUT, **kwargs)
+            if response.status_code < 500 or attempt == CALL_RETRIES:
+                break
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == CALL_RETRIES:
+                raise
+        time.sleep(CALL_BACKOFF * 2 ** attempt)
+    if response.status_code >= 400:
+        #Customer and Inventory answer [message, {}] with the error in the message, the database {"error": message}
+        try:
+            body = decode(response)
+            error = (body[0] if isinstance(body, list) else body).get("error")
+        except (ValueError, AttributeError, IndexError):
+            error = None
+        raise requests.HTTPError("{} {} answered {}: {}".format(method, url, response.status_code, error),
+                                 response=response)
+    return response
+
+def get_prices(columnar=False):
     """Gets the name and the price of each element in the database
+    :param columnar: True to get the goods in the compact format {"columns": ["name", "price"], "rows": [[name, price], ...]}
+    :type columnar: bool
     :return: A list of dictionaries each containing the name and the price of the goods
     :rtype: list
     """
     goods = []
     try:
-        query = {"1":"SELECT * FROM goods"}
-        goods = requests.get('http://172.17.0.2:5000/api/get', json=query).json()
+        query = {"op":"goods.list_prices", "max_staleness":LISTING_MAX_STALENESS}
+        if columnar:
+            query["format"] = "columnar"
+        goods = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
     except:
         goods=[]
     return goods
 
-def sale(username,name,amount):
+def get_prices_page(after, limit):
+    """Gets the name and the price of one page of goods ordered by id. The page starts after an id instead of at an
+    offset, so every page costs the same to read however deep into the catalog it is.
+    :param after: id of the last good of the previous page, 0 for the first page
+    :type after: int
+    :param limit: maximum number of goods in the page
+    :type limit: int
+    :return: the ids, names and prices of the page and the id to ask the next page after, None on the last page
+    :rtype: dictionary
+    """
+    page = {"prices": [], "next_after": None}
+    try:
+        query = {"op":"goods.page_prices", "max_staleness":LISTING_MAX_STALENESS,
+                 "args":(after, limit)}
+        result = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
+        page = {"prices": result["rows"], "next_after": result["next_after"]}
+    except:
+        page = {"prices": [], "next_after": None}
+    return page
+
+def stream_prices():
+    """Streams the name and the price of every good as newline delimited json, passing the rows on as they arrive
+    instead of loading the whole catalog in memory
+    :return: chunks of newline delimited json
+    :rtype: generator
+    """
+    query = {"op":"goods.list_prices", "max_staleness":LISTING_MAX_STALENESS}
+    with requests.get(DATABASE_URL + '/api/stream', json=query, headers=ACCEPT, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=None):
+            yield chunk
+
+def pin_price(key, request, price):
+    """Keeps the price of a sale under its idempotency key the first time the sale is sent. The sale sent again with the
+    same key charges the price kept, even if the price of the good changed in between, so every call of the sale is
+    sent again with the same arguments and replays the result of the first one.
+    :param key: idempotency key of the sale
+    :type key: string
+    :param request: the username, the name of the good and the amount of the sale
+    :type request: list
+    :param price: price of the sale at the current price of the good
+    :type price: float
+    :raises SaleRefused: if the key was used for another sale
+    :raises requests.RequestException: if the database cannot be reached or fails to keep the price
+    :return: the price kept under the key
+    :rtype: float
+    """
+    request = json.dumps(request)
+    kept_key = "sale:{}:price".format(key)
+    query = {"ops": [{"op": "idempotency.keep", "args": [kept_key, request, json.dumps(price)]},
+                     {"op": "idempotency.by_key", "args": [kept_key]}]}
+    kept = decode(call('POST', DATABASE_URL + '/api/batch', json=query))["results"][1]
+    if kept.get("request") != request:
+        raise SaleRefused("keeping the price", key, "The idempotency key was used for another sale", 422)
+    return json.loads(kept["result"])
+
+def sale(username,name,amount,key=None):
     """This is called when a purchase occured. The count of the item will be reduced by a certain amount and the users wallet will
     be reduced by the price by the item. It also calls the function to save the purchase in the database.
+    The wallet and then the count are checked and reduced by the other services in a single statement each, and the
+    wallet is charged back if the count is too low. Every call is retried with an idempotency key derived from the key
+    of the sale, so a sale sent again with the same key, or a call retried after a lost answer, never charges twice.
     :param username: username of the user who made the purchase
     :type username: string
     :param name: name of the item that got purchased
     :type name: string
+    :param key: idempotency key of the sale, a new one if None
+    :type key: string
     :raises InsufficientAmount: if the user doesn't have the item's price in his wallet, the error will be raised
     :raises OutOfStock: if the item's count is equal to 0, the error will be raised
+    :raises SaleInterrupted: if a call to another service or the charge back of the wallet fails, with the key to send
+        the sale again with
+    :raises SaleRefused: if another service refuses a call of the sale, or the key was used for another sale
     :return: A message confirming purchase status
     :rtype: Dictionary
     """
+    key = key or uuid.uuid4().hex
+    calls = "sale:" + key
     good = get_good_by_name(name)
-    user = requests.get('http://172.17.0.3:3000/api/users/{}'.format(username)).json()
     message = {}
+    if good == {}:
+        message["status"] = 'Good not found'
+        return message
+    if type(amount) != float and type(amount) != int:
+        message["status"] = "Amount should be a number"
+        return message
+    price = good["price"]*amount
+    step = "keeping the price"
     try:
-        if user["wallet"] >= (good["price"]*amount) and good["count"] > amount:
-            requests.put('http://172.17.0.3:3000/api/users/deduce/{}'.format(username),json =(good["price"]*amount))
-            requests.put('http://172.17.0.4:7000/api/goods/deduce/{}'.format(name),json= amount)
-        elif user["wallet"] < (good["price"]*amount):
-            raise InsufficientAmount('Not enough available to spend {}'.format(good["price"]*amount))
-        elif good["count"] == 0:
-            raise OutOfStock('{} is out of stock'.format(good["name"]))
-        elif good["count"] - amount<0:
-            raise ('Not enough {} in stock'.format(good["name"]))
+        price = pin_price(key, [username, name, amount], price)
+        step = "reducing the wallet"
+        reduced, user = decode(call('PUT', CUSTOMER_URL + '/api/users/deduce/{}'.format(username),
+                                    calls + ":wallet", json=price))
+        if reduced["status"].startswith('Not enough available'):
+            raise InsufficientAmount('Not enough available to spend {}'.format(price))
+        if reduced["status"] != 'Successfully reduced!':
+            raise LookupError(reduced["status"])
+        step = "reducing the stock"
+        refused = None
+        try:
+            deduced, updated_good = decode(call('PUT', INVENTORY_URL + '/api/goods/deduce/{}'.format(name),
+                                                calls + ":stock", json=amount))
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code >= 500:
+                raise
+            #The wallet was reduced, it is charged back before the refusal is reported
+            refused = e
+            deduced = {"status": str(e)}
+        if deduced["status"] != 'Succefully deduced item':
+            step = "charging back the wallet"
+            refunded, user = decode(call('PUT', CUSTOMER_URL + '/api/users/charge/{}'.format(username),
+                                         calls + ":refund", json=price))
+            if refunded["status"] != 'Successfully charged!':
+                raise SaleInterrupted(step, key, refunded["status"])
+            if refused is not None:
+                raise SaleRefused("reducing the stock", key, str(refused), refused.response.status_code)
+            if deduced["status"] == 'Good is out of stock':
+                raise OutOfStock('{} is out of stock'.format(good["name"]))
+            raise LookupError(deduced["status"])
+        step = "saving the purchase"
+        saved = save_purchase(username,name,amount,calls + ":history")
+        if saved.get("rowcount") != 1:
+            raise SaleInterrupted(step, key, "The database saved {} purchases".format(saved.get("rowcount")))
         message["status"] = "Purchase successful"
-        save_purchase(username,name,amount)
     except InsufficientAmount:
-       message["status"] = 'Not enough available to spend {}'.format(good["price"]*amount)
+       message["status"] = 'Not enough available to spend {}'.format(price)
     except OutOfStock:
        message["status"] = '{} is out of stock'.format(good["name"])
-    except:
-       message["status"] ='Not enough {} in stock'.format(good["name"])
+    except LookupError as e:
+       #The status of the service that refused, like User not found or Not enough <good> in stock
+       message["status"] = str(e)
+    except requests.HTTPError as e:
+        #A client error is answered the same way however many times the sale is sent
+        if e.response is not None and e.response.status_code < 500:
+            raise SaleRefused(step, key, str(e), e.response.status_code)
+        raise SaleInterrupted(step, key, str(e))
+    except requests.RequestException as e:
+        raise SaleInterrupted(step, key, str(e))
     return message
 
-def save_purchase(username,name,amount):
+def save_purchase(username,name,amount,key=None):
     """Saves the purchase made by a customer in the databse by saving his username and the name of the item
     :param username: username of the user who made the purchase
     :type username: string
     :param name: name of the item that got purchased
     :type name: string
+    :param key: idempotency key of the purchase, saved once however many times it is sent
+    :type key: string
+    :raises requests.RequestException: if the database cannot be reached or fails to save the purchase
+    :return: the result of the insert, the number of rows inserted in rowcount
+    :rtype: dictionary
     """
     l = {"username" : username,"name" : name, "amount":amount}
-    query = {"1":"INSERT INTO history (name, item,amount) VALUES (?, ?, ?)",
-                "2": (l['username'], l['name'],l['amount']) }
-    requests.post('http://172.17.0.2:5000/api/post', json=query)
+    query = {"op":"history.insert",
+                "args": (l['username'], l['name'],l['amount']) }
+    if key is not None:
+        query["idempotency_key"] = key
+    return decode(call('POST', DATABASE_URL + '/api/post', json=query))
 
 def get_history(username):
     """Given the username of the customer, this function returns the purchase history of this customer by
@@ -83,13 +296,114 @@ def get_history(username):
     """
     history = {}
     try:
-        query = {"1":"SELECT * FROM history WHERE name = ?",
-                    "2":(username,)}
-        history = requests.get('http://172.17.0.2:5000/api/get', json=query).json()
+        query = {"op":"history.by_user",
+                    "args":(username,)}
+        history = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
     except:
         history = {}
     return history
 
+def get_monthly_history(username):
+    """Given the username of the customer, this function returns how many of each item the customer bought in each
+    month, archived purchases included
+    :param username: username of the customer whose history we want
+    :type username: string
+    :return: {month as YYYY-MM: {item: amount}}, oldest month first
+    :rtype: dictionary
+    """
+    history = {}
+    try:
+        query = {"op":"history.monthly",
+                    "args":(username,)}
+        history = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
+    except:
+        history = {}
+    return history
+
+def match_query(text):
+    """Turns the words typed by a customer into an FTS5 query matching the goods whose name or description holds every
+    word, the last one possibly unfinished. Every word is quoted, so nothing typed is read as FTS5 syntax.
+    :param text: the words to search for
+    :type text: string
+    :return: the query, empty if the text holds no word
+    :rtype: string
+    """
+    words = ['"{}"'.format(word) for word in re.findall(r"\w+", text)]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+def search_goods(text, limit=PAGE_SIZE, offset=0):
+    """Searches the name and the description of the goods for words, through the full-text index of the database.
+    Only the goods holding every word are read, so a search costs the same however large the catalog is.
+    :param text: the words to search for
+    :type text: string
+    :param limit: maximum number of goods in the page
+    :type limit: int
+    :param offset: number of better matches to skip, 0 for the first page
+    :type offset: int
+    :return: the goods of the page, best match first, and the offset of the next page, None on the last page
+    :rtype: dictionary
+    """
+    page = {"goods": [], "next_offset": None}
+    query = match_query(text)
+    if not query:
+        return page
+    try:
+        query = {"op":"goods.search",
+                 "args":(query, limit, offset)}
+        goods = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
+        page = {"goods": goods, "next_offset": offset + limit if len(goods) == limit else None}
+    except:
+        page = {"goods": [], "next_offset": None}
+    return page
+
+def filter_goods(category=None, min_price=None, max_price=None, in_stock=False, descending=False, after=None,
+                 limit=PAGE_SIZE):
+    """Lists one page of the goods of a category and a price band, cheapest first or dearest first. Only the goods of
+    the band are read, from an index holding the listed columns, and the page starts after the last good of the
+    previous page instead of at an offset, so every page costs the same to read however large the catalog is.
+    :param category: category of the goods, whatever its case, None for every category
+    :type category: string
+    :param min_price: lowest price, None for no lower bound
+    :type min_price: float
+    :param max_price: highest price, None for no upper bound
+    :type max_price: float
+    :param in_stock: True to only list the goods left in stock
+    :type in_stock: bool
+    :param descending: True to list the dearest goods first
+    :type descending: bool
+    :param after: price and name of the last good of the previous page, None for the first page
+    :type after: dictionary
+    :param limit: maximum number of goods in the page
+    :type limit: int
+    :return: the id, name, category, price and count of the goods of the page and the price and name to ask the next
+        page after, None on the last page
+    :rtype: dictionary
+    """
+    page = {"goods": [], "next_after": None}
+    low = -sys.float_info.max if min_price is None else min_price
+    high = sys.float_info.max if max_price is None else max_price
+    name = None
+    if after:
+        #The next page starts at the price of the last good, the names break the ties on that price
+        name = after["name"]
+        if descending:
+            high = min(high, after["price"])
+        else:
+            low = max(low, after["price"])
+    op = "goods.by_category_price" if category else "goods.by_price"
+    try:
+        query = {"op":op + "_desc" if descending else op, "max_staleness":LISTING_MAX_STALENESS,
+                 "args":(category, low, high, 1 if in_stock else 0, name, limit)}
+        result = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
+        goods = result["rows"]
+        page = {"goods": goods,
+                "next_after": {"price": goods[-1]["price"], "name": goods[-1]["name"]} if result["next_after"] else None}
+    except:
+        page = {"goods": [], "next_after": None}
+    return page
+
 def get_good_by_name(name): 
     """Get the information of the good from the database using its name
     :param name: Name of the good we want to extract
@@ -99,20 +413,56 @@ def get_good_by_name(name):
     """
     good = {}
     try:
-        query = {"1":"SELECT * FROM goods WHERE name = ?",
-                 "2":(name,)}
-        good = requests.get('http://172.17.0.2:5000/api/get', json=query).json()
+        query = {"op":"goods.by_name",
+                 "args":(name,)}
+        good = decode(requests.get(DATABASE_URL + '/api/get', json=query, headers=ACCEPT))
     except:
         good = {}
     return good
 
 @app.route('/api/prices', methods=['GET'])
 def api_get_prices():
-    """API implementation of get_prices()
+    """API implementation of get_prices(), ?format=columnar returns them in the compact columnar format. With
+    ?after=<id>&limit=N it returns one page of prices instead, see get_prices_page(), and with ?format=ndjson it
+    streams all prices as newline delimited json, see stream_prices()
     :return: the prices of all items in the database
     :rtype: json object
     """
-    return jsonify(get_prices())
+    if request.args.get('format') == 'columnar':
+        return respond(get_prices(columnar=True))
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_prices(), mimetype='application/x-ndjson')
+    if 'after' in request.args or 'limit' in request.args:
+        after = request.args.get('after', 0, type=int)
+        limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        return respond(get_prices_page(after, limit))
+    return respond(get_prices())
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """API implementation of search_goods(), ?q=<words>&limit=N&offset=M
+    :return: one page of the goods matching the words, best match first
+    :rtype: json object
+    """
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return respond(search_goods(request.args.get('q', ''), limit, offset))
+
+@app.route('/api/goods', methods=['GET'])
+def api_filter_goods():
+    """API implementation of filter_goods(), ?category=<category>&min_price=X&max_price=Y&in_stock=1&sort=price or
+    sort=-price&limit=N, and &after_price=X&after_name=<name> for the next pages
+    :return: one page of the goods of the category and the price band
+    :rtype: json object
+    """
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    after = None
+    if 'after_name' in request.args:
+        after = {"price": request.args.get('after_price', 0, type=float), "name": request.args['after_name']}
+    return respond(filter_goods(request.args.get('category') or None, request.args.get('min_price', type=float),
+                                request.args.get('max_price', type=float),
+                                request.args.get('in_stock', '') in ('1', 'true', 'yes'),
+                                request.args.get('sort') == '-price', after, limit))
 
 @app.route('/api/goods/<name>', methods=['GET'])
 def api_get_good(name):
@@ -122,11 +472,11 @@ def api_get_good(name):
     :return: the information of the item
     :rtype: json object
     """
-    return jsonify(get_good_by_name(name))
+    return respond(get_good_by_name(name))
 
 @app.route('/api/sale/<username>,<name>', methods = ['POST'])
 def api_sale(username,name):
-    """API implementation of sale()
+    """API implementation of sale(), with the idempotency key of the sale in the Idempotency-Key header of the request
     :param username: username of the customer who did the purchase
     :type username: string 
     :param name: name of the good that got purchased
@@ -135,7 +485,12 @@ def api_sale(username,name):
     :rtype: json object
     """
     amount = request.get_json()
-    return jsonify(sale(username,name,amount))
+    try:
+        return respond(sale(username,name,amount,request.headers.get('Idempotency-Key')))
+    except SaleInterrupted as e:
+        return respond({"status": str(e), "step": e.step, "idempotency_key": e.key}), 502
+    except SaleRefused as e:
+        return respond({"status": str(e), "step": e.step, "idempotency_key": e.key}), e.status
 
 @app.route('/api/history/<username>', methods=['GET'])
 def api_history(username):
@@ -145,7 +500,17 @@ def api_history(username):
     :return: Purchase history of the customer
     :rtype: json object
     """
-    return jsonify(get_history(username))
+    return respond(get_history(username))
+
+@app.route('/api/history/<username>/monthly', methods=['GET'])
+def api_monthly_history(username):
+    """API implementation of get_monthly_history()
+    :param username: username of the customer whose history we're seeking
+    :type username: string
+    :return: Purchase history of the customer by month
+    :rtype: json object
+    """
+    return respond(get_monthly_history(username))
 
 if __name__ == "__main__":
     #app.debug = True
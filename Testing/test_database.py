@@ -0,0 +1,656 @@
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+#The Database service, not the database.py of this directory that the other tests use
+SERVICE_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Database", "database.py")
+SERVICE_DATABASE_ASGI = os.path.join(os.path.dirname(SERVICE_DATABASE), "database_asgi.py")
+
+def load_asgi(module):
+    '''Imports the ASGI variant of the Database service on top of an imported Database service, which it uses as its
+    database module
+    :param module: the Database service
+    :return: the module
+    '''
+    saved = sys.modules.get("database")
+    sys.modules["database"] = module
+    try:
+        spec = importlib.util.spec_from_file_location(module.__name__ + "_asgi", SERVICE_DATABASE_ASGI)
+        asgi = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(asgi)
+    finally:
+        if saved is None:
+            sys.modules.pop("database")
+        else:
+            sys.modules["database"] = saved
+    return asgi
+
+def load_database(name, shards):
+    '''Imports the Database service under another name, with the background jobs off. It opens its files by relative
+    paths, in the working directory.
+    :param name: name of the module
+    :type name: string
+    :param shards: number of shards of the database
+    :type shards: int
+    :return: the module
+    '''
+    settings = {"SHARDS": str(shards), "ARCHIVE_INTERVAL": "0", "PRUNE_INTERVAL": "0"}
+    saved = {key: os.environ.get(key) for key in settings}
+    os.environ.update(settings)
+    try:
+        spec = importlib.util.spec_from_file_location(name, SERVICE_DATABASE)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key)
+            else:
+                os.environ[key] = value
+    return module
+
+@pytest.fixture(scope="module")
+def services(tmp_path_factory):
+    '''Loads each variant of the Database service once, in a directory of its own
+    :return: function taking the name of the module and the number of shards, and returning the module and its directory
+    '''
+    loaded = {}
+
+    def load(name, shards):
+        if name not in loaded:
+            directory = tmp_path_factory.mktemp(name)
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                loaded[name] = load_database(name, shards), directory
+            finally:
+                os.chdir(cwd)
+        return loaded[name]
+    return load
+
+@pytest.fixture
+def service(services, monkeypatch):
+    '''The Database service with a single shard, the test runs in its directory
+    :return: the module
+    '''
+    module, directory = services("service_database", 1)
+    monkeypatch.chdir(directory)
+    return module
+
+@pytest.fixture
+def sharded(services, monkeypatch):
+    '''The Database service with 3 shards, the test runs in its directory
+    :return: the module
+    '''
+    module, directory = services("service_database_sharded", 3)
+    monkeypatch.chdir(directory)
+    return module
+
+def user(username):
+    '''Arguments of user.insert for a user
+    :param username: username of the user
+    :type username: string
+    :rtype: list
+    '''
+    return ["Test User", username, "pw", 30, "Beirut", "male", "single"]
+
+def post(module, op, args, **query):
+    '''Sends a write to the service
+    :return: the decoded answer and the http status
+    '''
+    response = module.app.test_client().post('/api/post', json=dict(query, op=op, args=args))
+    return response.get_json(), response.status_code
+
+def get(module, op, args):
+    '''Sends a read to the service
+    :return: the decoded answer
+    '''
+    return module.app.test_client().get('/api/get', json={"op": op, "args": args}).get_json()
+
+def test_pool_reuses_read_only_connections(service):
+    '''This tests the connection pool. A released connection should be handed out again instead of opening a new one,
+    only max_idle connections should stay open, and the connections of the read pool should refuse to write
+    '''
+    pool = service.ConnectionPool(service.DATABASE, max_idle=1, readonly=True)
+    with pool.connection() as conn:
+        first = conn
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == "wal"
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            conn.execute("UPDATE users SET wallet = 0")
+    with pool.connection() as conn:
+        assert conn is first
+        with pool.connection() as other:
+            assert other is not first
+    assert pool.stats() == {"size": 1, "idle": 1, "in_use": 0, "max_idle": 1, "created": 2, "reused": 1}
+    pool.close()
+    assert pool.stats()["size"] == 0
+
+def test_unknown_operation_refused(service):
+    '''This tests requests that name no operation of the registry: raw SQL, an unknown name, a read sent to a write
+    endpoint and the opposite. They should all be refused with 400 without running anything
+    '''
+    client = service.app.test_client()
+    for path, query in (('/api/post', {"op": "DELETE FROM users", "args": []}),
+                        ('/api/post', {"op": "users.drop", "args": []}),
+                        ('/api/post', {"op": "user.by_username", "args": ["nobody"]}),
+                        ('/api/get', {"op": "user.insert", "args": user("unknown-op")}),
+                        ('/api/batch', {"ops": [{"op": "user.insert", "args": user("unknown-op")},
+                                                {"op": "DELETE FROM users"}]})):
+        response = client.open(path, method="GET" if path == '/api/get' else "POST", json=query)
+        assert response.status_code == 400
+        assert response.get_json()["error"].startswith("Unknown operation")
+    assert post(service, "user.insert", ["too", "few"])[1] == 400
+    assert get(service, "user.by_username", ["unknown-op"]) == {}
+
+def test_migration_stops_on_duplicates(service, tmp_path):
+    '''This tests migrating a database whose users table holds the same username twice. The migration adding the unique
+    indexes should stop and leave the database at the version before it, then go through once a duplicate is removed
+    '''
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    for statement in service.MIGRATIONS[0][2]:
+        conn.execute(statement)
+    conn.execute('PRAGMA user_version = 1')
+    for name in ("twice", "twice", "once"):
+        conn.execute("INSERT INTO users (fullname, username, password, age, address, gender, marital_status) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)", user(name))
+    conn.commit()
+    with pytest.raises(service.MigrationError, match="'twice' \\(2 rows\\)"):
+        service.migrate(path)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+    conn.execute("DELETE FROM users WHERE user_id = 2")
+    conn.commit()
+    assert service.migrate(path) == service.MIGRATIONS[-1][0]
+    indexes = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"users_username", "goods_name", "history_name_item"} <= indexes
+    conn.close()
+
+def test_purchase_totals_kept_by_trigger(service):
+    '''This tests the per-user purchase totals. Each purchase should add its amount to the total of its user and good in
+    the same transaction, so a batch rolled back leaves the totals as they were
+    '''
+    for name, item, amount in (("summary", "apple", 2), ("summary", "apple", 3), ("summary", "pear", 1),
+                               ("other-summary", "apple", 7)):
+        assert post(service, "history.insert", [name, item, amount])[1] == 200
+    assert get(service, "history.by_user", ["summary"]) == {"apple": 5, "pear": 1}
+    response = service.app.test_client().post('/api/batch', json={"ops": [
+        {"op": "history.insert", "args": ["summary", "pear", 4]}, {"op": "user.insert", "args": ["too", "few"]}]})
+    assert response.status_code == 400
+    assert get(service, "history.by_user", ["summary"]) == {"apple": 5, "pear": 1}
+    conn = service.connect(service.DATABASE)
+    try:
+        totals = conn.execute("SELECT name, item, total FROM history_summary WHERE name LIKE '%summary' "
+                              "ORDER BY name, item").fetchall()
+        assert totals == conn.execute("SELECT name, item, SUM(amount) FROM history WHERE name LIKE '%summary' "
+                                      "GROUP BY name, item ORDER BY name, item").fetchall()
+    finally:
+        conn.close()
+
+def test_batch_aborted_or_partly_committed(service):
+    '''This tests a batch whose second operation fails. With abort_on_error the whole batch should be rolled back and
+    the index of the failing operation returned, without it only the failing operation should be rolled back
+    '''
+    post(service, "user.insert", user("batch-taken"))
+    ops = [{"op": "user.insert", "args": user("batch-new")}, {"op": "user.insert", "args": user("batch-taken")},
+           {"op": "user.by_username", "args": ["batch-new"]}]
+    response = service.app.test_client().post('/api/batch', json={"ops": ops})
+    assert response.status_code == 409
+    result = response.get_json()
+    assert (result["failed"], result["results"]) == (1, [{"rowcount": 1}])
+    assert get(service, "user.by_username", ["batch-new"]) == {}
+    response = service.app.test_client().post('/api/batch', json={"ops": ops, "abort_on_error": False})
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert results[0] == {"rowcount": 1}
+    assert "error" in results[1]
+    assert results[2]["username"] == "batch-new"
+    assert get(service, "user.by_username", ["batch-new"])["username"] == "batch-new"
+
+def test_concurrent_deducts_never_oversell(service):
+    '''This tests many orders for the same good sent at the same time. Only as many as the stock holds should reduce
+    it, and the stock should never go below 0
+    '''
+    post(service, "goods.insert", ["contended-good", "food", 1, "d", 10])
+    deduct = lambda n: service.execute_write({"op": "goods.deduct", "args": [1, "contended-good", 1, 1]})
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        answers = list(executor.map(deduct, range(25)))
+    assert all(status == 200 for result, status in answers)
+    assert sum(result["rowcount"] for result, status in answers) == 10
+    assert get(service, "goods.by_name", ["contended-good"])["count"] == 0
+
+def test_goods_pages_and_stream(service):
+    '''This tests the listings of the prices. Pages asked after the id of the last good should list every good once in
+    order of id, and the stream should send the same goods, one json object per line
+    '''
+    for n in range(7):
+        post(service, "goods.insert", ["paged-good-{}".format(n), "food", n, "d", 1])
+    ids = []
+    after = 0
+    while after is not None:
+        page = get(service, "goods.page_prices", [after, 3])
+        assert len(page["rows"]) <= 3
+        ids += [row["user_id"] for row in page["rows"]]
+        after = page["next_after"]
+    assert ids == sorted(set(ids))
+    response = service.app.test_client().get('/api/stream', json={"op": "goods.list_prices"})
+    streamed = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(streamed) == len(ids)
+    assert [row["name"] for row in streamed if row["name"].startswith("paged-good-")] == \
+        ["paged-good-{}".format(n) for n in range(7)]
+
+def test_price_pages_with_ties(service):
+    '''This tests the pages of a category listed by price when many goods have the same price. Each page starting at the
+    price and name of the last good of the previous one, every good should be listed once, cheapest first and by name
+    within a price, or the other way round, and the goods out of the price band or out of stock should be left out
+    '''
+    prices = {"tie-a": 5, "tie-b": 5, "tie-c": 3, "tie-d": 5, "tie-e": 7, "tie-f": 5, "tie-g": 5, "tie-h": 9}
+    for name, price in prices.items():
+        post(service, "goods.insert", [name, "Ties", price, "d", 0 if name == "tie-g" else 1])
+    for descending in (False, True):
+        low, high, after, listed = 3, 7, None, []
+        while True:
+            page = get(service, "goods.by_category_price_desc" if descending else "goods.by_category_price",
+                       ["ties", low, high, 1, after, 2])
+            listed += [(row["price"], row["name"]) for row in page["rows"]]
+            if page["next_after"] is None:
+                break
+            after = page["next_after"]
+            if descending:
+                high = page["rows"][-1]["price"]
+            else:
+                low = page["rows"][-1]["price"]
+        expected = sorted((price, name) for name, price in prices.items() if name not in ("tie-g", "tie-h"))
+        assert listed == (expected[::-1] if descending else expected)
+
+def test_columnar_rows_match_records(sharded):
+    '''This tests the columnar format. It should hold the same rows as the records, in the same order, with the names
+    of the columns sent once, for a listing and for a page merged across shards
+    '''
+    for n in range(6):
+        post(sharded, "user.insert", user("columnar-user-{}".format(n)))
+    client = sharded.app.test_client()
+    for op, args in (("user.list", []), ("user.page", [0, 4])):
+        records = client.get('/api/get', json={"op": op, "args": args}).get_json()
+        compact = client.get('/api/get', json={"op": op, "args": args, "format": "columnar"}).get_json()
+        rows = records if op == "user.list" else records["rows"]
+        assert [dict(zip(compact["columns"], row)) for row in compact["rows"]] == rows
+        if op == "user.page":
+            assert len(rows) == 4
+            assert compact["next_after"] == records["next_after"] == rows[-1]["user_id"]
+
+def test_cache_invalidated_by_another_process(service, tmp_path):
+    '''This tests the result cache when another process of the service commits a write. The cached results of the
+    tables it changed should no longer be served, the others should, and a result read before the write should not be
+    cached
+    '''
+    path = str(tmp_path / "shop.db.versions")
+    versions = service.TableVersions(path)
+    cache = service.ResultCache(versions, max_bytes=1024)
+    goods, users = ("goods.by_name", ("cached",), None), ("user.by_username", ("cached",), None)
+    cache.put(goods, '{"count":1}', ("goods",), versions.read(("goods",)))
+    cache.put(users, '{"wallet":1}', ("users",), versions.read(("users",)))
+    stamp = versions.read(("goods",))
+    assert cache.get(goods, ("goods",)) == '{"count":1}'
+    worker = multiprocessing.get_context("fork").Process(target=lambda: service.TableVersions(path).bump(["goods"]))
+    worker.start()
+    worker.join(5)
+    assert worker.exitcode == 0
+    assert cache.get(goods, ("goods",)) is None
+    assert cache.get(users, ("users",)) == '{"wallet":1}'
+    cache.put(goods, '{"count":0}', ("goods",), stamp)
+    assert cache.get(goods, ("goods",)) is None
+    assert cache.stats()["invalidations"] == 1
+
+def test_sqlite_profiles(service):
+    '''This tests the SQLite profiles. A profile should be overridable one setting at a time from the environment,
+    unknown profiles and values SQLite does not accept should be refused, and the connections should run with the
+    settings of the profile
+    '''
+    assert service.sqlite_settings("balanced", {}) == service.SQLITE_PROFILES["balanced"]
+    settings = service.sqlite_settings("throughput", {"SQLITE_MMAP_SIZE": "0", "SQLITE_SYNCHRONOUS": "NORMAL"})
+    assert settings == dict(service.SQLITE_PROFILES["throughput"], mmap_size=0, synchronous="normal")
+    with pytest.raises(ValueError, match="Unknown SQLite profile"):
+        service.sqlite_settings("fastest", {})
+    with pytest.raises(ValueError, match="Invalid SQLite synchronous"):
+        service.sqlite_settings("durable", {"SQLITE_SYNCHRONOUS": "sometimes"})
+    diagnostics = service.diagnostics()
+    assert diagnostics["profile"] == "durable"
+    for connection in ("read_connection", "write_connection"):
+        applied = diagnostics[connection]
+        assert (applied["journal_mode"], applied["cache_size"], applied["busy_timeout"]) == ("wal", -8000, 5.0)
+    assert diagnostics["write_connection"]["synchronous"] == "full"
+
+def test_statement_stats_and_slow_log(service, monkeypatch):
+    '''This tests the statistics of the statements. Each run should count its call, rows and errors by type, and with
+    SLOW_QUERY_MS at 0 every statement should be logged with the types of its arguments, never their values
+    '''
+    monkeypatch.setattr(service, "SLOW_QUERY_MS", 0)
+    client = service.app.test_client()
+    before = client.get('/api/stats').get_json()["operations"]
+    post(service, "user.insert", user("stats-secret"))
+    post(service, "user.insert", user("stats-secret"))
+    get(service, "user.by_username", ["stats-secret"])
+    stats = client.get('/api/stats').get_json()
+    insert, lookup = stats["operations"]["user.insert"], stats["operations"]["user.by_username"]
+    assert insert["calls"] - before["user.insert"]["calls"] == 2
+    assert insert["errors"] - before["user.insert"]["errors"] == 1
+    assert insert["error_types"]["IntegrityError"] >= 1
+    assert (lookup["calls"] - before["user.by_username"]["calls"], lookup["rows"] - before["user.by_username"]["rows"]) \
+        == (1, 1)
+    assert 0 <= lookup["p50_ms"] <= lookup["p99_ms"]
+    logged = stats["slow_queries"][-3:]
+    assert [entry["op"] for entry in logged] == ["user.insert", "user.insert", "user.by_username"]
+    assert logged[2]["args"] == ["str"]
+    assert logged[1]["error"] is not None
+    assert "stats-secret" not in json.dumps(stats["slow_queries"])
+
+def test_snapshot_checksum_and_restore(service, tmp_path):
+    '''This tests a snapshot. Its checksum file should hold the sha256 of the snapshot in the format of sha256sum, the
+    restored database should hold the rows written before it, and a damaged snapshot should be refused without
+    touching the database
+    '''
+    post(service, "user.insert", user("snapshotted"))
+    snapshots = service.Snapshots(service.DATABASE, str(tmp_path / "snapshots"), pages=4, sleep=0)
+    taken = snapshots.take()
+    with open(taken["path"] + '.sha256') as checksum:
+        assert checksum.read() == "{}  {}\n".format(taken["sha256"], os.path.basename(taken["path"]))
+    assert service.file_sha256(taken["path"]) == taken["sha256"]
+    assert snapshots.files() == [taken["path"]]
+    restored = str(tmp_path / "restored.db")
+    assert service.restore_snapshot(taken["path"], restored) == taken["sha256"]
+    with open(taken["path"], 'r+b') as damaged:
+        damaged.seek(-8, os.SEEK_END)
+        damaged.write(b'\0' * 8)
+    with pytest.raises(ValueError, match="does not match its checksum"):
+        service.restore_snapshot(taken["path"], restored)
+    conn = sqlite3.connect(restored)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE username = 'snapshotted'").fetchone()[0] == 1
+    finally:
+        conn.close()
+
+def test_asgi_answers_like_flask(service):
+    '''This tests the ASGI variant of the service. Sent the same reads, writes, batches, streams and bad requests, it
+    should answer with the same status and the same body as the Flask service, in json and in MessagePack
+    '''
+    asgi = load_asgi(service)
+    post(service, "goods.insert", ["parity-good", "food", 2, "d", 5])
+    flask_client, asgi_client = service.app.test_client(), asgi.app.test_client()
+    requests = [("GET", '/api/get', {"op": "goods.by_name", "args": ["parity-good"]}),
+                ("GET", '/api/get', {"op": "goods.list_prices", "args": [], "format": "columnar"}),
+                ("GET", '/api/get', {"op": "goods.insert", "args": []}),
+                ("PUT", '/api/put', {"op": "goods.deduct", "args": [1, "parity-good", 1, 1]}),
+                ("PUT", '/api/put', {"op": "goods.deduct", "args": [9, "parity-good", 9, 9]}),
+                ("POST", '/api/post', {"op": "goods.insert", "args": ["parity-good", "food", 2, "d", 5]}),
+                ("POST", '/api/batch', {"ops": [{"op": "goods.deduct", "args": [1, "parity-good", 1, 1]},
+                                                {"op": "goods.by_name", "args": ["parity-good"]}]}),
+                ("POST", '/api/bulk', {"op": "goods.import", "rows": [["parity-good", "food", 2, "d", 5]]}),
+                ("GET", '/api/stream', {"op": "goods.list_prices"}),
+                ("GET", '/api/stream', {"op": "goods.by_name", "args": ["parity-good"]})]
+
+    async def send(method, path, query, headers):
+        answer = await asgi_client.open(path, method=method, json=query, headers=headers)
+        return answer.status_code, answer.mimetype, await answer.get_data()
+
+    restock = lambda: post(service, "goods.update", ["parity-good", "food", 2, "d", 5, "parity-good"])
+    for headers in ({"Accept": "application/json"}, {"Accept": "application/msgpack"}):
+        for method, path, query in requests:
+            #Both services write the same rows, each request starts from the same stock
+            restock()
+            expected = flask_client.open(path, method=method, json=query, headers=headers)
+            restock()
+            answer = asyncio.run(send(method, path, query, headers))
+            assert answer == (expected.status_code, expected.mimetype, expected.get_data()), (method, path)
+
+def test_percentiles_never_exceed_max(service):
+    '''This tests the latency percentiles. Estimated from the upper bound of a bucket, they should still never exceed
+    the largest latency counted
+    '''
+    histogram = service.LatencyHistogram()
+    assert histogram.percentile(99) == 0.0
+    for seconds in (0.0011, 0.0011, 0.0011):
+        histogram.record(seconds)
+    assert histogram.percentile(50) == histogram.percentile(99) == 0.0011
+    histogram.record(0.5)
+    assert 0.0011 <= histogram.percentile(50) <= 0.0011 * 2 ** (1 / 4)
+    assert histogram.percentile(100) == 0.5
+
+def test_snapshots_of_the_same_second(service, tmp_path, monkeypatch):
+    '''This tests two snapshots taken within the same second. Both should be kept under their own names, each with its
+    checksum, oldest first, with no temporary file left behind
+    '''
+    clock = iter(range(1000))
+    monkeypatch.setattr(service.time, "time", lambda: 1792000000 + next(clock) / 1000)
+    snapshots = service.Snapshots(service.DATABASE, str(tmp_path / "snapshots"), sleep=0)
+    taken = [snapshots.take(), snapshots.take()]
+    assert snapshots.files() == [snapshot["path"] for snapshot in taken]
+    assert taken[0]["path"] != taken[1]["path"]
+    for snapshot in taken:
+        assert service.file_sha256(snapshot["path"]) == snapshot["sha256"]
+        with open(snapshot["path"] + '.sha256') as checksum:
+            assert checksum.read().split()[0] == snapshot["sha256"]
+    assert sorted(os.listdir(tmp_path / "snapshots")) == sorted(
+        [".lock"] + [os.path.basename(snapshot["path"]) + suffix for snapshot in taken for suffix in ("", ".sha256")])
+
+def test_group_commit_with_failing_write(service):
+    '''This tests the writer. Writes queued together are committed as one group, and the one that fails only rolls back
+    itself: the others of its group are committed and their callers get their results
+    '''
+    writer = service.Writer(service.DATABASE, max_group=10, max_delay=1)
+    insert = lambda username: (lambda conn: service.OPERATIONS["user.insert"].run(conn.cursor(), user(username)))
+    futures = [writer.enqueue(insert("group-a"), service.USERS), writer.enqueue(insert("group-a"), service.USERS),
+               writer.enqueue(insert("group-b"), service.USERS)]
+    assert futures[0].result(timeout=5) == {"rowcount": 1}
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) == {"rowcount": 1}
+    stats = writer.stats()
+    assert stats["groups"] == 1
+    assert stats["writes"] == 3
+    assert stats["failed"] == 1
+    assert get(service, "user.by_username", ["group-a"])["username"] == "group-a"
+    assert get(service, "user.by_username", ["group-b"])["username"] == "group-b"
+
+def test_writer_restarts_after_stopping(service, tmp_path):
+    '''This tests a writer thread that stops because its connection cannot be opened. The queued writes should fail
+    with WriterUnavailable instead of waiting forever, and the next write should start a new thread
+    '''
+    writer = service.Writer(str(tmp_path / "missing" / "shop.db"))
+    insert = lambda username: (lambda conn: service.OPERATIONS["user.insert"].run(conn.cursor(), user(username)))
+    with pytest.raises(service.WriterUnavailable) as stopped:
+        writer.submit(insert("restarted"), service.USERS)
+    assert service.error_status(stopped.value) == 503
+    writer.path = service.DATABASE
+    assert writer.submit(insert("restarted"), service.USERS) == {"rowcount": 1}
+    assert get(service, "user.by_username", ["restarted"])["username"] == "restarted"
+
+def test_write_not_committed_in_time(service, monkeypatch):
+    '''This tests a write waiting behind a write that does not finish. It should be answered 503 after WRITE_TIMEOUT
+    seconds, and the writer should go on once the slow write finishes
+    '''
+    monkeypatch.setattr(service, "WRITE_TIMEOUT", 0.2)
+    writer = service.Writer(service.DATABASE)
+    released = threading.Event()
+    slow = writer.enqueue(lambda conn: released.wait(5))
+    with pytest.raises(service.WriterUnavailable) as late:
+        writer.submit(lambda conn: 1)
+    assert service.error_status(late.value) == 503
+    released.set()
+    assert slow.result(timeout=5) is True
+    assert writer.submit(lambda conn: 2) == 2
+
+def test_idempotent_write_replayed(service):
+    '''This tests a write sent again with the same idempotency key. It should get the result of the first one without
+    running again
+    '''
+    post(service, "user.insert", user("idem"))
+    post(service, "user.add_wallet", [10, "idem"])
+    first = post(service, "user.add_wallet", [5, "idem"], idempotency_key="charge-1")
+    again = post(service, "user.add_wallet", [5, "idem"], idempotency_key="charge-1")
+    assert first == ({"rowcount": 1}, 200)
+    assert again == first
+    assert get(service, "user.by_username", ["idem"])["wallet"] == 15
+
+def test_idempotency_key_conflict(service):
+    '''This tests an idempotency key sent again with another write. It should be refused with 422 and not run
+    '''
+    post(service, "user.insert", user("conflict"))
+    post(service, "user.add_wallet", [5, "conflict"], idempotency_key="charge-2")
+    result, status = post(service, "user.add_wallet", [50, "conflict"], idempotency_key="charge-2")
+    assert status == 422
+    assert "error" in result
+    assert get(service, "user.by_username", ["conflict"])["wallet"] == 5
+
+def test_shard_routing(sharded):
+    '''This tests the routing of the users. Each user should be written to the shard of the crc32 of its username
+    '''
+    usernames = ["shard-user-{}".format(n) for n in range(12)]
+    for username in usernames:
+        assert post(sharded, "user.insert", user(username))[1] == 200
+    for username in usernames:
+        number = zlib.crc32(username.encode('utf-8')) % 3
+        assert number == sharded.shard_of(username)
+        conn = sharded.connect(sharded.shard_path(number, sharded.DATABASE))
+        try:
+            assert conn.execute("SELECT COUNT(*) FROM users WHERE username = ?", (username,)).fetchone()[0] == 1
+        finally:
+            conn.close()
+    assert len({sharded.shard_of(username) for username in usernames}) > 1
+
+def test_user_pages_merged_across_shards(sharded):
+    '''This tests the pages of users of a sharded database. The users of every shard should come in a single order of
+    user_id, each user once, across pages
+    '''
+    for n in range(12):
+        post(sharded, "user.insert", user("page-user-{}".format(n)))
+    ids = []
+    after = 0
+    while after is not None:
+        page = get(sharded, "user.page", [after, 5])
+        assert len(page["rows"]) <= 5
+        ids += [row["user_id"] for row in page["rows"]]
+        after = page["next_after"]
+    assert ids == sorted(ids)
+    assert len(ids) == len(set(ids))
+    assert len(ids) == sum(sharded.connect(path).execute("SELECT COUNT(*) FROM users").fetchone()[0]
+                           for path in sharded.shards.paths)
+
+def test_archive_history(service):
+    '''This tests the archival of the purchases. The old purchases should move to the archive file and into the monthly
+    totals, and the lifetime totals rebuilt from the history and the monthly totals should not change
+    '''
+    post(service, "goods.insert", ["archived-good", "food", 1, "d", 100])
+    post(service, "user.insert", user("archived"))
+    for amount in (1, 2, 3):
+        post(service, "history.insert", ["archived", "archived-good", amount])
+    conn = service.connect(service.DATABASE)
+    try:
+        with conn:
+            conn.execute("UPDATE history SET purchased_at = purchased_at - 200 * 86400 "
+                         "WHERE name = 'archived' AND amount < 3")
+    finally:
+        conn.close()
+    assert service.archive_history(service.DATABASE, "archive-test.db", 90) == 2
+    conn = service.connect(service.DATABASE)
+    try:
+        assert conn.execute("SELECT amount FROM history WHERE name = 'archived'").fetchall() == [(3,)]
+        assert conn.execute("SELECT total, purchases FROM history_rollup WHERE name = 'archived'").fetchall() == [(3, 2)]
+        service.rebuild_history_summary(service.DATABASE)
+        assert conn.execute("SELECT total FROM history_summary WHERE name = 'archived'").fetchone()[0] == 6
+    finally:
+        conn.close()
+    archive = sqlite3.connect("archive-test.db")
+    try:
+        assert archive.execute("SELECT amount FROM history WHERE name = 'archived' ORDER BY amount").fetchall() == \
+            [(1,), (2,)]
+    finally:
+        archive.close()
+
+def age_purchases(module, name, days):
+    '''Makes the purchases of a user days older
+    '''
+    conn = module.connect(module.DATABASE)
+    try:
+        with conn:
+            conn.execute("UPDATE history SET purchased_at = purchased_at - ? WHERE name = ?", (days * 86400, name))
+    finally:
+        conn.close()
+
+def test_archive_again_after_new_purchases(service):
+    '''This tests archiving the newest purchases, buying again and archiving again. The new purchase should not get the
+    id of an archived one, and every purchase should end up in the archive and in the monthly totals
+    '''
+    post(service, "goods.insert", ["rearchived-good", "food", 1, "d", 100])
+    post(service, "user.insert", user("rearchived"))
+    for amount in (1, 2):
+        post(service, "history.insert", ["rearchived", "rearchived-good", amount])
+    age_purchases(service, "rearchived", 200)
+    assert service.archive_history(service.DATABASE, "rearchive-test.db", 90) == 2
+    post(service, "history.insert", ["rearchived", "rearchived-good", 5])
+    age_purchases(service, "rearchived", 200)
+    assert service.archive_history(service.DATABASE, "rearchive-test.db", 90) == 1
+    archive = sqlite3.connect("rearchive-test.db")
+    try:
+        assert archive.execute("SELECT amount FROM history WHERE name = 'rearchived' ORDER BY user_id").fetchall() == \
+            [(1,), (2,), (5,)]
+    finally:
+        archive.close()
+    conn = service.connect(service.DATABASE)
+    try:
+        assert conn.execute("SELECT SUM(total), SUM(purchases) FROM history_rollup "
+                            "WHERE name = 'rearchived'").fetchone() == (8, 3)
+    finally:
+        conn.close()
+
+def test_archive_conflict_stops_archival(service):
+    '''This tests an archive holding another purchase under the id of a purchase to archive. The archival should stop
+    without deleting the purchase or adding it to the monthly totals
+    '''
+    post(service, "user.insert", user("conflicted"))
+    post(service, "history.insert", ["conflicted", "conflicted-good", 7])
+    age_purchases(service, "conflicted", 200)
+    conn = service.connect(service.DATABASE)
+    try:
+        purchase = conn.execute("SELECT user_id, purchased_at FROM history WHERE name = 'conflicted'").fetchone()
+    finally:
+        conn.close()
+    archive = sqlite3.connect("conflict-test.db")
+    try:
+        with archive:
+            archive.execute("CREATE TABLE history (user_id INTEGER PRIMARY KEY NOT NULL, name TEXT NOT NULL, "
+                            "item TEXT NOT NULL, amount INTEGER NOT NULL, purchased_at INTEGER NOT NULL)")
+            archive.execute("INSERT INTO history VALUES (?, 'someone-else', 'other-good', 1, ?)", tuple(purchase))
+    finally:
+        archive.close()
+    with pytest.raises(service.ArchiveConflict):
+        service.archive_history(service.DATABASE, "conflict-test.db", 90)
+    conn = service.connect(service.DATABASE)
+    try:
+        assert conn.execute("SELECT amount FROM history WHERE name = 'conflicted'").fetchall() == [(7,)]
+        assert conn.execute("SELECT COUNT(*) FROM history_rollup WHERE name = 'conflicted'").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+def test_changes_resume_after_prune(service):
+    '''This tests the change feed once old changes are pruned. A cursor whose next changes are kept should resume where
+    it stopped, one whose next changes were pruned should be told to reload from the current cursor
+    '''
+    start = service.current_cursor()
+    for n in range(6):
+        post(service, "user.insert", user("feed-{}".format(n)))
+    changes, middle = service.read_changes(start, 3, ("users",))
+    assert [change["data"]["username"] for change in changes] == ["feed-0", "feed-1", "feed-2"]
+    service.prune_changes(service.DATABASE, 3)
+    changes, end = service.read_changes(middle, 10, ("users",))
+    assert [change["data"]["username"] for change in changes] == ["feed-3", "feed-4", "feed-5"]
+    with pytest.raises(service.ChangesGone) as gone:
+        service.read_changes(start, 10, ("users",))
+    assert gone.value.cursor == end
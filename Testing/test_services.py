@@ -0,0 +1,278 @@
+import functools
+import importlib.util
+import io
+import os
+import zlib
+from urllib.parse import urlsplit
+import pytest
+import requests
+from test_database import load_database
+
+#The services, not the customer.py, inventory.py and sales.py of this directory that the other tests use
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+def load_service(name, path):
+    '''Imports a service under another name
+    :param name: name of the module
+    :type name: string
+    :param path: path of the service from the root of the repository
+    :type path: string
+    :return: the module
+    '''
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPOSITORY, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def route(clients, method, url, headers=None, json=None, data=None, params=None, timeout=None, stream=False):
+    '''Sends a request of a service to the test client of the service listening on the port of the url
+    :param clients: test clients by port
+    :type clients: dictionary
+    :return: the answer of the test client
+    :rtype: requests.Response
+    '''
+    parts = urlsplit(url)
+    #The answers are read uncompressed, requests would decompress them on the network
+    headers = {name: value for name, value in (headers or {}).items() if name.lower() != "accept-encoding"}
+    answer = clients[parts.port].open(parts.path, method=method, headers=headers, json=json, data=data,
+                                      query_string=params)
+    response = requests.Response()
+    response.status_code = answer.status_code
+    response.headers = requests.structures.CaseInsensitiveDict(answer.headers)
+    if stream:
+        response.raw = io.BytesIO(answer.get_data())
+    else:
+        response._content = answer.get_data()
+    response.encoding = "utf-8"
+    response.url = url
+    return response
+
+@pytest.fixture(scope="module")
+def services(tmp_path_factory):
+    '''Loads the four services once, the Database service in a directory of its own
+    :return: the modules of the database, customer, inventory and sales services and the directory of the database
+    '''
+    directory = tmp_path_factory.mktemp("services")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        database = load_database("services_database", 1)
+    finally:
+        os.chdir(cwd)
+    modules = (database, load_service("services_customer", "Customer/customer.py"),
+               load_service("services_inventory", "Inventory/inventory.py"),
+               load_service("services_sales", "Sales/sales.py"))
+    return modules, directory
+
+@pytest.fixture
+def shop(services, monkeypatch):
+    '''The four services, calling each other through their test clients. The test runs in the directory of the database
+    and the failed calls of the sales service are sent again without waiting.
+    :return: the modules of the database, customer, inventory and sales services
+    '''
+    modules, directory = services
+    monkeypatch.chdir(directory)
+    clients = {port: module.app.test_client() for port, module in zip((5000, 3000, 7000, 8000), modules)}
+    monkeypatch.setattr(requests, "request", functools.partial(route, clients))
+    for method in ("get", "post", "put", "delete"):
+        monkeypatch.setattr(requests, method, functools.partial(route, clients, method.upper()))
+    monkeypatch.setattr(modules[3], "CALL_BACKOFF", 0)
+    return modules
+
+def open_shop(shop, username, wallet, good, price, count):
+    '''Registers a customer with some money and a good in stock
+    '''
+    database, customer, inventory, sales = shop
+    customer.register({"fullname": "Test User", "username": username, "password": "pw", "age": 30,
+                       "address": "Beirut", "gender": "male", "marital_status": "single"})
+    customer.charge(username, wallet)
+    inventory.add_goods({"name": good, "category": "food", "price": price, "description": "d", "count": count})
+
+def sell(shop, username, good, amount, key):
+    '''Sends a sale to the sales service
+    :return: the decoded answer and the http status
+    '''
+    response = shop[3].app.test_client().post('/api/sale/{},{}'.format(username, good), json=amount,
+                                              headers={"Idempotency-Key": key})
+    return response.get_json(), response.status_code
+
+def wallet_and_stock(shop, username, good):
+    '''Returns the wallet of a customer and the stock of a good
+    :rtype: tuple
+    '''
+    database, customer, inventory, sales = shop
+    return customer.get_user_by_username(username)["wallet"], inventory.get_good_by_name(good)["count"]
+
+def test_sale_key_reused_for_another_sale(shop):
+    '''This tests a sale key sent again for another amount. It should be refused with 422 without charging anything,
+    however many times it is sent
+    '''
+    open_shop(shop, "reused", 100, "reused-good", 10, 10)
+    assert sell(shop, "reused", "reused-good", 2, "reused-key") == ({"status": "Purchase successful"}, 200)
+    for _ in range(2):
+        result, status = sell(shop, "reused", "reused-good", 3, "reused-key")
+        assert status == 422
+        assert result["idempotency_key"] == "reused-key"
+    assert wallet_and_stock(shop, "reused", "reused-good") == (80, 8)
+
+def test_interrupted_sale_keeps_its_price(shop, monkeypatch):
+    '''This tests a sale interrupted once its wallet is reduced, then sent again after the price of the good changed.
+    It should answer 502 with its key, and sent again it should finish at the first price without charging twice
+    '''
+    database, customer, inventory, sales = shop
+    open_shop(shop, "repriced", 100, "repriced-good", 10, 10)
+    send = requests.request
+
+    def unreachable_inventory(method, url, **kwargs):
+        if urlsplit(url).port == 7000:
+            raise requests.ConnectionError("Inventory is down")
+        return send(method, url, **kwargs)
+    monkeypatch.setattr(requests, "request", unreachable_inventory)
+    result, status = sell(shop, "repriced", "repriced-good", 2, "repriced-key")
+    assert status == 502
+    assert result["step"] == "reducing the stock"
+    monkeypatch.setattr(requests, "request", send)
+    inventory.update_good({"name": "repriced-good", "category": "food", "price": 30, "description": "d", "count": 10})
+    assert sell(shop, "repriced", "repriced-good", 2, "repriced-key") == ({"status": "Purchase successful"}, 200)
+    assert wallet_and_stock(shop, "repriced", "repriced-good") == (80, 8)
+
+def test_import_skips_rows_that_are_not_scalars(shop):
+    '''This tests imports whose rows hold a json object or a list among valid rows. The bad rows should be counted as
+    invalid with their line, and the valid rows of the same chunk should be inserted
+    '''
+    database, customer, inventory, sales = shop
+    goods = ['{{"name": "scalar-good-{}", "category": "food", "price": 1, "description": "d", "count": 1}}'.format(n)
+             for n in range(5)]
+    goods.insert(2, '{"name": "object-good", "category": "food", "price": 1, "description": {"x": 1}, "count": 1}')
+    summary = inventory.import_goods(goods, "ndjson")
+    assert (summary["inserted"], summary["invalid"]) == (5, 1)
+    assert summary["errors"] == [{"line": 3, "error": "Description must be text or a number"}]
+    users = ['{{"fullname": "U", "username": "scalar-user-{}", "password": "p", "age": 1, "address": "A", '
+             '"gender": "m", "marital_status": "s"}}'.format(n) for n in range(5)]
+    users.append('{"fullname": "U", "username": "list-user", "password": "p", "age": 1, "address": ["A"], '
+                 '"gender": "m", "marital_status": "s"}')
+    summary = customer.import_users(users, "ndjson")
+    assert (summary["inserted"], summary["invalid"]) == (5, 1)
+    assert summary["errors"] == [{"line": 6, "error": "Address must be text or a number"}]
+    assert customer.get_user_by_username("list-user") == {}
+
+def test_deduce_good_refuses_amounts_not_above_zero(shop):
+    '''This tests reducing the stock by a negative, zero or non numeric amount, through the inventory and straight
+    through the database. The stock should stay the same
+    '''
+    database, customer, inventory, sales = shop
+    open_shop(shop, "negative", 100, "negative-good", 10, 10)
+    for amount in (-5, 0, "2", True):
+        assert inventory.deduce_good("negative-good", amount) == ({"status": "Amount should be a number above 0"}, {})
+    client = database.app.test_client()
+    assert client.put('/api/put', json={"op": "goods.deduct", "args": [-5, "negative-good", -5, -5]}).get_json() == \
+        {"rowcount": 0}
+    assert wallet_and_stock(shop, "negative", "negative-good") == (100, 10)
+
+def test_deduce_wallet_refuses_amounts_not_above_zero(shop):
+    '''This tests reducing a wallet by a negative or zero amount, through the customer service and straight through the
+    database. The wallet should stay the same
+    '''
+    database, customer, inventory, sales = shop
+    open_shop(shop, "spender", 100, "spender-good", 10, 10)
+    for amount in (-5, 0, -0.5):
+        assert customer.deduce_wallet("spender", amount) == ({"status": "Amount should be above 0"}, {})
+    assert customer.deduce_wallet("spender", "5") == ({"status": "Amount should be a number"}, {})
+    client = database.app.test_client()
+    assert client.put('/api/put', json={"op": "user.deduct_wallet", "args": [-5, "spender", -5, -5]}).get_json() == \
+        {"rowcount": 0}
+    assert wallet_and_stock(shop, "spender", "spender-good") == (100, 10)
+
+def test_msgpack_negotiated(shop):
+    '''This tests the format of the answers. A caller asking for MessagePack should get it, holding the same user as
+    the json, and a caller sending no Accept header or accepting anything should get json
+    '''
+    msgpack = pytest.importorskip("msgpack")
+    database, customer, inventory, sales = shop
+    open_shop(shop, "packed", 10, "packed-good", 1, 1)
+    client = customer.app.test_client()
+    packed = client.get('/api/users/packed', headers={"Accept": "application/msgpack, application/json;q=0.5"})
+    assert packed.mimetype == "application/msgpack"
+    user = msgpack.unpackb(packed.get_data())
+    assert user["username"] == "packed"
+    for headers in ({}, {"Accept": "*/*"}, {"Accept": "application/json"}):
+        answer = client.get('/api/users/packed', headers=headers)
+        assert answer.mimetype == "application/json"
+        assert answer.get_json() == user
+    answer = database.app.test_client().get('/api/get', json={"op": "user.by_username", "args": ["packed"]},
+                                            headers=customer.ACCEPT)
+    assert answer.mimetype == "application/msgpack"
+    assert msgpack.unpackb(answer.get_data()) == user
+
+def test_large_answers_compressed(shop):
+    '''This tests the compression of the answers. A listing of a few kilobytes and a stream should be
+    compressed in the encoding the caller prefers and decompress to the same body, a small answer and an answer to a
+    caller accepting no encoding should not
+    '''
+    database, customer, inventory, sales = shop
+    customer.import_users(['{{"fullname": "U", "username": "compressed-{}", "password": "p", "age": 1, '
+                           '"address": "A", "gender": "m", "marital_status": "s"}}'.format(n) for n in range(40)],
+                          "ndjson")
+    client = customer.app.test_client()
+    plain = client.get('/api/users')
+    assert "Content-Encoding" not in plain.headers
+    decompress = {"gzip": lambda data: zlib.decompress(data, 31), "deflate": zlib.decompress}
+    for encoding, accept in (("gzip", "gzip"), ("deflate", "deflate"), ("gzip", "deflate;q=0.5, gzip")):
+        answer = client.get('/api/users', headers={"Accept-Encoding": accept})
+        assert answer.headers["Content-Encoding"] == encoding
+        assert "Accept-Encoding" in answer.headers["Vary"]
+        assert decompress[encoding](answer.get_data()) == plain.get_data()
+    small = client.get('/api/users/compressed-0', headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+    streamed = client.get('/api/users?format=ndjson', headers={"Accept-Encoding": "gzip"})
+    assert streamed.headers["Content-Encoding"] == "gzip"
+    assert zlib.decompress(streamed.get_data(), 31) == client.get('/api/users?format=ndjson').get_data()
+
+def test_import_validates_csv_rows(shop):
+    '''This tests a csv import of goods with invalid rows and a good already registered. Each invalid row should be
+    reported with its line and reason, the registered good skipped, and the export should hold the imported goods
+    '''
+    database, customer, inventory, sales = shop
+    inventory.add_goods({"name": "csv-taken", "category": "food", "price": 1, "description": "d", "count": 1})
+    lines = ["name,category,price,description,count",
+             "csv-apple,food,1.5,fresh,3",
+             "csv-taken,food,9,again,9",
+             "csv-robot,toys,1,d,1",
+             "csv-cheap,food,-1,d,1",
+             "csv-half,food,1,d,2.5",
+             ",food,1,d,1",
+             "csv-pear,Food,2,ripe,0"]
+    summary = inventory.import_goods(lines, "csv")
+    assert {key: summary[key] for key in ("status", "read", "inserted", "skipped", "invalid")} == \
+        {"status": "Successful import", "read": 7, "inserted": 2, "skipped": 1, "invalid": 4}
+    assert summary["errors"] == [{"line": 4, "error": "Category is invalid"},
+                                 {"line": 5, "error": "Price must be a number of at least 0"},
+                                 {"line": 6, "error": "Count must be a whole number of at least 0"},
+                                 {"line": 7, "error": "Name is empty"}]
+    assert inventory.get_good_by_name("csv-taken")["price"] == 1
+    exported = "".join(chunk.decode() if isinstance(chunk, bytes) else chunk for chunk in inventory.export_goods("csv"))
+    assert "csv-apple,food,1.5,fresh,3" in exported.splitlines()
+    assert "csv-pear,Food,2.0,ripe,0" in exported.splitlines()
+
+def test_search_goods(shop):
+    '''This tests the full-text search of the goods. A good naming the words should come before one only describing
+    them, the last word should match as a prefix and without its accents, text holding FTS5 syntax should be searched
+    as words, and a renamed good should be found by its new name only
+    '''
+    database, customer, inventory, sales = shop
+    for name, description in (("Quokka crème", "a soft cheese"), ("Plain cheese", "made with quokka milk"),
+                              ("Wombat bread", "baked daily")):
+        inventory.add_goods({"name": name, "category": "food", "price": 1, "description": description, "count": 1})
+    names = lambda text: [good["name"] for good in sales.search_goods(text)["goods"]]
+    assert names("quokka") == ["Quokka crème", "Plain cheese"]
+    assert names("quokka crem") == ["Quokka crème"]
+    assert names("QUOKKA milk") == ["Plain cheese"]
+    assert names('wombat" OR "quokka') == []
+    assert names("NEAR(wombat") == []
+    assert names("wom") == ["Wombat bread"]
+    database.app.test_client().put('/api/put', json={"op": "goods.update", "args": [
+        "Numbat bread", "food", 1, "baked daily", 1, "Wombat bread"]})
+    assert names("wombat") == []
+    assert names("numbat") == ["Numbat bread"]
+    page = sales.search_goods("quokka", limit=1)
+    assert (len(page["goods"]), page["next_offset"]) == (1, 1)